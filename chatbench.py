@@ -0,0 +1,1140 @@
+# chatbench.py
+
+import argparse
+import gc
+import gzip
+import heapq
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from bisect import bisect_right
+import chatserve
+import loadgen
+from chatclient import AdaptiveInterval, ChatClient, PollScheduler
+from chatlimit import RateLimiter
+
+# --------------------------
+# In-process Benchmarks
+# --------------------------
+#
+# Each command drives chatserve.py's state operations directly, in this
+# process and without HTTP, so it measures the state and its locks rather
+# than the web server. Run one command per process: they start from the
+# module's empty state. A command exits with status 1 when a check fails.
+
+def unlimited():
+    """Turn off the rate limits and the backlog bound; benchmarks send faster than people."""
+    chatserve.send_limiter = RateLimiter(0, chatserve.SEND_BURST)
+    chatserve.room_send_limiter = RateLimiter(0, chatserve.ROOM_SEND_BURST)
+    chatserve.create_room_limiter = RateLimiter(0, chatserve.CREATE_ROOM_BURST)
+    chatserve.MAX_MAILBOX_BACKLOG = 0
+
+# --------------------------
+# Contention
+# --------------------------
+#
+# Writer threads send direct messages between disjoint pairs of users, so
+# no two threads share a mailbox, while one reader polls the online list.
+# With per-mailbox locks the writers only meet on membership_lock for the
+# lookup; every message must arrive exactly once and in id order.
+
+def contention(threads_list, messages, message):
+    unlimited()
+    rounds = []
+    for threads in threads_list:
+        pairs = [(f'c{threads}_{i}_a', f'c{threads}_{i}_b') for i in range(threads)]
+        for sender, recipient in pairs:
+            chatserve.add_user(sender)
+            chatserve.add_user(recipient)
+        per_thread = messages // threads
+        barrier = threading.Barrier(threads + 1)
+        done = threading.Event()
+        reads = [0]
+
+        def write(sender, recipient):
+            barrier.wait()
+            for _ in range(per_thread):
+                chatserve.send_message(sender, recipient, message)
+
+        def read():
+            while not done.is_set():
+                chatserve.online_users_since(-1)  # Never current, so the full list every time
+                reads[0] += 1
+
+        writers = [threading.Thread(target=write, args=pair) for pair in pairs]
+        reader = threading.Thread(target=read)
+        for thread in writers:
+            thread.start()
+        reader.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        done.set()
+        reader.join()
+
+        lost = duplicated = 0
+        for _, recipient in pairs:
+            ids = chatserve.get_new_messages(recipient, 0)
+            ids = [msg.id for msg in ids]
+            lost += per_thread - len(set(ids))
+            duplicated += len(ids) - len(set(ids))
+            if ids != sorted(ids):
+                duplicated += 1
+        rounds.append({
+            'threads': threads,
+            'messages': per_thread * threads,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(per_thread * threads / elapsed),
+            'reader_calls_per_second': round(reads[0] / elapsed),
+            'lost': lost,
+            'duplicated_or_unordered': duplicated,
+        })
+        print(f"{threads:3d} threads: {rounds[-1]['messages_per_second']:8d} msg/s, "
+              f"reader {rounds[-1]['reader_calls_per_second']:7d} calls/s, lost {lost}, duplicated {duplicated}")
+    base = rounds[0]['messages_per_second']
+    for result in rounds:
+        result['scaling'] = round(result['messages_per_second'] / base, 2)
+    ok = all(not result['lost'] and not result['duplicated_or_unordered'] for result in rounds)
+    return {'rounds': rounds}, ok
+
+# --------------------------
+# Soak
+# --------------------------
+#
+# A simulated day of traffic in a few minutes: chatserve's clock is moved
+# forward by hand, five minutes per slice, with a compaction pass after
+# each. Most users read and acknowledge every slice; a few never read, so
+# only the caps bound their mailboxes and their rooms'. Once the age cap
+# has had time to act, RSS and the stored messages must stay flat. RSS
+# also moves with allocator fragmentation, so the count of live Python
+# objects is checked as well; a leak shows up there first.
+
+class SimulatedClock:
+    """Stands in for the time module in chatserve, with monotonic() moved forward by hand."""
+
+    def __init__(self):
+        self.offset = 0
+
+    def monotonic(self):
+        return time.monotonic() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+SLICE = 300  # Simulated seconds between compaction passes
+
+def soak(hours, messages_per_hour, users, rooms, lagging, warmup, tolerance):
+    unlimited()
+    clock = chatserve.time = SimulatedClock()
+    rng = random.Random(1)
+    names = [f's{i}' for i in range(users)]
+    for name in names:
+        chatserve.add_user(name)
+    room_ids = [chatserve.open_room(names[r], names[r + rooms::rooms]) for r in range(rooms)]
+    members = {room_id: names[r::rooms] for r, room_id in enumerate(room_ids)}
+    readers = names[lagging:]  # The first few users never read
+    cursors = dict.fromkeys(readers, 0)
+    per_slice = messages_per_hour * SLICE // 3600
+    sequence = 0
+    hourly = []
+    for hour in range(1, hours + 1):
+        for _ in range(3600 // SLICE):
+            for _ in range(per_slice):
+                sequence += 1
+                # A word of its own per message, so the search index has to shrink too
+                text = f'message m{sequence} about topic{rng.randrange(1000)}'
+                if rng.random() < 0.5:
+                    sender, recipient = rng.sample(names, 2)
+                else:
+                    recipient = rng.choice(room_ids)
+                    sender = rng.choice(members[recipient])
+                chatserve.send_message(sender, recipient, text)
+            for name in readers:
+                new_msgs = chatserve.get_new_messages(name, cursors[name])
+                if new_msgs:
+                    cursors[name] = new_msgs[-1].id
+                chatserve.acknowledge(name, cursors[name])
+            clock.offset += SLICE
+            chatserve.compact_mailboxes()
+        gc.collect()
+        stats = chatserve.state_stats()
+        hourly.append({
+            'hour': hour,
+            'messages_sent': stats['messages_sent'],
+            'messages_stored': stats['messages_stored'],
+            'message_bytes': stats['message_bytes'],
+            'indexed_words': len(chatserve.vocabulary),
+            'allocated_blocks': sys.getallocatedblocks(),
+            'rss_bytes': chatserve.process_rss(),
+        })
+        print(f"hour {hour:3d}: sent {stats['messages_sent']:9d}, stored {stats['messages_stored']:7d} "
+              f"({stats['message_bytes'] / 1e6:6.2f} MB), words {len(chatserve.vocabulary):7d}, "
+              f"blocks {hourly[-1]['allocated_blocks']:8d}, rss {hourly[-1]['rss_bytes'] / 1e6:7.1f} MB")
+    # Flat: nothing after the warmup grows past the warmup hour by more than tolerance
+    base = hourly[min(warmup, hours) - 1]
+    later = hourly[warmup:]
+    checks = {}
+    for key in ('messages_stored', 'indexed_words', 'allocated_blocks', 'rss_bytes'):
+        peak = max((hour[key] for hour in later), default=base[key])
+        checks[key] = {'after_warmup': base[key], 'peak_later': peak, 'growth': round(peak / base[key] - 1, 4)}
+    ok = all(check['growth'] <= tolerance for check in checks.values())
+    print(', '.join(f"{key} {check['growth']:+.1%}" for key, check in checks.items()),
+          f"after hour {warmup} (limit {tolerance:+.0%})")
+    return {'hours': hourly, 'checks': checks}, ok
+
+# --------------------------
+# Recovery
+# --------------------------
+#
+# Writes a log through the real send path, then times startup on it in a
+# fresh process twice: once replaying every record, and once more after
+# that process took a snapshot and logged a short tail, which is what a
+# server with --snapshot-interval replays. Each replay must bring back
+# exactly the messages that were written.
+
+TOPICS = [f'topic{i}' for i in range(1000)]  # A small vocabulary, so memory goes to the messages
+
+def run_replay(directory, tail):
+    """Run the replay command in a child process and return its results."""
+    with tempfile.NamedTemporaryFile(suffix='.json') as output:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--output', output.name,
+                        'replay', directory, '--tail', str(tail)], check=True)
+        return json.load(output)
+
+def replay(directory, tail):
+    started = time.perf_counter()
+    chatserve.open_log(directory)
+    elapsed = time.perf_counter() - started
+    stats = chatserve.state_stats()
+    result = {
+        'seconds': round(elapsed, 2),
+        'messages_sent': stats['messages_sent'],
+        'messages_stored': stats['messages_stored'],
+        'records_per_second': round(stats['messages_stored'] / elapsed),
+        'rss_bytes': chatserve.process_rss(),
+    }
+    print(f"replayed {stats['messages_stored']} messages in {elapsed:.1f} s, "
+          f"rss {result['rss_bytes'] / 1e6:.0f} MB")
+    if tail:
+        started = time.perf_counter()
+        chatserve.take_snapshot()
+        result['snapshot_seconds'] = round(time.perf_counter() - started, 2)
+        users = sorted(chatserve.connected_users)
+        for i in range(tail):
+            chatserve.send_message(users[i % len(users)], users[(i + 1) % len(users)], f'tail {TOPICS[i % 1000]}')
+        chatserve.wal.sync()
+        print(f"snapshot in {result['snapshot_seconds']:.1f} s, then {tail} more messages logged")
+    return result
+
+def recovery(messages, users, rooms, tail, directory):
+    unlimited()
+    keep = directory is not None
+    directory = directory or tempfile.mkdtemp(prefix='chatbench-')
+    try:
+        chatserve.open_log(directory)
+        names = [f'r{i}' for i in range(users)]
+        for name in names:
+            chatserve.add_user(name)
+        room_ids = [chatserve.open_room(names[r], names[r + rooms::rooms]) for r in range(rooms)]
+        rng = random.Random(1)
+        started = time.perf_counter()
+        for i in range(messages):
+            text = f'message about {rng.choice(TOPICS)} and {rng.choice(TOPICS)}'
+            if i % 2:
+                chatserve.send_message(names[i % users], names[(i * 7 + 1) % users], text)
+            else:
+                room_id = room_ids[i % rooms]
+                chatserve.send_message(names[i % rooms], room_id, text)
+        chatserve.wal.sync()
+        elapsed = time.perf_counter() - started
+        stats = chatserve.state_stats()
+        log_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        written = {'messages_sent': stats['messages_sent'], 'messages_stored': stats['messages_stored'],
+                   'seconds': round(elapsed, 1), 'log_bytes': log_bytes}
+        print(f"wrote {stats['messages_stored']} messages ({log_bytes / 1e6:.0f} MB of log) in {elapsed:.0f} s")
+        # The writer's own copy of the state is dropped before the replays measure theirs
+        chatserve.wal = None
+        chatserve.mailboxes.clear()
+        gc.collect()
+
+        full = run_replay(directory, tail)
+        snapshot = run_replay(directory, 0)
+        ok = (full['messages_sent'] == written['messages_sent']
+              and full['messages_stored'] == written['messages_stored']
+              and snapshot['messages_sent'] == written['messages_sent'] + tail
+              and snapshot['messages_stored'] == written['messages_stored'] + tail)
+        return {'written': written, 'full_replay': full, 'snapshot_replay': snapshot}, ok
+    finally:
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+# --------------------------
+# Pastes
+# --------------------------
+#
+# Chat lines mixed with 100 kB log pastes, sent to a 10-member room twice:
+# once with payloads stored and served as they are, once with the store's
+# zlib and the responses' gzip. The second pass uses its own users and room,
+# so both run in one process. Wire bytes are the response bodies one member
+# is sent, polling after every message and then for the whole backlog.
+
+STORE_COMPRESS_MIN = chatserve.STORE_COMPRESS_MIN
+
+def paste(rng, size):
+    """Log lines, like a pasted stack of them, of about size characters."""
+    lines = []
+    while size > 0:
+        line = (f'2026-10-17 12:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{rng.randrange(1000):03d} '
+                f'{rng.choice(("INFO", "INFO", "WARN", "ERROR"))} worker-{rng.randrange(16)} '
+                f'GET /api/{rng.choice(TOPICS)}/{rng.randrange(10 ** 6)} took {rng.randrange(2000)} ms')
+        lines.append(line)
+        size -= len(line) + 1
+    return '\n'.join(lines)
+
+def decoded(response):
+    body = response.data
+    if response.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return json.loads(body)['messages']
+
+def send_pastes(prefix, messages, paste_count, paste_bytes, compress):
+    """Send the corpus to a new room and poll it; the bytes and timings seen."""
+    chatserve.STORE_COMPRESS_MIN = STORE_COMPRESS_MIN if compress else sys.maxsize
+    encoding = {'Accept-Encoding': 'gzip' if compress else 'identity'}
+    client = chatserve.app.test_client()
+    names = [f'{prefix}{i}' for i in range(10)]
+    tokens = [client.post('/register', json={'username': name}).get_json()['token'] for name in names]
+    reader = {'Authorization': f'Bearer {tokens[-1]}', **encoding}
+    room_id = chatserve.open_room(names[0], names[1:])
+    rng = random.Random(1)
+    corpus = [paste(rng, paste_bytes) if i % (messages // paste_count) == 0 else f'message {i} about {rng.choice(TOPICS)}'
+              for i in range(messages)]
+    last_id = max(chatserve.mailboxes[room_id].ids)
+    first_id = last_id
+    polled = 0
+    paste_polls = []
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i, text in enumerate(corpus):
+        chatserve.send_message(names[i % 9], room_id, text)
+        started = time.perf_counter()
+        response = client.get(f'/messages?username={names[-1]}&last_id={last_id}', headers=reader)
+        if len(text) > 1000:
+            paste_polls.append(time.perf_counter() - started)
+        polled += len(response.data)
+        last_id = max((message['id'] for message in decoded(response)), default=last_id)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    started = time.perf_counter()
+    backlog = client.get(f'/messages?username={names[-1]}&last_id={first_id}', headers=reader)
+    backlog_time = time.perf_counter() - started
+    return {'payload_bytes': chatserve.mailboxes[room_id].nbytes, 'memory_held': held,
+            'wire_polling_each': polled, 'wire_backlog': len(backlog.data),
+            'backlog_delivered': len(decoded(backlog)), 'paste_poll_ms': median_ms(paste_polls),
+            'backlog_ms': round(backlog_time * 1000, 1)}, sum(map(len, corpus))
+
+def pastes(messages, paste_count, paste_bytes):
+    unlimited()
+    before, text = send_pastes('pb', messages, paste_count, paste_bytes, compress=False)
+    after, _ = send_pastes('pa', messages, paste_count, paste_bytes, compress=True)
+    result = {'messages': messages, 'pastes': paste_count, 'text_bytes': text, 'before': before, 'after': after}
+    print(f"{messages} messages into a 10-member room, {paste_count} of them {paste_bytes // 1000} kB pastes, "
+          f"{text / 1e6:.2f} MB of text:")
+    print(f"{'':36} {'before':>9} {'after':>9}")
+    for key, label, scale, unit in (('payload_bytes', 'mailbox payload bytes', 1e6, 'MB'),
+                                    ('memory_held', 'memory held (tracemalloc)', 1e6, 'MB'),
+                                    ('wire_polling_each', 'wire, member polling each message', 1e6, 'MB'),
+                                    ('wire_backlog', 'wire, full backlog in one poll', 1e6, 'MB'),
+                                    ('paste_poll_ms', 'poll delivering one paste', 1, 'ms'),
+                                    ('backlog_ms', 'full backlog poll', 1, 'ms')):
+        print(f"  {label:<34} {before[key] / scale:6.2f} {unit} {after[key] / scale:6.2f} {unit}")
+    ok = (before['backlog_delivered'] == after['backlog_delivered'] == messages
+          and all(after[key] < before[key] for key in ('payload_bytes', 'memory_held', 'wire_polling_each', 'wire_backlog')))
+    return result, ok
+
+# --------------------------
+# Polls
+# --------------------------
+#
+# A /messages poll bisects each of the user's mailboxes on last_id, so its
+# cost should not depend on the history stored behind it. The store is
+# grown through the send path to each size in turn, and the same polls are
+# timed at every size: an empty one from the newest id, and one catching up
+# on the last CATCH_UP messages sent. Neither may get slower by more than
+# the tolerance from the smallest size to the largest.
+
+CATCH_UP = 10000  # Messages sent since the catch-up polls' last_id, over all mailboxes
+SEND_BATCH = 100  # Messages per send_messages call while filling the store
+
+def batches(count, names, room_ids, rng):
+    """Yield (sender, batch) of count messages, half direct and half to the sender's room."""
+    users, rooms = len(names), len(room_ids)
+    for start in range(0, count, SEND_BATCH):
+        sender = rng.randrange(users)
+        batch = []
+        for i in range(min(SEND_BATCH, count - start)):
+            text = f'message about {rng.choice(TOPICS)} and {rng.choice(TOPICS)}'
+            if i % 2:
+                recipient = names[(sender + rng.randrange(1, users)) % users]
+            else:
+                recipient = room_ids[sender % rooms]
+            batch.append({'recipient': recipient, 'message': text})
+        yield names[sender], batch
+
+def fill(count, names, room_ids, rng):
+    """Send count messages through send_messages, in batches."""
+    for sender, batch in batches(count, names, room_ids, rng):
+        chatserve.send_messages(sender, batch)
+
+def time_polls(polled, last_ids, rounds):
+    """Median and p99 microseconds of get_new_messages over rounds passes of polled."""
+    timings = []
+    for _ in range(rounds):
+        for name, last_id in zip(polled, last_ids):
+            started = time.perf_counter_ns()
+            chatserve.get_new_messages(name, last_id)
+            timings.append(time.perf_counter_ns() - started)
+    timings.sort()
+    return {'p50_us': round(timings[len(timings) // 2] / 1000, 2),
+            'p99_us': round(timings[len(timings) * 99 // 100] / 1000, 2)}
+
+def polls(sizes, users, rooms, polled_users, rounds, tolerance):
+    unlimited()
+    names = [f'p{i:05d}' for i in range(users)]
+    for name in names:
+        chatserve.add_user(name)
+    room_ids = [chatserve.open_room(names[r], names[r + rooms::rooms]) for r in range(rooms)]
+    polled = random.Random(2).sample(names, polled_users)
+    rng = random.Random(1)
+    results = []
+    stored = 0
+    for size in sizes:
+        started = time.perf_counter()
+        fill(size - stored, names, room_ids, rng)
+        stored = size
+        filled = time.perf_counter() - started
+        newest = chatserve.message_id - 1
+        gc.collect()
+        result = {'messages': size, 'fill_seconds': round(filled, 1), 'rss_bytes': chatserve.process_rss(),
+                  'empty': time_polls(polled, [newest] * polled_users, rounds),
+                  'catch_up': time_polls(polled, [newest - CATCH_UP] * polled_users, rounds)}
+        results.append(result)
+        print(f"{size:>10} messages: empty poll p50 {result['empty']['p50_us']:7.1f} us "
+              f"p99 {result['empty']['p99_us']:7.1f} us, catch-up p50 {result['catch_up']['p50_us']:7.1f} us "
+              f"p99 {result['catch_up']['p99_us']:7.1f} us; rss {result['rss_bytes'] / 1e6:.0f} MB")
+    checks = {}
+    for kind in ('empty', 'catch_up'):
+        first, last = results[0][kind]['p50_us'], results[-1][kind]['p50_us']
+        checks[kind] = {'growth': round(last / first - 1, 3), 'ok': last <= first * (1 + tolerance)}
+        print(f"{kind} poll median {first:.1f} -> {last:.1f} us from {sizes[0]} to {sizes[-1]} messages: "
+              f"{'ok' if checks[kind]['ok'] else 'FAIL'} (limit {tolerance:+.0%})")
+    return {'sizes': results, 'checks': checks}, all(check['ok'] for check in checks.values())
+
+# --------------------------
+# Batching
+# --------------------------
+#
+# The same messages sent one /send request each and then as /send_batch
+# requests, through the Flask test client so each request pays for its
+# routing, JSON and session check as a real one would. Batches must
+# deliver every message and be the faster way to send them.
+
+def batching(messages, batch_size):
+    unlimited()
+    client = chatserve.app.test_client()
+    token = client.post('/register', json={'username': 'b_alice'}).get_json()['token']
+    client.post('/register', json={'username': 'b_bob'})
+    alice = {'Authorization': f'Bearer {token}'}
+    texts = [f'message {i} about {TOPICS[i % 1000]}' for i in range(messages)]
+    refused = 0
+
+    started = time.perf_counter()
+    for text in texts:
+        response = client.post('/send', json={'sender': 'b_alice', 'recipient': 'b_bob', 'message': text},
+                               headers=alice)
+        refused += response.status_code != 200
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for start in range(0, messages, batch_size):
+        batch = [{'recipient': 'b_bob', 'message': text} for text in texts[start:start + batch_size]]
+        response = client.post('/send_batch', json={'sender': 'b_alice', 'messages': batch}, headers=alice)
+        refused += response.status_code != 200
+    batched = time.perf_counter() - started
+
+    delivered = len(chatserve.get_new_messages('b_bob', 0))
+    result = {'messages': messages, 'batch_size': batch_size, 'refused_requests': refused,
+              'delivered': delivered, 'single_per_second': round(messages / single),
+              'batched_per_second': round(messages / batched)}
+    print(f"single /send:         {result['single_per_second']:8} msg/s")
+    print(f"/send_batch of {batch_size:<5} {result['batched_per_second']:8} msg/s "
+          f"({single / batched:.0f}x); {delivered}/{2 * messages} delivered")
+    return result, not refused and delivered == 2 * messages and batched < single
+
+# --------------------------
+# Rooms
+# --------------------------
+#
+# Rooms of 10k members, among users some of whom hold a poll open: each is
+# created, sent to and left by one member, then a user in all of them logs
+# out. Room notices are posted once in the room's own mailbox, so none of
+# this may store a message per member.
+
+def median_ms(timings):
+    return round(sorted(timings)[len(timings) // 2] * 1000, 2)
+
+def large_rooms(members, count, waiting):
+    unlimited()
+    names = [f'l{i:05d}' for i in range(members)]
+    for name in names:
+        chatserve.add_user(name)
+    events = [chatserve.add_waiter(name) for name in names[-waiting:]]
+    timings = {'create': [], 'send': [], 'leave': []}
+    for r in range(count):
+        started = time.perf_counter()
+        room_id = chatserve.open_room(names[0], names[1:])
+        timings['create'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        chatserve.send_message(names[1], room_id, f'hello room {r}')
+        timings['send'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        chatserve.leave(names[2 + r], room_id)
+        timings['leave'].append(time.perf_counter() - started)
+    # names[0] is in every room
+    started = time.perf_counter()
+    chatserve.log_out(names[0])
+    logout = time.perf_counter() - started
+    for name, event in zip(names[-waiting:], events):
+        chatserve.remove_waiter(name, event)
+    stored = chatserve.state_stats()['messages_stored']
+
+    result = {'members': members, 'rooms': count, 'waiting': waiting,
+              **{f'{op}_ms': median_ms(values) for op, values in timings.items()},
+              'logout_ms': round(logout * 1000, 2), 'messages_stored': stored}
+    print(f"{count} rooms of {members} members, {waiting} of them waiting on a poll (median per room):")
+    print(f"  create {result['create_ms']} ms, send {result['send_ms']} ms, leave {result['leave_ms']} ms")
+    print(f"  log out of all {count}: {result['logout_ms']} ms")
+    print(f"  {stored} messages stored afterwards")
+    return result, stored < members
+
+# --------------------------
+# Limiter
+# --------------------------
+#
+# What the rate limits cost a send they let through. Buckets get a rate
+# too high to ever refuse, so every call takes the allowed path with the
+# real arithmetic: the limiter alone, check_send_rate under
+# membership_lock as the send operations call it, and send_message end to
+# end with the limits on and then off. The fast path must stay within the
+# budget, in microseconds.
+
+def per_call_us(func, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - started) / calls * 1e6
+
+def limiter(calls, budget):
+    unlimited()
+    for name in ('q_alice', 'q_bob', 'q_carol'):
+        chatserve.add_user(name)
+    room_id = chatserve.open_room('q_alice', ['q_bob'])
+    limits = (RateLimiter(1e9, 1e9), RateLimiter(1e9, 1e9))
+    bucket = RateLimiter(1e9, 1e9)
+
+    def bucket_call():
+        now = time.monotonic()
+        if not bucket.delay('q_alice', 1, now):
+            bucket.spend('q_alice', 1)
+
+    def check(recipient):
+        with chatserve.membership_lock:
+            chatserve.check_send_rate('q_alice', {recipient: 1})
+
+    result = {'empty_loop_us': per_call_us(lambda: None, calls), 'bucket_us': per_call_us(bucket_call, calls)}
+    chatserve.send_limiter, chatserve.room_send_limiter = limits
+    result['check_dm_us'] = per_call_us(lambda: check('q_bob'), calls)
+    result['check_room_us'] = per_call_us(lambda: check(room_id), calls)
+    # The backlog bound stays on, just above the sends so it never refuses
+    sends = calls // 2
+    chatserve.MAX_MAILBOX_BACKLOG = sends + 1
+    result['send_limited_us'] = per_call_us(lambda: chatserve.send_message('q_alice', 'q_bob', 'hi'), sends)
+    unlimited()
+    result['send_unlimited_us'] = per_call_us(lambda: chatserve.send_message('q_alice', 'q_carol', 'hi'), sends)
+    result = {key: round(value, 2) for key, value in result.items()}
+
+    print(f"empty loop                     {result['empty_loop_us']:6.2f} us")
+    print(f"RateLimiter.delay + spend      {result['bucket_us']:6.2f} us")
+    print(f"check_send_rate, direct        {result['check_dm_us']:6.2f} us, with membership_lock")
+    print(f"check_send_rate, room          {result['check_room_us']:6.2f} us, with membership_lock")
+    print(f"send_message, limits on / off  {result['send_limited_us']:6.2f} / {result['send_unlimited_us']:.2f} us")
+    slowest = max(result['check_dm_us'], result['check_room_us'])
+    print(f"fast path {slowest:.2f} us: {'ok' if slowest <= budget else 'FAIL'} (budget {budget:g} us)")
+    return result, slowest <= budget
+
+# --------------------------
+# Polling
+# --------------------------
+#
+# The request rate a thousand clients put on the server, from the real
+# AdaptiveInterval and PollScheduler classes with frontend.py's intervals,
+# run on a simulated clock. Messages reach each client at random, and users
+# join at random: a message pokes the client's status polls, and a join
+# makes its next presence poll find something. With push, messages cost no
+# requests but the acknowledgements; without it, /messages is polled on its
+# own interval. Every client starts at the same instant; rates are taken
+# after the first minute. The fixed 2 s loop this replaced polled every
+# resource in lockstep, whatever the load.
+
+POLLING_LOADS = {  # name: (seconds between messages to each client, seconds between joins), None for never
+    'idle': (None, None),
+    'mixed': (100, 60),
+    'active': (10, 1),
+}
+
+def simulate_polling(clients, seconds, message_every, join_every, push, rng):
+    """Requests per simulated second of clients polling, as a list."""
+    # frontend imports tkinter, which only this command needs
+    from frontend import ACK_INTERVAL, ANNOUNCEMENT_POLL, MESSAGE_RETRY, PRESENCE_POLL
+    requests = [0] * seconds
+    clock = [0.0]
+    joins = []  # Times users joined
+    if join_every:
+        t = rng.expovariate(1 / join_every)
+        while t < seconds:
+            joins.append(t)
+            t += rng.expovariate(1 / join_every)
+
+    def count():
+        if clock[0] < seconds:
+            requests[int(clock[0])] += 1
+
+    schedulers, states, events = [], [], []
+    for c in range(clients):
+        state = {'presence_at': 0.0, 'pending': 0, 'acked_at': 0.0}
+
+        def presence(state=state):
+            count()
+            since, state['presence_at'] = state['presence_at'], clock[0]
+            return bisect_right(joins, clock[0]) > bisect_right(joins, since)
+
+        def announcement():
+            count()
+            return False
+
+        def messages(state=state, c=c):
+            count()
+            found, state['pending'] = state['pending'], 0
+            if found:
+                poke(c)
+            return found
+
+        status = PollScheduler()
+        status.add(presence, AdaptiveInterval(*PRESENCE_POLL), now=0)
+        status.add(announcement, AdaptiveInterval(*ANNOUNCEMENT_POLL), now=0)
+        schedulers.append([status])
+        if not push:
+            inbox = PollScheduler()
+            inbox.add(messages, AdaptiveInterval(*MESSAGE_RETRY), now=0)
+            schedulers[c].append(inbox)
+        states.append(state)
+        for which, scheduler in enumerate(schedulers[c]):
+            events.append((scheduler.next_due(), 'poll', c, which))
+        if message_every:
+            events.append((rng.expovariate(1 / message_every), 'message', c, 0))
+    if push:
+        clock[0] = 0.0
+        for _ in range(clients):
+            count()  # Each client opens its stream once
+
+    def poke(c):
+        status = schedulers[c][0]
+        status.hurry(clock[0])
+        heapq.heappush(events, (status.next_due(), 'poll', c, 0))
+
+    heapq.heapify(events)
+    while events:
+        t, kind, c, which = heapq.heappop(events)
+        if t >= seconds:
+            break
+        clock[0] = t
+        if kind == 'poll':
+            scheduler = schedulers[c][which]
+            if t != scheduler.next_due():
+                continue  # Brought forward by a poke since
+            scheduler.run_due(t)
+            heapq.heappush(events, (scheduler.next_due(), 'poll', c, which))
+        else:
+            state = states[c]
+            if push:
+                poke(c)
+                if t - state['acked_at'] >= ACK_INTERVAL:
+                    state['acked_at'] = t
+                    count()
+            else:
+                state['pending'] += 1
+            heapq.heappush(events, (t + rng.expovariate(1 / message_every), 'message', c, 0))
+    return requests
+
+def polling(clients, minutes):
+    seconds = minutes * 60
+    random.seed(1)  # The intervals' jitter
+    rng = random.Random(1)
+    results = {}
+    ok = True
+    for push in (True, False):
+        # Before: every resource polled every 2 s in lockstep; /messages too without push
+        resources = 2 if push else 3
+        fixed = clients * resources / 2
+        mode = 'push' if push else 'no push'
+        print(f"{clients} clients, {mode}:")
+        print(f"  fixed 2 s (before)  {fixed:7.0f} req/s  peak {clients * resources:5}/s")
+        for load, (message_every, join_every) in POLLING_LOADS.items():
+            rates = simulate_polling(clients, seconds, message_every, join_every, push, rng)[60:]
+            mean, peak = sum(rates) / len(rates), max(rates)
+            results[f'{mode} {load}'] = {'requests_per_second': round(mean, 1), 'peak': peak}
+            print(f"  {load:<18}  {mean:7.0f} req/s  peak {peak:5}/s")
+            ok = ok and mean < fixed and (load != 'idle' or mean < fixed / 10)
+    return {'clients': clients, 'minutes': minutes, 'loads': results}, ok
+
+# --------------------------
+# Memory
+# --------------------------
+#
+# Bytes per stored message, traced by tracemalloc over a fixture sent
+# through the real send path. The store this replaced kept one
+# {'id', 'sender', 'recipient', 'message'} dict per message; the same
+# messages are built that way too, for comparison. Both are also given
+# without the message bodies, which neither representation can shrink,
+# and the store without its search index, which the dicts never had: what
+# is left is the record itself, which must come out smaller.
+
+def memory(messages, users, rooms):
+    unlimited()
+    names = [f'm{i:05d}' for i in range(users)]
+    for name in names:
+        chatserve.add_user(name)
+    room_ids = [chatserve.open_room(names[r], names[r + rooms::rooms]) for r in range(rooms)]
+    gc.collect()
+    tracemalloc.start()
+
+    baseline = tracemalloc.get_traced_memory()[0]
+    records = []
+    for sender, batch in batches(messages, names, room_ids, random.Random(1)):
+        for item in batch:
+            records.append({'id': len(records) + 1, 'sender': sender, 'recipient': item['recipient'],
+                            'message': item['message']})
+    dicts = tracemalloc.get_traced_memory()[0] - baseline
+    dict_bodies = sum(sys.getsizeof(record['message']) for record in records)
+    del records
+    gc.collect()
+
+    baseline = tracemalloc.get_traced_memory()[0]
+    fill(messages, names, room_ids, random.Random(1))
+    gc.collect()
+    store = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    store_bodies = 0
+    index = 0
+    for box in chatserve.mailboxes.values():
+        store_bodies += sum(len(chatserve.message_text(payload).encode()) for payload in box.payloads)
+        index += sys.getsizeof(box.index) + sum(map(sys.getsizeof, box.index.values()))
+
+    result = {
+        'messages': messages,
+        'dict_bytes_per_message': round(dicts / messages, 1),
+        'dict_bytes_per_message_without_bodies': round((dicts - dict_bodies) / messages, 1),
+        'store_bytes_per_message': round(store / messages, 1),
+        'store_bytes_per_message_without_bodies': round((store - store_bodies) / messages, 1),
+        'search_index_bytes_per_message': round(index / messages, 1),
+        'record_bytes_per_message': round((store - store_bodies - index) / messages, 1),
+    }
+    print(f"{messages} messages, bytes per message:")
+    print(f"  dict per message      {result['dict_bytes_per_message']:7.1f}  "
+          f"{result['dict_bytes_per_message_without_bodies']:7.1f} without bodies")
+    print(f"  columnar mailboxes    {result['store_bytes_per_message']:7.1f}  "
+          f"{result['store_bytes_per_message_without_bodies']:7.1f} without bodies, "
+          f"of which {result['search_index_bytes_per_message']:.1f} search index")
+    print(f"  record, without body or index: {result['dict_bytes_per_message_without_bodies']:.1f} as a dict, "
+          f"{result['record_bytes_per_message']:.1f} in columns")
+    return result, store - store_bodies - index < dicts - dict_bodies
+
+# --------------------------
+# Sessions
+# --------------------------
+#
+# Many clients that register, join rooms and never come back: the reaper
+# must log them out and take their rooms, mailboxes, indexed words and
+# interned names with them, while users holding a long poll are kept. Each
+# wave of them must leave no more behind than the one before. A few
+# requests go over HTTP first, as a client would send them, to check that
+# a session only acts for its own user and that malformed messages are
+# refused before they reach the state.
+
+STATE_MAPS = ('connected_users', 'sessions', 'session_tokens', 'last_seen', 'rooms', 'user_rooms',
+              'mailboxes', 'acked', 'vocabulary', 'symbol_ids')
+
+def state_sizes():
+    return {name: len(getattr(chatserve, name)) for name in STATE_MAPS}
+
+def abandon(prefix, users, room_size, live):
+    """Register users who chat once and go quiet, then reap them. Returns (results, failures)."""
+    names = [f'{prefix}{i:05d}' for i in range(users)]
+    for name in names:
+        chatserve.add_user(name)
+    for i in range(0, users, room_size):
+        room_id = chatserve.open_room(names[i], names[i + 1:i + room_size])
+        chatserve.send_message(names[i], room_id, f'hello room {i // room_size}')
+    for i, name in enumerate(names):
+        chatserve.send_message(names[(i + 1) % users], name, f'pending for {name}')
+    gc.collect()
+    populated = tracemalloc.get_traced_memory()[0]
+    full = state_sizes()
+
+    # The first few hold a long poll; everyone else went quiet long ago
+    events = [chatserve.add_waiter(name) for name in names[:live]]
+    stale = chatserve.time.monotonic() - chatserve.SESSION_TIMEOUT - 1
+    for name in chatserve.last_seen:
+        chatserve.last_seen[name] = stale
+    started = time.perf_counter()
+    reaped = chatserve.reap_sessions()
+    elapsed = time.perf_counter() - started
+    for name, event in zip(names, events):
+        chatserve.remove_waiter(name, event)
+    kept = set(chatserve.connected_users)
+    failures = []
+    if kept != set(names[:live]):
+        failures.append(f'{prefix}: kept {len(kept)} users, expected the {live} waiting')
+    if any(not participants <= kept for participants in chatserve.rooms.values()):
+        failures.append(f'{prefix}: a room still lists a reaped user')
+    if not set(chatserve.mailboxes) <= kept | set(chatserve.rooms):
+        failures.append(f'{prefix}: a mailbox outlived its user or room')
+
+    # Once the waiting users go quiet too, nothing is left
+    for name in chatserve.last_seen:
+        chatserve.last_seen[name] = stale
+    chatserve.reap_sessions()
+    del names, events, kept
+    gc.collect()
+    empty = state_sizes()
+    failures += [f'{prefix}: {name} still holds {size}' for name, size in empty.items() if size]
+    return {'reaped': reaped, 'reap_seconds': round(elapsed, 3), 'populated_bytes': populated,
+            'left_bytes': tracemalloc.get_traced_memory()[0], 'populated': full}, failures
+
+def sessions(users, room_size, live, waves):
+    unlimited()
+    failures = http_checks()
+    for name in ('h_alice', 'h_bob'):
+        chatserve.log_out(name)
+    gc.collect()
+    tracemalloc.start()
+    # The presence journal keeps the latest changes up to its size. Filled
+    # (and traced) first, later waves only replace its entries
+    for i in range(chatserve.PRESENCE_JOURNAL_SIZE // 2 + 1):
+        chatserve.add_user(f'wu_{i:05d}')
+        chatserve.log_out(f'wu_{i:05d}')
+    results = []
+    for wave in range(waves):
+        result, wave_failures = abandon(f'w{wave}_', users, room_size, live)
+        results.append(result)
+        failures += wave_failures
+        print(f"wave {wave + 1}: {users} sessions, {result['populated_bytes'] / 1e6:.2f} MB traced; "
+              f"reaped {result['reaped']} in {result['reap_seconds'] * 1000:.0f} ms, "
+              f"{result['left_bytes'] / 1e6:.2f} MB left")
+    tracemalloc.stop()
+    # What the first wave leaves is high-water marks of dict tables. Later
+    # waves reuse them and must leave nothing more behind
+    growth = results[-1]['left_bytes'] - results[0]['left_bytes']
+    if waves > 1 and growth > results[0]['populated_bytes'] * 0.05:
+        failures.append(f'each wave of {users} sessions leaves {growth / (waves - 1) / 1e6:.2f} MB behind')
+    for failure in failures:
+        print('FAIL', failure)
+    return {'users': users, 'waves': results, 'failures': failures}, not failures
+
+# --------------------------
+# Checks
+# --------------------------
+#
+# Requests a client might send, run through the Flask test client, each with
+# the status it must get; then the races and engine differences that review
+# turned up. Every check names what went wrong, and the command fails on any.
+
+def http_checks():
+    """Each request a client might send, with the status it must get. Returns the failures."""
+    client = chatserve.app.test_client()
+    tokens = {name: client.post('/register', json={'username': name}).get_json()['token']
+              for name in ('h_alice', 'h_bob')}
+    alice = {'Authorization': f"Bearer {tokens['h_alice']}"}
+    cases = [
+        ('own session', 200, '/send', {'sender': 'h_alice', 'recipient': 'h_bob', 'message': 'hi'}, alice, {}),
+        ('no token', 401, '/send', {'sender': 'h_alice', 'recipient': 'h_bob', 'message': 'hi'}, {}, {}),
+        ('sender is someone else', 403, '/send',
+         {'sender': 'h_bob', 'recipient': 'h_alice', 'message': 'hi'}, alice, {}),
+        ('username and sender differ', 403, '/send',
+         {'username': 'h_alice', 'sender': 'h_bob', 'recipient': 'h_alice', 'message': 'hi'}, alice, {}),
+        ('query names someone else', 403, '/send',
+         {'sender': 'h_alice', 'recipient': 'h_bob', 'message': 'hi'}, alice, {'username': 'h_bob'}),
+        ('message is an object', 400, '/send',
+         {'sender': 'h_alice', 'recipient': 'h_bob', 'message': {'text': 'hi'}}, alice, {}),
+        ('recipient is a list', 400, '/send', {'sender': 'h_alice', 'recipient': ['h_bob'], 'message': 'hi'}, alice, {}),
+        ('batch message is a number', 400, '/send_batch',
+         {'sender': 'h_alice', 'messages': [{'recipient': 'h_bob', 'message': 7}]}, alice, {}),
+        # JSON escapes can carry lone surrogates, which no UTF-8 encoder takes
+        ('message is a lone surrogate', 400, '/send',
+         {'sender': 'h_alice', 'recipient': 'h_bob', 'message': '\ud800'}, alice, {}),
+        ('batch ends in a lone surrogate', 400, '/send_batch',
+         {'sender': 'h_alice', 'messages': [{'recipient': 'h_bob', 'message': 'ok1'},
+                                            {'recipient': 'h_bob', 'message': 'x\udfff'}]}, alice, {}),
+        # Names and room ids are looked up in sets and dicts; anything but a string must not reach them
+        ('username is a list', 400, '/register', {'username': ['h_carol']}, {}, {}),
+        ('username is a number', 400, '/register', {'username': 7}, {}, {}),
+        ('participant is a list', 400, '/create_room', {'admin': 'h_alice', 'participants': [['h_bob']]}, alice, {}),
+        ('participants is a string', 400, '/create_room', {'admin': 'h_alice', 'participants': 'h_bob'}, alice, {}),
+        ('room_id is a list', 400, '/leave_room', {'username': 'h_alice', 'room_id': ['room_1']}, alice, {}),
+        ('room_id is a number', 400, '/leave_room', {'username': 'h_alice', 'room_id': 1}, alice, {}),
+    ]
+    failures = []
+    for name, expected, route, body, headers, query in cases:
+        status = client.post(route, json=body, headers=headers, query_string=query).status_code
+        if status != expected:
+            failures.append(f'{name}: {route} answered {status}, expected {expected}')
+    # A refused batch delivers none of its messages
+    bob = {'Authorization': f"Bearer {tokens['h_bob']}"}
+    received = client.get('/messages', query_string={'username': 'h_bob'}, headers=bob).get_json()['messages']
+    if any(msg['message'] == 'ok1' for msg in received):
+        failures.append('a refused batch delivered its first message')
+    return failures
+
+def leaked(names, word):
+    """What a closed mailbox kept hold of after names logged out. Returns the failures."""
+    failures = [f'{name} is still interned' for name in names if name in chatserve.symbol_ids]
+    if word in chatserve.vocabulary:
+        failures.append(f'"{word}" is still indexed')
+    return failures
+
+def race_checks():
+    """Sends that lose the race with their recipient's logout, or a room's last leave. Returns the failures."""
+    failures = []
+    # Forced: the mailbox is looked up, then discarded before the append
+    chatserve.add_user('r_alice')
+    chatserve.add_user('r_bob')
+    room_id = chatserve.open_room('r_alice', ['r_bob'])
+    for key, leave in ((room_id, lambda: [chatserve.leave(name, room_id) for name in ('r_alice', 'r_bob')]),
+                       ('r_bob', lambda: chatserve.log_out('r_bob'))):
+        mailbox, readers = chatserve.mailboxes[key], chatserve.readers_of(key)
+        leave()
+        try:
+            chatserve.deliver(mailbox, 'r_alice', 'orphaned zebra', readers)
+            failures.append(f'a message went to the discarded mailbox {key}')
+        except chatserve.StateError:
+            pass
+    chatserve.log_out('r_alice')
+    failures += leaked(('r_alice',), 'zebra')
+
+    # Raced: a batch to two users while the second logs out, many times over
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    for i in range(300):
+        sender, first, second = f'rs{i}', f'ra{i}', f'rb{i}'
+        for name in (sender, first, second):
+            chatserve.add_user(name)
+        start = threading.Barrier(2)
+        batch = [{'recipient': first, 'message': 'raced yak'}, {'recipient': second, 'message': 'raced yak'}]
+        sent = []
+
+        def send():
+            start.wait()
+            try:
+                sent.append(chatserve.send_messages(sender, batch))
+            except chatserve.StateError:
+                pass
+
+        def log_out():
+            start.wait()
+            chatserve.log_out(second)
+
+        threads = [threading.Thread(target=send), threading.Thread(target=log_out)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # All or none: a refused batch leaves nothing for the first recipient either
+        if not sent and chatserve.get_new_messages(first, 0):
+            failures.append(f'round {i}: a refused batch delivered its first message')
+        for name in (sender, first):
+            chatserve.log_out(name)
+        failures += [f'round {i}: {failure}' for failure in leaked((sender, first, second), 'yak')]
+    sys.setswitchinterval(interval)
+    return failures
+
+def engine_checks(port):
+    """What each --engine must do alike, against a real server. Returns the failures."""
+    failures = []
+    for engine in ('flask', 'asyncio'):
+        process = loadgen.start_server(engine, port, options=['--compact-interval', '0.2'])
+        try:
+            alice, bob = ChatClient(f'http://127.0.0.1:{port}'), ChatClient(f'http://127.0.0.1:{port}')
+            alice.register('e_alice')
+            bob.register('e_bob')
+            for i in range(3):
+                alice.send('e_bob', f'before the stream {i}')
+            bob.fetch()
+            # Opening a stream at last_id confirms everything up to it, so compaction may drop it.
+            # Flask sends no headers before the first event, so the stream is opened and left unread
+            with socket.create_connection(('127.0.0.1', port)) as stream:
+                stream.sendall(f'GET /stream?username=e_bob&last_id={bob.last_id} HTTP/1.1\r\n'
+                               f'Host: 127.0.0.1\r\nAuthorization: Bearer {bob.token}\r\n\r\n'.encode())
+                deadline = time.monotonic() + 3
+                while alice.call('GET', '/stats')['messages_stored'] and time.monotonic() < deadline:
+                    time.sleep(0.1)
+                stored = alice.call('GET', '/stats')['messages_stored']
+            if stored:
+                failures.append(f'{engine}: opening /stream did not acknowledge, {stored} messages kept')
+            alice.close()
+            bob.close()
+        finally:
+            loadgen.stop_server(process)
+    return failures
+
+def checks(port):
+    unlimited()
+    failures = http_checks() + race_checks() + engine_checks(port)
+    for failure in failures:
+        print('FAIL', failure)
+    print(f'{len(failures)} checks failed' if failures else 'all checks passed')
+    return {'failures': failures}, not failures
+
+# --------------------------
+# Run
+# --------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark chatserve.py's state in-process.")
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('contention', help='send throughput as writer threads go from 1 to 16')
+    command.add_argument('--threads', default='1,2,4,8,16', help='comma-separated writer thread counts')
+    command.add_argument('--messages', type=int, default=40000, help='messages sent per round, over all threads')
+    command.add_argument('--message-size', type=int, default=64, help='bytes per message body')
+
+    command = commands.add_parser('soak', help='a simulated day of traffic; RSS and storage must stay flat')
+    command.add_argument('--hours', type=int, default=24, help='simulated hours')
+    command.add_argument('--messages-per-hour', type=int, default=20000)
+    command.add_argument('--users', type=int, default=200)
+    command.add_argument('--rooms', type=int, default=20)
+    command.add_argument('--lagging', type=int, default=10, help='users who never read or acknowledge')
+    command.add_argument('--max-mailbox-messages', type=int, default=2000,
+                         help='count cap, scaled down so it acts within the day')
+    command.add_argument('--max-message-age', type=float, default=6 * 3600,
+                         help='age cap in seconds, scaled down likewise')
+    command.add_argument('--warmup', type=int, default=8, help='simulated hours before the flatness check starts')
+    command.add_argument('--tolerance', type=float, default=0.15, help='growth allowed after the warmup')
+
+    command = commands.add_parser('checks', help='the route contract, and the races review found, must hold')
+    command.add_argument('--port', type=int, default=5098, help='for the servers each --engine is checked on')
+
+    command = commands.add_parser('recovery', help='startup time on a log of 5M messages, with and without a snapshot')
+    command.add_argument('--messages', type=int, default=5000000)
+    command.add_argument('--users', type=int, default=1000)
+    command.add_argument('--rooms', type=int, default=100)
+    command.add_argument('--tail', type=int, default=100000, help='messages logged after the snapshot')
+    command.add_argument('--data-dir', help='keep the log here instead of a temporary directory')
+
+    command = commands.add_parser('replay', help='time startup on an existing --data-dir')
+    command.add_argument('directory')
+    command.add_argument('--tail', type=int, default=0, help='then snapshot and log this many more messages')
+
+    command = commands.add_parser('batching', help='send throughput of single /send against /send_batch requests')
+    command.add_argument('--messages', type=int, default=5000, help='sent each way')
+    command.add_argument('--batch-size', type=int, default=500, help=f'at most {chatserve.MAX_BATCH}')
+
+    command = commands.add_parser('rooms', help='create, send to, leave and log out of 10k-member rooms')
+    command.add_argument('--members', type=int, default=10000)
+    command.add_argument('--rooms', type=int, default=21)
+    command.add_argument('--waiting', type=int, default=300, help='members holding a poll open')
+
+    command = commands.add_parser('limiter', help="the rate limits' overhead on a send they allow")
+    command.add_argument('--calls', type=int, default=100000, help='timed calls of each kind')
+    command.add_argument('--budget', type=float, default=10, help='microseconds the limit checks may take')
+
+    command = commands.add_parser('polling', help='server request rate of 1k idle and active clients, simulated')
+    command.add_argument('--clients', type=int, default=1000)
+    command.add_argument('--minutes', type=int, default=10, help='simulated; rates are taken after the first')
+
+    command = commands.add_parser('memory', help='bytes per stored message on a 1M-message fixture, traced')
+    command.add_argument('--messages', type=int, default=1000000)
+    command.add_argument('--users', type=int, default=1000)
+    command.add_argument('--rooms', type=int, default=100)
+
+    command = commands.add_parser('pastes', help='memory and wire bytes of chat lines mixed with 100 kB pastes')
+    command.add_argument('--messages', type=int, default=2000)
+    command.add_argument('--pastes', type=int, default=40)
+    command.add_argument('--paste-bytes', type=int, default=100000)
+
+    command = commands.add_parser('polls', help='poll latency stays flat as 10k to 10M messages are stored')
+    command.add_argument('--sizes', default='10000,100000,1000000,10000000',
+                         help='comma-separated stored message counts, ascending')
+    command.add_argument('--users', type=int, default=1000)
+    command.add_argument('--rooms', type=int, default=100)
+    command.add_argument('--polled-users', type=int, default=100, help='users whose polls are timed')
+    command.add_argument('--rounds', type=int, default=20, help='polls per user at each size')
+    command.add_argument('--tolerance', type=float, default=0.5, help='median growth allowed across the sizes')
+
+    command = commands.add_parser('sessions', help='10k abandoned sessions are reaped and their memory reclaimed')
+    command.add_argument('--users', type=int, default=10000)
+    command.add_argument('--room-size', type=int, default=5)
+    command.add_argument('--live', type=int, default=100, help='users holding a long poll, who must be kept')
+    command.add_argument('--waves', type=int, default=3, help='rounds of users who come and go, each reaped in full')
+
+    args = parser.parse_args()
+    chatserve.chatmetrics.enabled = False
+    if args.command == 'contention':
+        results, ok = contention([int(n) for n in args.threads.split(',')], args.messages, 'x' * args.message_size)
+    elif args.command == 'soak':
+        chatserve.MAX_MAILBOX_MESSAGES = args.max_mailbox_messages
+        chatserve.MAX_MESSAGE_AGE = args.max_message_age
+        results, ok = soak(args.hours, args.messages_per_hour, args.users, args.rooms, args.lagging,
+                           args.warmup, args.tolerance)
+    elif args.command == 'checks':
+        results, ok = checks(args.port)
+    elif args.command == 'recovery':
+        results, ok = recovery(args.messages, args.users, args.rooms, args.tail, args.data_dir)
+    elif args.command == 'batching':
+        results, ok = batching(args.messages, args.batch_size)
+    elif args.command == 'rooms':
+        results, ok = large_rooms(args.members, args.rooms, args.waiting)
+    elif args.command == 'limiter':
+        results, ok = limiter(args.calls, args.budget)
+    elif args.command == 'polling':
+        results, ok = polling(args.clients, args.minutes)
+    elif args.command == 'memory':
+        results, ok = memory(args.messages, args.users, args.rooms)
+    elif args.command == 'pastes':
+        results, ok = pastes(args.messages, args.pastes, args.paste_bytes)
+    elif args.command == 'polls':
+        results, ok = polls([int(n) for n in args.sizes.split(',')], args.users, args.rooms, args.polled_users,
+                            args.rounds, args.tolerance)
+    elif args.command == 'sessions':
+        results, ok = sessions(args.users, args.room_size, args.live, args.waves)
+    elif args.command == 'replay':
+        results, ok = replay(args.directory, args.tail), True
+
+    results = {'command': args.command, 'python': sys.version.split()[0], **results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not ok:
+        sys.exit(f'{args.command}: check failed')
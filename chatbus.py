@@ -0,0 +1,201 @@
+# chatbus.py
+
+import os
+import sys
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+
+# --------------------------
+# State Backends
+# --------------------------
+#
+# chatserve.py reaches its shared state only through a backend:
+#   call(name, *args)   run the state operation called name and return its result
+#   watch(username)     start waking this process's waiters for username
+#   unwatch(username)   stop again
+#
+# LocalBackend keeps the state in this process. BrokerBackend forwards every
+# call to a broker process that owns the state for several servers, and gets
+# wakeups back for the users it watches.
+
+class LocalBackend:
+    """Runs state operations in this process. The default backend."""
+
+    def __init__(self, operations):
+        self.operations = operations  # {name: function}
+
+    def call(self, name, *args):
+        return self.operations[name](*args)
+
+    def watch(self, username):
+        pass  # notify() already reaches every waiter in this process
+
+    def unwatch(self, username):
+        pass
+
+class BrokerBackend:
+    """Runs state operations in the broker listening at address.
+
+    wake(username) is called from a background thread whenever a message
+    for a watched user arrives, and must wake that user's local waiters.
+    """
+
+    def __init__(self, address, wake):
+        self.address = address
+        self.wake = wake
+        self.worker_id = f'{os.getpid()}-{id(self)}'
+        self.idle = []  # Connections not in use by a call
+        self.lock = Lock()
+        # Registered before any call, so the broker can route wakeups to us
+        wakeups = Client(address, family='AF_UNIX')
+        wakeups.send(('wakeups', self.worker_id))
+        wakeups.recv()
+        Thread(target=self._receive_wakeups, args=(wakeups,), daemon=True).start()
+
+    def call(self, name, *args):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = Client(self.address, family='AF_UNIX')
+            conn.send(('calls', self.worker_id))
+        conn.send((name, args))
+        kind, value = conn.recv()
+        with self.lock:
+            self.idle.append(conn)
+        if kind == 'error':
+            raise value
+        return value
+
+    def watch(self, username):
+        self.call('watch', username)
+
+    def unwatch(self, username):
+        self.call('unwatch', username)
+
+    def _receive_wakeups(self, conn):
+        try:
+            while True:
+                self.wake(conn.recv())
+        except (EOFError, OSError):
+            # Without the broker this server has no state left to serve
+            print(' * Lost the connection to the broker, exiting', file=sys.stderr)
+            os._exit(1)
+
+# --------------------------
+# Broker
+# --------------------------
+#
+# Every connection starts with a hello naming the server process it is from:
+#   ('calls', worker_id)    then (name, args) requests, each answered with
+#                           ('ok', result) or ('error', exception)
+#   ('wakeups', worker_id)  answered with 'ready'; from then on the broker
+#                           sends the username of every watched user to wake
+# Each connection is served by its own thread, so calls from different
+# servers run in parallel under the state's own locks.
+
+class RemoteWaiter:
+    """Stands in the broker's waiters for one server process's waiters of username."""
+
+    __slots__ = ('channel', 'username')
+
+    def __init__(self, channel, username):
+        self.channel = channel
+        self.username = username
+
+    def set(self):
+        self.channel.send(self.username)
+
+class WakeupChannel:
+    """The broker's end of one server process's wakeup connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = Lock()
+        self.waiters = {}  # {username: RemoteWaiter}
+
+    def send(self, username):
+        with self.lock:
+            try:
+                self.conn.send(username)
+            except OSError:
+                pass  # Server gone; its waiters are removed when the channel closes
+
+class Broker:
+    """Serves state operations to server processes over a Unix socket.
+
+    add_waiter and remove_waiter register and drop anything with a set()
+    method, to be called when a message for that user arrives.
+    """
+
+    def __init__(self, address, operations, add_waiter, remove_waiter):
+        if os.path.exists(address):
+            os.remove(address)  # Left behind by a broker that did not shut down cleanly
+        self.listener = Listener(address, family='AF_UNIX')
+        self.operations = operations
+        self.add_waiter = add_waiter
+        self.remove_waiter = remove_waiter
+        self.channels = {}  # {worker_id: WakeupChannel}
+        self.lock = Lock()
+
+    def serve_forever(self):
+        while True:
+            conn = self.listener.accept()
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            kind, worker_id = conn.recv()
+            if kind == 'wakeups':
+                self._serve_wakeups(conn, worker_id)
+            else:
+                self._serve_calls(conn, worker_id)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _serve_calls(self, conn, worker_id):
+        while True:
+            name, args = conn.recv()
+            try:
+                if name == 'watch':
+                    result = self._watch(worker_id, *args)
+                elif name == 'unwatch':
+                    result = self._unwatch(worker_id, *args)
+                else:
+                    result = self.operations[name](*args)
+            except Exception as e:
+                conn.send(('error', e))
+            else:
+                conn.send(('ok', result))
+
+    def _serve_wakeups(self, conn, worker_id):
+        channel = WakeupChannel(conn)
+        with self.lock:
+            self.channels[worker_id] = channel
+        conn.send('ready')
+        try:
+            # Nothing is ever sent this way; recv() returns EOF when the server exits
+            while True:
+                conn.recv()
+        finally:
+            with self.lock:
+                del self.channels[worker_id]
+                waiters, channel.waiters = channel.waiters, {}
+            for username, waiter in waiters.items():
+                self.remove_waiter(username, waiter)
+
+    def _watch(self, worker_id, username):
+        with self.lock:
+            channel = self.channels[worker_id]
+            waiter = channel.waiters.get(username)
+            if waiter is None:
+                waiter = channel.waiters[username] = RemoteWaiter(channel, username)
+        self.add_waiter(username, waiter)
+
+    def _unwatch(self, worker_id, username):
+        with self.lock:
+            channel = self.channels.get(worker_id)
+            waiter = channel.waiters.pop(username, None) if channel is not None else None
+        if waiter is not None:
+            self.remove_waiter(username, waiter)
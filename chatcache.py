@@ -0,0 +1,119 @@
+# chatcache.py
+
+import os
+import re
+import sqlite3
+from threading import Lock
+from urllib.parse import urlsplit
+
+# --------------------------
+# Message Cache
+# --------------------------
+#
+# The client's copy of the messages it has received, one SQLite file per
+# server and username. Rows are keyed by the chat they are shown in and the
+# server's message id; the cursor is the id up to which the client holds
+# every message, so a restart resumes from there instead of refetching.
+#
+# The server drops a user's mailbox on logout, and a new registration
+# starts a new one, so the cache only stays valid for one server session.
+# It keeps that session's token too, for a restarted client to resume it.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat TEXT NOT NULL,        -- Chat shown in: room_id, or the other user of a DM
+    id INTEGER NOT NULL,       -- Server message id
+    mailbox TEXT NOT NULL,     -- Server chat read from: room_id, or our own username
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (chat, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_mailbox ON messages (mailbox, id);
+CREATE TABLE IF NOT EXISTS chats (chat TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+"""
+
+def cache_path(directory, server_url, username):
+    """Path of the cache file for username on server_url, inside directory."""
+    server = urlsplit(server_url).netloc or server_url
+    name = re.sub(r'[^\w.-]', '_', f'{server}-{username}')
+    return os.path.join(directory, f'{name}.sqlite3')
+
+class MessageCache:
+    """SQLite store of received messages and the cursor after them.
+
+    Safe to share between threads; each call runs in its own transaction.
+    """
+
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # A lost tail after a crash is refetched from the cursor; no fsync per message
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def clear(self):
+        """Forget every message, chat and the cursor, for a new session."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM messages')
+            self.db.execute('DELETE FROM chats')
+            self.db.execute('DELETE FROM meta')
+
+    def cursor(self):
+        """The id up to which every message is held, or 0."""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone()
+        return row[0] if row else 0
+
+    def session_token(self):
+        """The token of the server session this cache belongs to, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'token'").fetchone()
+        return row[0] if row else None
+
+    def set_session_token(self, token):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('token', ?)", (token,))
+
+    def add(self, rows, cursor=None):
+        """Store (chat, id, mailbox, sender, message) rows, then advance the cursor to cursor if given."""
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)', rows)
+            if cursor is not None:
+                self.db.execute("INSERT INTO meta VALUES ('cursor', ?) "
+                                "ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)", (cursor,))
+
+    def add_chat(self, chat):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO chats VALUES (?)', (chat,))
+
+    def chats(self):
+        with self.lock:
+            return [chat for chat, in self.db.execute('SELECT chat FROM chats')]
+
+    def page(self, chat, before=None, limit=100):
+        """Up to limit (id, sender, message) of chat below id before, oldest first."""
+        with self.lock:
+            rows = self.db.execute('SELECT id, sender, message FROM messages WHERE chat = ? AND id < ? '
+                                   'ORDER BY id DESC LIMIT ?',
+                                   (chat, before if before is not None else 2 ** 63 - 1, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    def page_after(self, chat, after, limit=100):
+        """Up to limit (id, sender, message) of chat above id after, oldest first."""
+        with self.lock:
+            return self.db.execute('SELECT id, sender, message FROM messages WHERE chat = ? AND id > ? '
+                                   'ORDER BY id LIMIT ?', (chat, after, limit)).fetchall()
+
+    def oldest(self, mailbox):
+        """Id of the oldest message held from the server's mailbox, or None."""
+        with self.lock:
+            return self.db.execute('SELECT min(id) FROM messages WHERE mailbox = ?', (mailbox,)).fetchone()[0]
@@ -0,0 +1,353 @@
+# chatclient.py
+
+import json
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --------------------------
+# Configuration
+# --------------------------
+
+SERVER_URL = "http://localhost:5003"
+CONNECT_TIMEOUT = 5  # Seconds to establish a connection to the server
+REQUEST_TIMEOUT = 10  # Seconds to wait for a response (on top of any long-poll wait)
+STREAM_READ_TIMEOUT = 60  # Seconds of /stream silence (keep-alives included) before giving up
+RETRIES = 3  # Attempts after a refused connection or a 502/503/504
+RETRY_BACKOFF = 0.2  # Base of the exponential backoff between retries, in seconds
+POOL_SIZE = 4  # Kept-alive connections per client
+POLL_BACKOFF = 2  # Factor a polling interval grows by after each poll that found nothing new
+POLL_JITTER = 0.2  # Polling intervals vary by up to this fraction either way
+
+# --------------------------
+# Transport
+# --------------------------
+
+class JitteredRetry(Retry):
+    """Retry with full jitter, so clients that lost the server together do not return together."""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+def make_session(pool_size=POOL_SIZE):
+    # Only connection errors are retried for POST; a lost response could mean a duplicate send
+    retry = JitteredRetry(total=RETRIES, backoff_factor=RETRY_BACKOFF, status_forcelist=(502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+def error_message(response):
+    try:
+        return response.json().get('message')
+    except ValueError:
+        return f"HTTP {response.status_code}"
+
+def retry_after(response):
+    """Seconds the server asked to wait before trying again, or None."""
+    try:
+        return max(0.0, float(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        return None  # Absent, or an HTTP date, which this server never sends
+
+class ChatError(Exception):
+    """A request that failed to reach the server or that the server refused.
+
+    status is the HTTP status code, or None if there was no response.
+    retry_after is set when the server refused for now (429) and said how
+    many seconds to wait.
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+# --------------------------
+# Client
+# --------------------------
+
+class ChatClient:
+    """The chat protocol without a GUI: one user talking to one server.
+
+    Methods raise ChatError on failure. A client keeps its own keep-alive
+    connection pool, its session token, the id of the last message it
+    received and the ETags of conditional GETs, and may be shared between
+    threads.
+    """
+
+    def __init__(self, server_url=SERVER_URL, username=None, pool_size=POOL_SIZE):
+        self.server_url = server_url
+        self.username = username
+        self.session = make_session(pool_size)
+        self.token = None  # Session token from register(), sent with every request
+        self.last_id = 0  # Cursor for fetch() and stream()
+        self.etags = {}  # {path: ETag of the last 200 response}, sent back as If-None-Match
+
+    def close(self):
+        self.session.close()
+
+    # Requests
+
+    def request(self, method, path, timeout=REQUEST_TIMEOUT, **kwargs):
+        """Send a request and return the response, whatever its status."""
+        try:
+            return self.session.request(method, f"{self.server_url}{path}",
+                                        timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+        except requests.RequestException as e:
+            raise ChatError(str(e)) from e
+
+    def call(self, method, path, **kwargs):
+        """Make a request and return its JSON body.
+
+        A GET of a path that sent an ETag before is made conditional and
+        returns None when the server answers 304.
+        """
+        if method == 'GET' and path in self.etags:
+            kwargs['headers'] = {'If-None-Match': self.etags[path]}
+        response = self.request(method, path, **kwargs)
+        if response.status_code == 200:
+            if 'ETag' in response.headers:
+                self.etags[path] = response.headers['ETag']
+            return response.json()
+        if response.status_code == 304:
+            return None
+        raise ChatError(error_message(response), response.status_code, retry_after(response))
+
+    # Users
+
+    def set_token(self, token):
+        self.token = token
+        if token is None:
+            self.session.headers.pop('Authorization', None)
+        else:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def register(self, username=None):
+        if username is not None:
+            self.username = username
+        data = self.call('POST', "/register", json={'username': self.username})
+        self.set_token(data.get('token'))
+        return data.get('message')
+
+    def resume(self, username, token):
+        """Act as username again with the token an earlier register() got, if it has not expired."""
+        self.username = username
+        self.set_token(token)
+        self.heartbeat()
+
+    def heartbeat(self):
+        """Keep the session from expiring; any other request does as well."""
+        self.call('POST', "/heartbeat", json={'username': self.username})
+
+    def logout(self):
+        message = self.call('POST', "/logout", json={'username': self.username}).get('message')
+        self.set_token(None)
+        return message
+
+    def presence(self, since=None):
+        """Return the /presence answer: changes since a version, or the full list."""
+        params = {'since': since} if since is not None else {}
+        return self.call('GET', "/presence", params=params)
+
+    def online_users(self):
+        """Return the list of online users, or None if unchanged since the last call."""
+        data = self.call('GET', "/online")
+        return data.get('online_users', []) if data else None
+
+    def announcement(self):
+        """Return the announcement, or None if unchanged since the last call."""
+        data = self.call('GET', "/announcement")
+        return data.get('announcement', '') if data else None
+
+    # Messages
+
+    def send(self, recipient, message):
+        self.call('POST', "/send", json={'sender': self.username, 'recipient': recipient, 'message': message})
+
+    def send_batch(self, items):
+        """Send many (recipient, message) pairs in one request; returns their ids in order."""
+        payload = {
+            'sender': self.username,
+            'messages': [{'recipient': recipient, 'message': message} for recipient, message in items]
+        }
+        return self.call('POST', "/send_batch", json=payload).get('ids')
+
+    def fetch(self, wait=0):
+        """Return the messages after last_id and advance it.
+
+        The server may hold the request up to wait seconds for one to arrive.
+        """
+        params = {'username': self.username, 'last_id': self.last_id}
+        if wait:
+            params['wait'] = wait
+        new_msgs = self.call('GET', "/messages", params=params, timeout=wait + REQUEST_TIMEOUT).get('messages', [])
+        if new_msgs:
+            self.last_id = max(self.last_id, max(msg['id'] for msg in new_msgs))
+        return new_msgs
+
+    def fetch_batch(self, cursors):
+        """Fetch new messages for several chats in one request.
+
+        cursors maps a room_id (or our own username, for DMs) to the last id
+        seen there; returns {chat: [message, ...]}.
+        """
+        payload = {'username': self.username, 'cursors': cursors}
+        return self.call('POST', "/fetch_batch", json=payload).get('messages', {})
+
+    def history(self, chat=None, before=None, limit=None):
+        """Return (a page of older messages oldest first, cursor or None).
+
+        chat is a room_id or our own username (for DMs); None pages through
+        every chat we read. Pass the cursor back as before for the page
+        before this one; None means there is nothing older.
+        """
+        params = {'username': self.username}
+        if chat is not None:
+            params['chat'] = chat
+        if before is not None:
+            params['before'] = before
+        if limit is not None:
+            params['limit'] = limit
+        data = self.call('GET', "/history", params=params)
+        return data.get('messages', []), data.get('next_before')
+
+    def search(self, query, before=None, limit=None):
+        """Search the chats we can read; returns (messages newest first, cursor or None).
+
+        Pass the cursor back as before for the next page.
+        """
+        params = {'username': self.username, 'q': query}
+        if before is not None:
+            params['before'] = before
+        if limit is not None:
+            params['limit'] = limit
+        data = self.call('GET', "/search", params=params)
+        return data.get('messages', []), data.get('next_before')
+
+    def stream(self, read_timeout=STREAM_READ_TIMEOUT):
+        """Yield messages pushed over /stream, advancing last_id, until it closes.
+
+        The stream resumes from last_id, so calling this again picks up
+        anything sent in between. A server without /stream raises ChatError
+        with status 404.
+        """
+        params = {'username': self.username, 'last_id': self.last_id}
+        with self.request('GET', "/stream", params=params, stream=True, timeout=read_timeout) as response:
+            if response.status_code != 200:
+                raise ChatError(error_message(response), response.status_code)
+            data = []
+            try:
+                # chunk_size=None hands over each event as soon as it arrives
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if line.startswith('data:'):
+                        data.append(line[5:].lstrip())
+                    elif not line and data:
+                        msg = json.loads('\n'.join(data))
+                        data = []
+                        self.last_id = max(self.last_id, msg['id'])
+                        yield msg
+            except requests.RequestException as e:
+                raise ChatError(str(e)) from e
+
+    def ack(self):
+        """Confirm receipt of everything up to last_id."""
+        self.call('POST', "/ack", json={'username': self.username, 'last_id': self.last_id})
+
+    # Rooms
+
+    def create_room(self, participants):
+        """Create a room with us as admin and return its room_id."""
+        payload = {'admin': self.username, 'participants': list(participants)}
+        return self.call('POST', "/create_room", json=payload).get('room_id')
+
+    def leave_room(self, room_id):
+        return self.call('POST', "/leave_room", json={'username': self.username, 'room_id': room_id}).get('message')
+
+# --------------------------
+# Polling
+# --------------------------
+#
+# Whatever a client cannot be pushed is polled on its own adaptive interval:
+# fast right after something changed, backing off exponentially while
+# nothing does. Every wait is jittered, so clients that started (or lost the
+# server) together spread out instead of polling in lockstep.
+
+class AdaptiveInterval:
+    """The wait before the next poll of one resource, between fastest and slowest seconds."""
+
+    def __init__(self, fastest, slowest, jitter=POLL_JITTER):
+        self.fastest = fastest
+        self.slowest = slowest
+        self.jitter = jitter
+        self.current = fastest
+
+    def reset(self):
+        self.current = self.fastest
+
+    def wait(self):
+        """The current interval, jittered."""
+        return self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def update(self, active):
+        """Record whether the last poll found anything new; return the wait before the next.
+
+        The wait is the fastest one after activity, and grows for every poll
+        after that which comes back empty.
+        """
+        if active:
+            self.reset()
+        wait = self.wait()
+        self.current = min(self.slowest, self.current * POLL_BACKOFF)
+        return wait
+
+class PollScheduler:
+    """Runs pollers from one thread, each on its own AdaptiveInterval.
+
+    A poller is a callable returning true when it found something new.
+    poke() brings every poller back to its fastest interval, for when the
+    user or the conversation has just been active. Times are
+    time.monotonic() seconds.
+    """
+
+    def __init__(self):
+        self.pollers = []  # [due, poll, interval]
+        self.poked = threading.Event()
+
+    def add(self, poll, interval, now=None):
+        if now is None:
+            now = time.monotonic()
+        # First run somewhere in the first interval, not at the same instant as every other client
+        self.pollers.append([now + random.uniform(0, interval.fastest), poll, interval])
+
+    def next_due(self):
+        return min(poller[0] for poller in self.pollers)
+
+    def run_due(self, now):
+        """Run the pollers due by now and schedule their next runs."""
+        for poller in self.pollers:
+            due, poll, interval = poller
+            if due <= now:
+                poller[0] = now + interval.update(bool(poll()))
+
+    def hurry(self, now):
+        """Reset every interval to its fastest, and bring forward runs due later than that."""
+        for poller in self.pollers:
+            poller[2].reset()
+            poller[0] = min(poller[0], now + poller[2].wait())
+
+    def poke(self):
+        """hurry() from any thread."""
+        self.poked.set()
+
+    def run_forever(self):
+        while True:
+            if self.poked.wait(max(0, self.next_due() - time.monotonic())):
+                self.poked.clear()
+                self.hurry(time.monotonic())
+            self.run_due(time.monotonic())
@@ -0,0 +1,56 @@
+# chatlimit.py
+
+# --------------------------
+# Rate Limiting
+# --------------------------
+#
+# Token buckets, one per key (a user, a room): each holds up to burst tokens
+# and refills at rate tokens per second, and an action costing n tokens is
+# allowed once n are there. Checking and spending are separate, so a request
+# drawing on several buckets takes from all of them or from none.
+#
+# Buckets are [tokens, stamp] lists made on first use and dropped by prune()
+# once they have refilled, so only recently active keys take any memory.
+
+class RateLimiter:
+    """Token buckets sharing one rate and burst. A rate of 0 turns it off.
+
+    Not thread-safe: callers serialize access with a lock of their own.
+    Times are time.monotonic() values passed in by the caller.
+    """
+
+    __slots__ = ('rate', 'burst', 'buckets')
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # Tokens per second
+        self.burst = burst
+        self.buckets = {}  # {key: [tokens, time of the last refill]}
+
+    def delay(self, key, count, now):
+        """Refill key's bucket; return 0 if count tokens are there, else seconds until they will be.
+
+        A count above burst only needs a full bucket, and leaves it in debt.
+        """
+        if not self.rate:
+            return 0
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        missing = min(count, self.burst) - bucket[0]
+        return missing / self.rate if missing > 0 else 0
+
+    def spend(self, key, count):
+        """Take count tokens from key's bucket, after delay() allowed them."""
+        if self.rate:
+            self.buckets[key][0] -= count
+
+    def prune(self, now):
+        """Forget the buckets that are full again. Returns how many went."""
+        full = [key for key, (tokens, stamp) in self.buckets.items()
+                if tokens + (now - stamp) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+        return len(full)
@@ -0,0 +1,186 @@
+# chatlog.py
+
+import json
+import os
+from threading import Condition, Lock, Thread
+
+# --------------------------
+# Write-Ahead Log
+# --------------------------
+#
+# Layout of the data directory:
+#   wal-00000001.log       JSON record per line, append-only
+#   snapshot-00000003.json full state; covers every segment numbered below 3
+#
+# With group commit, append() only queues the encoded record. One writer
+# thread drains the queue, writes the whole batch and fsyncs once, so many
+# concurrent senders share the cost of a single disk flush.
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # Roll over to a new segment past this size
+
+class WriteAheadLog:
+    """Segmented append-only record log with snapshots.
+
+    Call load() once to read back the latest snapshot and the records after
+    it, then start() before appending.
+    """
+
+    def __init__(self, directory, group_commit=True, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.group_commit = group_commit
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)  # Writer waits here for records
+        self.flushed = Condition(self.lock)  # sync() waits here for the writer
+        self.pending = []  # Encoded lines, or an int: switch to that segment
+        self.appended = 0  # Records handed to append()
+        self.durable = 0  # Records written and fsynced
+        self.segment = max(self._numbers('wal-', '.log'), default=0)
+        self.segment_size = 0
+        self.file = None
+        self.writer = None
+
+    # Files
+
+    def _path(self, prefix, number, suffix):
+        return os.path.join(self.directory, f'{prefix}{number:08d}{suffix}')
+
+    def _numbers(self, prefix, suffix):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                try:
+                    numbers.append(int(name[len(prefix):-len(suffix)]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    def _open_segment(self, number):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.file = open(self._path('wal-', number, '.log'), 'ab')
+
+    # Recovery
+
+    def load(self):
+        """Return (snapshot state or None, iterator over the records after it)."""
+        state, first_segment = None, 0
+        for number in reversed(self._numbers('snapshot-', '.json')):
+            try:
+                with open(self._path('snapshot-', number, '.json'), 'rb') as f:
+                    state = json.load(f)
+                first_segment = number
+                break
+            except (OSError, ValueError):
+                continue  # Unreadable snapshot: fall back to an older one
+        segments = [n for n in self._numbers('wal-', '.log') if n >= first_segment]
+        return state, self._records(segments)
+
+    def _records(self, segments):
+        for number in segments:
+            with open(self._path('wal-', number, '.log'), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Torn write at the tail of a crashed segment
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        break
+
+    # Writing
+
+    def start(self):
+        """Open a fresh segment for appending and start the writer thread."""
+        # Never append to an old segment: its tail may be a torn write
+        self.segment += 1
+        self._open_segment(self.segment)
+        if self.group_commit:
+            self.writer = Thread(target=self._write_batches, daemon=True)
+            self.writer.start()
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        with self.lock:
+            self.segment_size += len(line)
+            if self.segment_size > self.segment_bytes:
+                self._rotate_locked()
+                self.segment_size = len(line)
+            self.appended += 1
+            if self.group_commit:
+                self.pending.append(line)
+                self.wakeup.notify()
+            else:
+                # Baseline durability: one write and one fsync per record
+                self.file.write(line)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.durable = self.appended
+
+    def sync(self):
+        """Block until every record appended so far is on disk."""
+        with self.lock:
+            target = self.appended
+            while self.durable < target:
+                self.flushed.wait()
+
+    def rotate(self):
+        """Send later records to a new segment and return its number."""
+        with self.lock:
+            self._rotate_locked()
+            self.segment_size = 0
+            return self.segment
+
+    def _rotate_locked(self):
+        self.segment += 1
+        if self.group_commit:
+            self.pending.append(self.segment)
+            self.wakeup.notify()
+        else:
+            self._open_segment(self.segment)
+
+    def _write_batches(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.wakeup.wait()
+                batch, self.pending = self.pending, []
+                target = self.appended
+            lines = []
+            for item in batch:
+                if isinstance(item, int):
+                    self.file.write(b''.join(lines))
+                    lines = []
+                    self._open_segment(item)
+                else:
+                    lines.append(item)
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.lock:
+                self.durable = target
+                self.flushed.notify_all()
+
+    # Snapshots
+
+    def write_snapshot(self, segment, state):
+        """Persist state as covering every segment below segment, then prune them."""
+        path = self._path('snapshot-', segment, '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for number in self._numbers('snapshot-', '.json'):
+            if number < segment:
+                os.remove(self._path('snapshot-', number, '.json'))
+        for number in self._numbers('wal-', '.log'):
+            if number < segment:
+                os.remove(self._path('wal-', number, '.log'))
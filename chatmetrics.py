@@ -0,0 +1,203 @@
+# chatmetrics.py
+
+import os
+import sys
+from bisect import bisect_left
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+# --------------------------
+# Histograms
+# --------------------------
+#
+# Rendered in the Prometheus text exposition format (version 0.0.4). Buckets
+# are upper bounds in seconds; each observation costs a bisect and one short
+# lock, so instrumentation can stay on in production.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOCK_BUCKETS = (1e-6, 5e-6, 2.5e-5, 1e-4, 5e-4, 0.0025, 0.01, 0.05, 0.25, 1)
+
+enabled = True  # False turns every observation into a no-op
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.total = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+
+    def render(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.total
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+        lines.append(f'{name}_sum{labels} {total}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+class HistogramFamily:
+    """Histograms of one metric, one per combination of label values."""
+
+    def __init__(self, name, help, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}  # {label values: Histogram}
+        self.lock = Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, Histogram(self.buckets))
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for values, child in sorted(self.children.items()):
+            labels = ''.join(f'{name}="{escape(value)}",' for name, value in zip(self.labelnames, values))
+            lines += child.render(self.name, labels)
+        return lines
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric(name, kind, help, samples):
+    """Render a gauge or counter from [(labels dict, value)]."""
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+    for labels, value in samples:
+        if labels:
+            rendered = ','.join(f'{key}="{escape(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{{{rendered}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return lines
+
+# --------------------------
+# Locks
+# --------------------------
+
+lock_wait = HistogramFamily('chat_lock_wait_seconds', 'Time spent waiting to acquire a lock.',
+                            ('lock',), LOCK_BUCKETS)
+lock_hold = HistogramFamily('chat_lock_hold_seconds', 'Time a lock was held.', ('lock',), LOCK_BUCKETS)
+
+class TimedLock:
+    """A Lock that records how long it was waited for and held.
+
+    Every lock created with the same name shares one pair of histograms.
+    """
+    __slots__ = ('lock', 'wait', 'hold', 'acquired')
+
+    def __init__(self, name):
+        self.lock = Lock()
+        self.wait = lock_wait.labels(name)
+        self.hold = lock_hold.labels(name)
+        self.acquired = 0.0  # perf_counter() when taken, 0 if untimed
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not enabled:
+            return self.lock.acquire(blocking, timeout)
+        started = perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.acquired = perf_counter()
+        self.wait.observe(self.acquired - started)
+        return True
+
+    def release(self):
+        acquired, self.acquired = self.acquired, 0.0
+        released = perf_counter()
+        self.lock.release()
+        if acquired:
+            self.hold.observe(released - acquired)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# --------------------------
+# Sampling Profiler
+# --------------------------
+
+PROFILE_INTERVAL = 0.01  # Seconds between stack samples
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed interval while running.
+
+    Samples are counted per collapsed stack ("outer;inner;leaf"), the input
+    format of flamegraph.pl and speedscope. Threads blocked in a wait are
+    sampled too, so this is wall-clock rather than CPU time.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = Thread(target=self._run, args=(interval,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopped.set()
+            thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def collapsed(self):
+        """Return the samples as 'stack count' lines, most frequent first."""
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _run(self, interval):
+        me = get_ident()
+        while not self.stopped.wait(interval):
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                sampled.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(sampled)
+                self.samples += 1
@@ -1,7 +1,40 @@
 # server.py
 
-from flask import Flask, request, jsonify
-from threading import Lock
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import re
+import secrets
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import ExitStack
+from functools import wraps
+from heapq import merge, nlargest
+from itertools import islice
+from operator import itemgetter
+from flask import Flask, Response, request, jsonify
+import chatmetrics
+from chatbus import Broker, BrokerBackend, LocalBackend
+from chatlimit import RateLimiter
+from chatlog import WriteAheadLog
+from chatmetrics import HistogramFamily, SamplingProfiler, TimedLock, metric
+from threading import Event, Thread
+from urllib.parse import parse_qs, urlencode
+
+try:
+    import orjson  # Optional: a faster JSON encoder for message payloads and responses
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
@@ -9,46 +42,1301 @@ app = Flask(__name__)
 # Global Data Structures
 # --------------------------
 
+# Locks, always taken in this order when nested:
+#   membership_lock -> Mailbox.lock (several in key order) -> id_lock / waiters_lock / vocabulary_lock / sessions_lock
+# membership_lock only guards who exists and who is in which room; message
+# logs have one lock each, so sends to unrelated DMs and rooms run in parallel.
+
 connected_users = set()  # Set of usernames
-rooms = {}  # {room_id: set(usernames)}
+# Members are frozensets, replaced rather than changed, so a sender can fan
+# out to the members it looked up without holding membership_lock
+rooms = {}  # {room_id: frozenset(usernames)}
+user_rooms = {}  # {username: set(room_ids)}, reverse index of rooms
+acked = {}  # {username: highest message id the user confirmed receiving}
+# Bumped whenever connected_users changes; starts unique per run so ETags
+# handed out before a restart never match
+presence_version = time.time_ns()
+presence_journal = deque()  # (version, username, joined) for the latest changes
+PRESENCE_JOURNAL_SIZE = 10000  # Changes kept for /presence deltas
 room_id_counter = 1
-messages = []  # List of messages: {'id': int, 'sender': str, 'recipient': str, 'message': str}
+mailboxes = {}  # {username or room_id: Mailbox}
+membership_lock = TimedLock('membership')
 message_id = 1
-data_lock = Lock()
+id_lock = TimedLock('id')
+symbols = []  # Interned usernames, None in free slots; message senders are stored as indexes into this
+symbol_ids = {}  # {username: index in symbols}
+symbol_refs = []  # Per index in symbols: number of mailboxes holding messages from that user
+free_symbols = []  # Indexes in symbols to reuse
+symbols_lock = TimedLock('symbols')
+waiters = {}  # {username: set(Event)}, one per long poll or stream held for the user
+waiters_lock = TimedLock('waiters')
+MAX_WAIT = 30  # Upper bound in seconds on the /messages wait parameter
+STREAM_KEEPALIVE = 15  # Seconds between keep-alive comments on an idle /stream
+EMPTY_MESSAGES = b'{"status":"success","messages":[]}'  # /messages body when nothing is new
+MAX_BATCH = 1000  # Most messages accepted by one /send_batch request
+
+# Large messages: bodies are capped, payloads past STORE_COMPRESS_MIN bytes
+# are kept zlib-compressed, and responses past RESPONSE_COMPRESS_MIN bytes
+# are sent gzip- or deflate-encoded to clients that accept it.
+MAX_MESSAGE_BYTES = 256 * 1024  # UTF-8 bytes per message body
+MAX_REQUEST_BYTES = 16 * 1024 * 1024  # Larger request bodies are refused with 413 unread
+STORE_COMPRESS_MIN = 1024
+STORE_COMPRESS_LEVEL = 6  # zlib level; paid once per message
+RESPONSE_COMPRESS_MIN = 1024
+RESPONSE_COMPRESS_LEVEL = 1  # Paid again for every reader, so speed over ratio
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+# Search: every mailbox keeps an inverted index of its own messages, so a
+# query only touches the chats the user may read. Words indexed anywhere are
+# also kept sorted here, to expand prefix queries by bisection.
+TOKEN_PATTERN = re.compile(r'\w+')
+QUERY_PATTERN = re.compile(r'(\w+)(\*?)')  # A word, and * if it is a prefix
+MAX_TERM_LENGTH = 64  # Longer words are not indexed
+MIN_PREFIX_LENGTH = 2  # Shortest prefix accepted in a query ("ab*")
+MAX_PREFIX_TERMS = 1000  # Most indexed words a prefix may expand to
+SEARCH_PAGE = 50  # Results per /search page by default
+MAX_SEARCH_PAGE = 200
+HISTORY_PAGE = 100  # Messages per /history page by default
+MAX_HISTORY_PAGE = 1000
+vocabulary = []  # Sorted words indexed in at least one mailbox
+vocabulary_refs = {}  # {word: number of mailboxes indexing it}
+vocabulary_lock = TimedLock('vocabulary')
+
+# Cached bodies for the two endpoints every client polls. Unchanged polls
+# are answered 304 from the ETag alone.
+online_cache = (-1, b'')  # (presence_version, JSON body)
+ANNOUNCEMENT_FILE = 'announcement.txt'
+ANNOUNCEMENT_CHECK_INTERVAL = 1  # Seconds between announcement file checks
+announcement_cache = None  # ((mtime_ns, size), JSON body), or None if unreadable
+announcement_watched = False  # True once a watcher keeps announcement_cache fresh
+
+# Retention: messages every reader has acknowledged are compacted away, and
+# these caps (0 disables one) bound each mailbox even if a reader never acks.
+MAX_MAILBOX_MESSAGES = 10000
+MAX_MESSAGE_AGE = 7 * 24 * 3600  # Seconds
+MAX_MAILBOX_BYTES = 16 * 1024 * 1024
+COMPACT_INTERVAL = 30  # Seconds between background compaction passes
+compacted_total = 0  # Messages dropped by compaction since startup
+compaction_due = 0  # time.monotonic() of the next compaction pass
+
+# Backpressure: token buckets per sender, per room written to and per room
+# creator (a rate of 0 disables one), and a hard bound on each mailbox
+# between compaction passes. Refusals are answered 429 with Retry-After.
+SEND_RATE = 20  # Messages per second each user may send
+SEND_BURST = 50  # A bigger /send_batch needs a full bucket and leaves it in debt
+ROOM_SEND_RATE = 100  # Messages per second into one room, from all its members
+ROOM_SEND_BURST = 200
+CREATE_ROOM_RATE = 0.2  # Rooms per second each user may create
+CREATE_ROOM_BURST = 5
+MAX_MAILBOX_BACKLOG = 20000  # Messages a mailbox may hold before sends to it are refused (0 = unlimited)
+send_limiter = RateLimiter(SEND_RATE, SEND_BURST)
+room_send_limiter = RateLimiter(ROOM_SEND_RATE, ROOM_SEND_BURST)
+create_room_limiter = RateLimiter(CREATE_ROOM_RATE, CREATE_ROOM_BURST)
+
+# Sessions: /register hands out a token, and requests acting for a user
+# must carry theirs. Every request with a valid token counts as a heartbeat;
+# users silent for SESSION_TIMEOUT (with no long poll or stream open) are
+# logged out by the reaper, REAP_BATCH at a time.
+sessions = {}  # {token: username}
+session_tokens = {}  # {username: token}
+# Least recently seen first, so the reaper only looks at the front
+last_seen = OrderedDict()  # {username: time.monotonic() of their last request}
+sessions_lock = TimedLock('sessions')
+SESSION_TOKEN_BYTES = 24  # Random bytes per token, before base64
+SESSION_TIMEOUT = 120  # Seconds without a request before a session expires (0 = never)
+REAP_INTERVAL = 15  # Seconds between reaper passes
+REAP_BATCH = 200  # Users logged out per hold of membership_lock
+IDENTITY_FIELDS = ('username', 'sender', 'admin')  # Request fields naming the user a request acts for
+reaped_total = 0  # Sessions expired by the reaper since startup
+
+# Durability: with --data-dir every state change is appended to a write-ahead
+# log before the request is answered, and snapshots bound recovery time.
+wal = None  # WriteAheadLog, or None to keep state in memory only
+inline_sync = True  # Routes wait for the log themselves (the asyncio engine defers it)
+wal_replaying = False  # True while recovery re-applies logged records
+SNAPSHOT_INTERVAL = 300  # Seconds between snapshots
+
+# Instrumentation served by /metrics and /profile. Locks are TimedLocks, and
+# all mailbox locks share one pair of wait/hold histograms.
+request_latency = HistogramFamily('chat_request_duration_seconds',
+                                  'Time to answer a request, long-poll waits included.', ('method', 'route'))
+METRICS_TOP_MAILBOXES = 20  # Mailboxes listed by name in chat_mailbox_messages
+profiler = SamplingProfiler()
+profile_enabled = False  # /profile answers only on servers started with --profile
+MIN_PROFILE_INTERVAL = chatmetrics.PROFILE_INTERVAL  # Finer sampling is refused; it would eat the server's CPU
+open_connections = 0  # Client connections held by the asyncio engine
+
+# What readers get back: the id, and the whole message already encoded as a
+# JSON object. Responses splice payloads in as they are; nothing is encoded
+# again per reader or per poll. A large payload stays Deflated until then.
+Message = namedtuple('Message', ('id', 'payload'))
+
+class Deflated(bytes):
+    """A payload kept zlib-compressed; see inflate()."""
+
+    __slots__ = ()
+
+class Mailbox:
+    """Append-only log of the messages addressed to one user or room.
+
+    Messages are appended in increasing id order, so the ids column stays
+    sorted and a poll can bisect straight to the first unseen message.
+    Storage is columnar: every message shares the mailbox key as recipient,
+    senders are interned to small ints, and each message is held once as
+    the JSON bytes every reader is sent, compressed if it is large.
+    """
+
+    __slots__ = ('key', 'ids', 'senders', 'payloads', 'stamps', 'sizes', 'nbytes', 'index', 'held', 'closed', 'lock')
+
+    def __init__(self, key):
+        self.key = key  # Recipient of every message here: a username or room_id
+        self.ids = array('q')
+        self.senders = array('L')  # Indexes into symbols
+        self.payloads = []  # {"id", "sender", "recipient", "message"} as JSON bytes, or Deflated
+        self.stamps = array('d')  # time.monotonic() at append, for the age cap
+        self.sizes = array('L')  # Stored payload sizes, for the bytes cap
+        self.nbytes = 0
+        self.index = {}  # {word: array of the ids of messages containing it, ascending}
+        self.held = {}  # {index in symbols: number of messages here from that sender}
+        self.closed = False  # Set under lock once discarded; nothing may be appended after
+        self.lock = TimedLock('mailbox')
+
+    def append(self, msg_id, sender, body):
+        payload = encode_json({'id': msg_id, 'sender': sender, 'recipient': self.key, 'message': body})
+        # orjson (3.8) returns its whole ~1 KiB write buffer; keep a copy of just the bytes
+        payload = bytes(memoryview(payload))
+        if len(payload) >= STORE_COMPRESS_MIN:
+            packed = zlib.compress(payload, STORE_COMPRESS_LEVEL)
+            if len(packed) < len(payload):
+                payload = Deflated(packed)
+        size = len(payload)
+        self.ids.append(msg_id)
+        symbol = symbol_ids.get(sender)
+        # A symbol this mailbox holds cannot be freed and reused under us
+        if symbol is None or symbol not in self.held:
+            symbol = hold_name(sender)
+            self.held[symbol] = 0
+        self.held[symbol] += 1
+        self.senders.append(symbol)
+        self.payloads.append(payload)
+        self.stamps.append(time.monotonic())
+        self.sizes.append(size)
+        self.nbytes += size
+        new_words = []
+        for word in tokenize(body):
+            postings = self.index.get(word)
+            if postings is None:
+                postings = self.index[word] = array('q')
+                new_words.append(word)
+            postings.append(msg_id)
+        if new_words:
+            add_words(new_words)
+
+    def since(self, last_id):
+        start = bisect_right(self.ids, last_id)
+        return list(map(Message, self.ids[start:], self.payloads[start:]))
+
+    def trim(self, count):
+        """Drop the oldest count messages and return how many went."""
+        count = min(count, len(self.ids))
+        if count <= 0:
+            return 0
+        # Postings are sorted like ids, so each word loses a prefix of its list
+        last_id = self.ids[count - 1]
+        gone = []
+        for word in set().union(*(tokenize(message_text(payload)) for payload in self.payloads[:count])):
+            postings = self.index.get(word)
+            if postings is None:
+                continue
+            del postings[:bisect_right(postings, last_id)]
+            if not postings:
+                del self.index[word]
+                gone.append(word)
+        if gone:
+            drop_words(gone)
+        released = []
+        for symbol, messages in Counter(self.senders[:count]).items():
+            self.held[symbol] -= messages
+            if not self.held[symbol]:
+                del self.held[symbol]
+                released.append(symbol)
+        if released:
+            release_names(released)
+        self.nbytes -= sum(self.sizes[:count])
+        del self.ids[:count], self.senders[:count], self.payloads[:count]
+        del self.stamps[:count], self.sizes[:count]
+        return count
+
+    def matches(self, terms, before):
+        """Yield (id, self) for messages below id before that match every term, newest first.
+
+        terms is a list with, per query term, the words that satisfy it: the
+        word itself, or every indexed word a prefix expands to.
+        """
+        lists = []
+        for words in terms:
+            postings = [self.index[word] for word in words if word in self.index]
+            if not postings:
+                return
+            lists.append(postings)
+        # Walk the rarest term and look the others up
+        lists.sort(key=lambda postings: sum(map(len, postings)))
+        driver, others = lists[0], lists[1:]
+        walks = [descending(postings, bisect_left(postings, before)) for postings in driver]
+        previous = None
+        for msg_id in merge(*walks, reverse=True):
+            if msg_id == previous:
+                continue  # Two words of one message matched the same prefix
+            previous = msg_id
+            if all(any(contains(postings, msg_id) for postings in alternatives) for alternatives in others):
+                yield msg_id, self
+
+    def older(self, before):
+        """Yield (id, self) for messages below id before, newest first."""
+        for msg_id in descending(self.ids, bisect_left(self.ids, before)):
+            yield msg_id, self
+
+    def message(self, msg_id):
+        return Message(msg_id, self.payloads[bisect_left(self.ids, msg_id)])
 
 # --------------------------
 # Helper Functions
 # --------------------------
 
+def encode_json(value):
+    """value as compact UTF-8 JSON bytes, through orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+def inflate(payload):
+    """A stored payload as JSON bytes."""
+    return zlib.decompress(payload) if type(payload) is Deflated else payload
+
+def message_text(payload):
+    """The message body held in a payload."""
+    return (orjson.loads if orjson is not None else json.loads)(inflate(payload))['message']
+
+def json_array(msgs):
+    """A JSON array of msgs, joined from their payloads."""
+    return b'[' + b','.join([inflate(msg.payload) for msg in msgs]) + b']'
+
+def messages_response(messages, **fields):
+    """A 200 {'status': 'success', 'messages': messages, **fields} response.
+
+    messages is already encoded JSON, such as from json_array().
+    """
+    head = encode_json({'status': 'success', **fields})
+    return Response(head[:-1] + b',"messages":' + messages + b'}', mimetype='application/json')
+
+def tokenize(text):
+    """The distinct words of text, as indexed and searched."""
+    return {word for word in TOKEN_PATTERN.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH}
+
+def add_words(words):
+    """Count one more mailbox indexing each of words."""
+    with vocabulary_lock:
+        for word in words:
+            if word in vocabulary_refs:
+                vocabulary_refs[word] += 1
+            else:
+                vocabulary_refs[word] = 1
+                vocabulary.insert(bisect_left(vocabulary, word), word)
+
+def drop_words(words):
+    """Count one mailbox fewer indexing each of words, forgetting those none index."""
+    with vocabulary_lock:
+        for word in words:
+            vocabulary_refs[word] -= 1
+            if not vocabulary_refs[word]:
+                del vocabulary_refs[word]
+                del vocabulary[bisect_left(vocabulary, word)]
+
+def expand_prefix(prefix):
+    """Indexed words starting with prefix, or None if there are more than MAX_PREFIX_TERMS."""
+    with vocabulary_lock:
+        start = bisect_left(vocabulary, prefix)
+        words = []
+        for word in vocabulary[start:start + MAX_PREFIX_TERMS + 1]:
+            if not word.startswith(prefix):
+                break
+            words.append(word)
+    return words if len(words) <= MAX_PREFIX_TERMS else None
+
+def descending(postings, end):
+    """Iterate postings[:end] backwards without copying it."""
+    for i in range(end - 1, -1, -1):
+        yield postings[i]
+
+def contains(postings, msg_id):
+    i = bisect_left(postings, msg_id)
+    return i < len(postings) and postings[i] == msg_id
+
+def hold_name(name):
+    """Count one more mailbox with messages from name; return the small int standing for it in symbols."""
+    with symbols_lock:
+        index = symbol_ids.get(name)
+        if index is None:
+            if free_symbols:
+                index = free_symbols.pop()
+                symbols[index] = name
+                symbol_refs[index] = 0
+            else:
+                index = len(symbols)
+                symbols.append(name)
+                symbol_refs.append(0)
+            symbol_ids[name] = index
+        symbol_refs[index] += 1
+        return index
+
+def release_names(indexes):
+    """Count one mailbox fewer for each of indexes, freeing the names none hold."""
+    with symbols_lock:
+        for index in indexes:
+            symbol_refs[index] -= 1
+            if not symbol_refs[index]:
+                del symbol_ids[symbols[index]]
+                symbols[index] = None
+                free_symbols.append(index)
+
+def check_open(mailbox):
+    """Raise StateError if mailbox was discarded since it was looked up. Caller must hold its lock."""
+    # Senders look mailboxes up under membership_lock but append after
+    # releasing it; a logout, reap or last leave may have come in between
+    if mailbox.closed:
+        raise StateError('Room does not exist.' if mailbox.key.startswith('room_') else 'Recipient not online.')
+
+def append_batch(mailbox, sender, texts):
+    """Append messages to an open mailbox and return their ids. Caller must hold its lock."""
+    global message_id
+    # Ids are allocated under the mailbox lock, so they enter each mailbox
+    # in order and a reader holding the lock never misses an older one.
+    with id_lock:
+        first_id = message_id
+        message_id += len(texts)
+    for msg_id, text in enumerate(texts, first_id):
+        mailbox.append(msg_id, sender, text)
+        # Logged under the mailbox lock so the log keeps each mailbox in id order
+        log_record({'op': 'msg', 'id': msg_id, 'sender': sender, 'recipient': mailbox.key, 'message': text})
+    return range(first_id, first_id + len(texts))
+
+def deliver_batch(mailbox, sender, texts, readers):
+    """Append messages to mailbox and wake readers once. Returns their ids.
+
+    Needs no membership_lock; raises StateError if the mailbox was discarded.
+    """
+    with mailbox.lock:
+        check_open(mailbox)
+        ids = append_batch(mailbox, sender, texts)
+    notify_all(readers)
+    return ids
+
+def deliver(mailbox, sender, text, readers):
+    """Append one message to mailbox and wake readers. Returns its id.
+
+    Needs no membership_lock.
+    """
+    return deliver_batch(mailbox, sender, (text,), readers)[0]
+
+def readers_of(recipient):
+    """Users who read recipient's mailbox. Caller must hold membership_lock."""
+    return rooms[recipient] if recipient in rooms else (recipient,)
+
+def check_recipient(sender, recipient):
+    """Return why sender may not write to recipient, or None. Caller must hold membership_lock."""
+    # If recipient is a room
+    if recipient.startswith('room_'):
+        if recipient not in rooms:
+            return 'Room does not exist.'
+        if sender not in rooms[recipient]:
+            return 'You are not a participant of this room.'
+    # Direct message: check if recipient is online
+    elif recipient not in connected_users:
+        return 'Recipient not online.'
+    return None
+
+def check_send_rate(sender, counts):
+    """Take tokens for sender sending counts[recipient] messages to each recipient, or raise RateLimited.
+
+    Nothing is taken unless every bucket and mailbox has room. Caller must
+    hold membership_lock and have checked the recipients.
+    """
+    now = time.monotonic()
+    total = sum(counts.values())
+    delay = send_limiter.delay(sender, total, now)
+    if delay:
+        raise RateLimited('You are sending messages too fast.', delay)
+    for recipient, count in counts.items():
+        if recipient in rooms:
+            delay = room_send_limiter.delay(recipient, count, now)
+            if delay:
+                raise RateLimited(f'Room {recipient.split("_")[1]} is receiving messages too fast.', delay)
+        if MAX_MAILBOX_BACKLOG and len(mailboxes[recipient].ids) + count > MAX_MAILBOX_BACKLOG:
+            # Only compaction makes room, once readers have caught up
+            raise RateLimited(f'The mailbox of {recipient} is full.', compaction_due - now)
+    send_limiter.spend(sender, total)
+    for recipient, count in counts.items():
+        if recipient in rooms:
+            room_send_limiter.spend(recipient, count)
+
+def post_message(sender, recipient, text):
+    """Deliver a message to an existing user or room. Caller must hold membership_lock."""
+    return deliver(mailboxes[recipient], sender, text, readers_of(recipient))
+
+def notify(username):
+    """Wake every long poll and stream held for username."""
+    with waiters_lock:
+        events = list(waiters.get(username, ()))
+    for event in events:
+        event.set()
+
+def notify_all(usernames):
+    """Wake every long poll and stream held for any of usernames."""
+    with waiters_lock:
+        # Only users with a poll open matter; walk whichever side is smaller
+        if len(usernames) > len(waiters):
+            present = [username for username in waiters if username in usernames]
+        else:
+            present = [username for username in usernames if username in waiters]
+        events = [event for username in present for event in waiters[username]]
+    for event in events:
+        event.set()
+
+def add_waiter(username, event=None):
+    """Register an Event that notify() sets.
+
+    The asyncio engine passes its own asyncio.Event; anything with a set()
+    method works.
+    """
+    if event is None:
+        event = Event()
+    with waiters_lock:
+        if username not in waiters:
+            # Watched before anything is read, so a send in between still wakes us
+            backend.watch(username)
+            waiters[username] = set()
+        waiters[username].add(event)
+    return event
+
+def remove_waiter(username, event):
+    """Unregister an Event from add_waiter()."""
+    with waiters_lock:
+        pending = waiters.get(username)
+        if pending is not None:
+            pending.discard(event)
+            if not pending:
+                del waiters[username]
+                backend.unwatch(username)
+
+def discard_mailbox(key):
+    """Drop a mailbox, and its words from the vocabulary. Caller must hold membership_lock."""
+    mailbox = mailboxes.pop(key, None)
+    if mailbox is not None:
+        with mailbox.lock:
+            mailbox.closed = True
+            words = list(mailbox.index)
+            held = list(mailbox.held)
+        if words:
+            drop_words(words)
+        if held:
+            release_names(held)
+
+def remove_from_room(username, room_id, announce=True):
+    """Drop a participant and tell whoever is left. Caller must hold membership_lock."""
+    participants = rooms[room_id] - {username}
+    memberships = user_rooms.get(username)
+    if memberships is not None:
+        memberships.discard(room_id)
+    if len(participants) == 0:
+        del rooms[room_id]
+        discard_mailbox(room_id)
+        return
+    rooms[room_id] = participants
+    if announce:
+        # One message in the room's own log reaches every member still in it
+        post_message('server', room_id, f'{username} has left room {room_id.split("_")[1]}.')
+
+def presence_changed(username, joined):
+    """Record a join or leave for /online and /presence. Caller must hold membership_lock."""
+    global presence_version
+    presence_version += 1
+    presence_journal.append((presence_version, username, joined))
+    if len(presence_journal) > PRESENCE_JOURNAL_SIZE:
+        presence_journal.popleft()
+
+def presence_since(version):
+    """Net joins and leaves after version, or None if the journal no longer reaches back.
+
+    Caller must hold membership_lock.
+    """
+    if version == presence_version:
+        return [], []
+    if not presence_journal or not presence_journal[0][0] - 1 <= version < presence_version:
+        return None
+    # Versions in the journal are consecutive, so this is an index, not a search
+    changes = {}
+    for index in range(version - presence_journal[0][0] + 1, len(presence_journal)):
+        _, username, joined = presence_journal[index]
+        changes[username] = joined
+    joined = [username for username, is_join in changes.items() if is_join]
+    left = [username for username, is_join in changes.items() if not is_join]
+    return joined, left
+
+def start_session(username, token):
+    """Let token act for username, whose idle timeout starts now.
+
+    token is None for users recovered from a log written before sessions.
+    """
+    with sessions_lock:
+        if token is not None:
+            sessions[token] = username
+            session_tokens[username] = token
+        seen(username, time.monotonic())
+
+def seen(username, now):
+    """Mark username active at now. Caller must hold sessions_lock."""
+    last_seen[username] = now
+    last_seen.move_to_end(username)
+
+def end_session(username):
+    with sessions_lock:
+        token = session_tokens.pop(username, None)
+        if token is not None:
+            del sessions[token]
+        last_seen.pop(username, None)
+
+def remove_user(username):
+    """Drop a user with their session, memberships and mailbox. Caller must hold membership_lock."""
+    if username in connected_users:
+        connected_users.remove(username)
+        presence_changed(username, False)
+    end_session(username)
+    for room_id in list(user_rooms.pop(username, ())):
+        remove_from_room(username, room_id, announce=not wal_replaying)
+    # Pending DMs must not leak to whoever registers this name next
+    discard_mailbox(username)
+    acked.pop(username, None)
+
+# --------------------------
+# Persistence
+# --------------------------
+
+def log_record(record):
+    """Append a state change to the write-ahead log, if there is one."""
+    if wal is not None:
+        wal.append(record)
+
+def sync_log():
+    """Wait until every logged change is durable, before answering a request."""
+    if wal is not None and inline_sync:
+        wal.sync()
+
+def apply_record(record):
+    """Re-apply one logged change during recovery. Replays are idempotent."""
+    global message_id, room_id_counter
+    op = record.pop('op')
+    if op == 'msg':
+        mailbox = mailboxes.get(record['recipient'])
+        if mailbox is not None and (not mailbox.ids or record['id'] > mailbox.ids[-1]):
+            mailbox.append(record['id'], record['sender'], record['message'])
+        message_id = max(message_id, record['id'] + 1)
+    elif op == 'register':
+        if record['username'] not in connected_users:
+            connected_users.add(record['username'])
+            presence_changed(record['username'], True)
+            start_session(record['username'], record.get('token'))
+        mailboxes.setdefault(record['username'], Mailbox(record['username']))
+    elif op == 'logout':
+        remove_user(record['username'])
+    elif op == 'create_room':
+        room_id = record['room_id']
+        rooms[room_id] = frozenset(record['participants'])
+        mailboxes.setdefault(room_id, Mailbox(room_id))
+        for user in record['participants']:
+            user_rooms.setdefault(user, set()).add(room_id)
+        room_id_counter = max(room_id_counter, int(room_id.split('_')[1]) + 1)
+    elif op == 'leave_room':
+        room_id = record['room_id']
+        if room_id in rooms and record['username'] in rooms[room_id]:
+            remove_from_room(record['username'], room_id, announce=False)
+
+def capture_state():
+    """Copy the whole state at one instant and cut the log there.
+
+    Holds every lock while copying, so no change can be half applied and
+    half logged; returns (first segment not covered, state).
+    """
+    with membership_lock:
+        keys = sorted(mailboxes)
+        with ExitStack() as stack:
+            for key in keys:
+                stack.enter_context(mailboxes[key].lock)
+            segment = wal.rotate()
+            with id_lock:
+                next_id = message_id
+            with sessions_lock:
+                tokens = dict(session_tokens)
+            # Payloads are decoded back to bodies once the locks are released
+            columns = {key: (mailboxes[key].ids.tolist(), mailboxes[key].senders.tolist(),
+                             list(mailboxes[key].payloads)) for key in keys}
+            state = {
+                'message_id': next_id,
+                'room_id_counter': room_id_counter,
+                'users': list(connected_users),
+                'sessions': tokens,
+                'rooms': {room_id: list(participants) for room_id, participants in rooms.items()},
+                'acked': dict(acked),
+                'symbols': list(symbols),
+            }
+    # Columns as [ids, sender symbols, bodies]
+    state['mailboxes'] = {key: [ids, senders, [message_text(payload) for payload in payloads]]
+                          for key, (ids, senders, payloads) in columns.items()}
+    return segment, state
+
+def restore_state(state):
+    global message_id, room_id_counter
+    message_id = state['message_id']
+    room_id_counter = state['room_id_counter']
+    connected_users.update(state['users'])
+    # Idle timeouts restart from now; snapshots from before sessions have no tokens
+    tokens = state.get('sessions', {})
+    for user in state['users']:
+        start_session(user, tokens.get(user))
+    for room_id, participants in state['rooms'].items():
+        rooms[room_id] = frozenset(participants)
+        for user in participants:
+            user_rooms.setdefault(user, set()).add(room_id)
+    acked.update(state['acked'])
+    names = state['symbols']
+    for key, (ids, senders, bodies) in state['mailboxes'].items():
+        mailbox = mailboxes[key] = Mailbox(key)
+        for msg_id, sender, body in zip(ids, senders, bodies):
+            mailbox.append(msg_id, names[sender], body)
+
+def take_snapshot():
+    segment, state = capture_state()
+    wal.write_snapshot(segment, state)
+
+def run_snapshotter():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        take_snapshot()
+
+def open_log(directory, group_commit=True):
+    """Recover state from directory, then log every further change there."""
+    global wal, wal_replaying
+    log = WriteAheadLog(directory, group_commit=group_commit)
+    state, records = log.load()
+    wal_replaying = True
+    try:
+        if state is not None:
+            restore_state(state)
+        for record in records:
+            apply_record(record)
+    finally:
+        wal_replaying = False
+    log.start()
+    wal = log
+
+def compact_mailbox(mailbox, floor, now):
+    """Trim messages at or below floor, then enforce the caps. Returns the count dropped."""
+    with mailbox.lock:
+        drop = bisect_right(mailbox.ids, floor)
+        if MAX_MAILBOX_MESSAGES:
+            drop = max(drop, len(mailbox.ids) - MAX_MAILBOX_MESSAGES)
+        if MAX_MESSAGE_AGE:
+            drop = max(drop, bisect_left(mailbox.stamps, now - MAX_MESSAGE_AGE))
+        if MAX_MAILBOX_BYTES:
+            remaining = mailbox.nbytes - sum(mailbox.sizes[:drop])
+            while remaining > MAX_MAILBOX_BYTES and drop < len(mailbox.sizes):
+                remaining -= mailbox.sizes[drop]
+                drop += 1
+        return mailbox.trim(drop)
+
+def compact_mailboxes():
+    """Run one compaction pass over every mailbox. Returns the count dropped."""
+    global compacted_total, compaction_due
+    now = time.monotonic()
+    with membership_lock:
+        # A room's log can only go as far as its slowest member has acked
+        plan = [(box, min((acked.get(user, 0) for user in rooms.get(key, (key,))), default=0))
+                for key, box in mailboxes.items()]
+        for limiter in (send_limiter, room_send_limiter, create_room_limiter):
+            limiter.prune(now)
+    dropped = sum(compact_mailbox(box, floor, now) for box, floor in plan)
+    compacted_total += dropped
+    compaction_due = time.monotonic() + COMPACT_INTERVAL
+    return dropped
+
+def run_compactor():
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        compact_mailboxes()
+
+def reap_sessions():
+    """Log out every user idle for SESSION_TIMEOUT. Returns how many went.
+
+    Users are taken REAP_BATCH at a time, releasing membership_lock in
+    between, so requests keep being served through a large reap. A user with
+    a long poll or stream open is waiting, not idle, and is kept.
+    """
+    global reaped_total
+    if not SESSION_TIMEOUT:
+        return 0
+    reaped = 0
+    while True:
+        with membership_lock:
+            now = time.monotonic()
+            expired = []
+            with sessions_lock:
+                for username, stamp in last_seen.items():
+                    if stamp > now - SESSION_TIMEOUT or len(expired) == REAP_BATCH:
+                        break
+                    expired.append(username)
+            with waiters_lock:
+                waiting = {username for username in expired if username in waiters}
+            with sessions_lock:
+                for username in waiting:
+                    seen(username, now)
+            gone = [username for username in expired if username not in waiting]
+            for username in gone:
+                log_record({'op': 'logout', 'username': username})
+                remove_user(username)
+        sync_log()
+        # Ends a poll or stream that opened after the check
+        notify_all(set(gone))
+        reaped += len(gone)
+        if len(expired) < REAP_BATCH:
+            break
+    reaped_total += reaped
+    return reaped
+
+def run_reaper():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        reap_sessions()
+
+def process_rss():
+    """Resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+        except ImportError:
+            return None
+        # Peak rather than current RSS; ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def refresh_announcement():
+    """Re-read the announcement file if its mtime or size changed since the last look."""
+    global announcement_cache
+    try:
+        stat = os.stat(ANNOUNCEMENT_FILE)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if announcement_cache is not None and announcement_cache[0] == stamp:
+            return
+        with open(ANNOUNCEMENT_FILE, 'r') as f:
+            announcement = f.read().strip()
+    except OSError:
+        announcement_cache = None
+        return
+    body = encode_json({'status': 'success', 'announcement': announcement})
+    announcement_cache = (stamp, body)
+
+def run_announcement_watcher():
+    global announcement_watched
+    announcement_watched = True
+    while True:
+        refresh_announcement()
+        time.sleep(ANNOUNCEMENT_CHECK_INTERVAL)
+
+def is_text(value):
+    """Whether value is a str that encodes to UTF-8.
+
+    JSON escapes can carry lone surrogates ("\\ud800") into a str, and no
+    encoder of stored payloads accepts those.
+    """
+    if not isinstance(value, str):
+        return False
+    if value.isascii():
+        return True
+    try:
+        value.encode()
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def too_large(message):
+    """Whether a message body is over MAX_MESSAGE_BYTES of UTF-8."""
+    # A character is at most 4 bytes, so most bodies need no encoding to check
+    return (isinstance(message, str) and len(message) * 4 > MAX_MESSAGE_BYTES
+            and len(message.encode()) > MAX_MESSAGE_BYTES)
+
+def session_token(authorization, token_param):
+    """A request's session token: from an Authorization: Bearer header, else the token query parameter."""
+    # EventSource cannot set headers, hence the parameter
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return token.strip()
+    return token_param or None
+
+def cached_response(body, etag):
+    """Serve a cached JSON body with its ETag, or an empty 304 if the client has it."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients may keep the body but must revalidate before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --------------------------
+# State Operations
+# --------------------------
+#
+# Everything the routes read or change in the shared state goes through
+# these functions. Calls are made through the backend: in this process by
+# default, or in a broker process whose state several servers share
+# (--broker). Arguments and results must be picklable; refusals are raised
+# as StateError and answered with a 400.
+
+class StateError(Exception):
+    """A refused operation; its message is returned to the client."""
+
+class RateLimited(Exception):
+    """An operation refused for now; the client may retry after retry_after seconds.
+
+    Not a StateError: routes let it through to a handler that answers 429.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.args[0]
+
+operations = {}  # {name: function}, what a backend may run
+
+def state_operation(func):
+    operations[func.__name__] = func
+
+    @wraps(func)
+    def call(*args):
+        return backend.call(func.__name__, *args)
+    return call
+
+backend = LocalBackend(operations)
+
+@state_operation
+def add_user(username):
+    """Register username and return the token of their new session."""
+    token = secrets.token_urlsafe(SESSION_TOKEN_BYTES)
+    with membership_lock:
+        if username in connected_users:
+            raise StateError('Username already taken.')
+        connected_users.add(username)
+        presence_changed(username, True)
+        mailboxes[username] = Mailbox(username)
+        start_session(username, token)
+        log_record({'op': 'register', 'username': username, 'token': token})
+    sync_log()
+    return token
+
+@state_operation
+def log_out(username):
+    with membership_lock:
+        if username not in connected_users:
+            raise StateError('Username not found.')
+        log_record({'op': 'logout', 'username': username})
+        # Also removes the user from all rooms they belong to
+        remove_user(username)
+    sync_log()
+    notify(username)
+
+@state_operation
+def resolve_session(token):
+    """Return the user token acts for, marking them active now, or None if it is unknown."""
+    # One dict lookup and one move in last_seen, whatever the number of sessions
+    with sessions_lock:
+        username = sessions.get(token)
+        if username is not None:
+            seen(username, time.monotonic())
+    return username
+
+@state_operation
+def is_online(username):
+    with membership_lock:
+        return username in connected_users
+
+@state_operation
+def send_message(sender, recipient, text):
+    """Deliver one message and return its id."""
+    with membership_lock:
+        if sender not in connected_users:
+            raise StateError('Sender not registered.')
+        error = check_recipient(sender, recipient)
+        if error:
+            raise StateError(error)
+        check_send_rate(sender, {recipient: 1})
+        mailbox = mailboxes[recipient]
+        readers = readers_of(recipient)
+
+    # Only the recipient's mailbox is locked for the append itself
+    msg_id = deliver(mailbox, sender, text, readers)
+    sync_log()
+    return msg_id
+
+@state_operation
+def send_messages(sender, batch):
+    """Deliver a list of {'recipient', 'message'} dicts, all or none. Returns their ids."""
+    # Positions in the batch per recipient, so each mailbox is locked once
+    by_recipient = {}
+    for index, item in enumerate(batch):
+        by_recipient.setdefault(item['recipient'], []).append(index)
+
+    # The whole batch is validated before anything is sent
+    with membership_lock:
+        if sender not in connected_users:
+            raise StateError('Sender not registered.')
+        for recipient, indexes in by_recipient.items():
+            error = check_recipient(sender, recipient)
+            if error:
+                raise StateError(f'Message {indexes[0]}: {error}')
+        check_send_rate(sender, {recipient: len(indexes) for recipient, indexes in by_recipient.items()})
+        targets = {recipient: (mailboxes[recipient], readers_of(recipient)) for recipient in by_recipient}
+
+    ids = [0] * len(batch)
+    # Every mailbox held at once (in key order), so none can be discarded
+    # between the first append and the last
+    with ExitStack() as stack:
+        for recipient in sorted(by_recipient):
+            stack.enter_context(targets[recipient][0].lock)
+        for recipient, indexes in by_recipient.items():
+            try:
+                check_open(targets[recipient][0])
+            except StateError as e:
+                raise StateError(f'Message {indexes[0]}: {e}') from None
+        for recipient, indexes in by_recipient.items():
+            texts = [batch[index]['message'] for index in indexes]
+            for index, msg_id in zip(indexes, append_batch(targets[recipient][0], sender, texts)):
+                ids[index] = msg_id
+    for _, readers in targets.values():
+        notify_all(readers)
+    sync_log()
+    return ids
+
+@state_operation
 def get_new_messages(username, last_id):
-    user_rooms = {room_id for room_id, participants in rooms.items() if username in participants}
-    new_msgs = [msg for msg in messages if msg['id'] > last_id and 
-                (msg['recipient'] == username or msg['recipient'] in user_rooms)]
-    return new_msgs
+    """Return the user's messages newer than last_id, or None if not registered."""
+    with membership_lock:
+        if username not in connected_users:
+            return None
+        keys = sorted({username, *user_rooms.get(username, ())})
+        boxes = [mailboxes[key] for key in keys if key in mailboxes]
+    # Hold all of the user's mailboxes at once (in key order, so readers cannot
+    # deadlock). Ids are allocated under these locks, so no older message can
+    # still be in flight and the newest id returned is a safe cursor.
+    with ExitStack() as stack:
+        for box in boxes:
+            stack.enter_context(box.lock)
+        batches = [box.since(last_id) for box in boxes]
+    # Each mailbox is sorted by id, so a k-way merge keeps delivery order
+    return list(merge(*batches, key=itemgetter(0)))
+
+@state_operation
+def get_chats_since(username, cursors):
+    """Return {chat: [Message]} newer than each chat's own cursor, for chats username reads."""
+    with membership_lock:
+        if username not in connected_users:
+            raise StateError('User not registered.')
+        # Only the user's own mailbox and their rooms; anything else is left out
+        readable = {username, *user_rooms.get(username, ())}
+        boxes = [(key, mailboxes[key]) for key in cursors if key in readable and key in mailboxes]
+
+    # Each chat has its own cursor, so the mailboxes can be read one at a time
+    result = {}
+    for key, box in boxes:
+        with box.lock:
+            result[key] = box.since(cursors[key])
+    return result
+
+@state_operation
+def get_history(username, chat, before, limit):
+    """Return (up to limit messages below id before in oldest-first order, cursor for the page before or None).
+
+    chat is a room the user is in, or their own username for direct
+    messages; None pages through every chat they read, like /messages.
+    before None starts from the newest message.
+    """
+    with membership_lock:
+        if username not in connected_users:
+            raise StateError('User not registered.')
+        readable = {username, *user_rooms.get(username, ())}
+        if chat is None:
+            keys = sorted(readable)
+        elif chat in readable:
+            keys = [chat]
+        else:
+            raise StateError('You cannot read this chat.')
+        boxes = [mailboxes[key] for key in keys if key in mailboxes]
+    if before is None:
+        before = float('inf')
+    # All mailboxes held at once, so no older message can still be in flight
+    with ExitStack() as stack:
+        for box in boxes:
+            stack.enter_context(box.lock)
+        older = merge(*(box.older(before) for box in boxes), key=itemgetter(0), reverse=True)
+        page = [box.message(msg_id) for msg_id, box in islice(older, limit + 1)]
+    cursor = page[limit - 1].id if len(page) > limit else None
+    page = page[:limit]
+    page.reverse()
+    return page, cursor
+
+@state_operation
+def search_messages(username, query, before, limit):
+    """Return (matches newest first, cursor for the next page or None) in the chats username reads.
+
+    Every word of query must match; a word ending in * matches any word it
+    starts. before is an exclusive message id cursor, None for the newest.
+    """
+    terms = []
+    for word, star in QUERY_PATTERN.findall(query.lower()):
+        if not star:
+            terms.append([word])
+            continue
+        if len(word) < MIN_PREFIX_LENGTH:
+            raise StateError(f'Prefixes need at least {MIN_PREFIX_LENGTH} characters.')
+        words = expand_prefix(word)
+        if words is None:
+            raise StateError(f'"{word}*" matches too many words.')
+        terms.append(words)
+    if not terms:
+        raise StateError('Query has no words to search for.')
+
+    with membership_lock:
+        if username not in connected_users:
+            raise StateError('User not registered.')
+        keys = sorted({username, *user_rooms.get(username, ())})
+        boxes = [mailboxes[key] for key in keys if key in mailboxes]
+    if before is None:
+        before = float('inf')
+    # All mailboxes held at once, in key order like get_new_messages
+    with ExitStack() as stack:
+        for box in boxes:
+            stack.enter_context(box.lock)
+        hits = merge(*(box.matches(terms, before) for box in boxes), key=itemgetter(0), reverse=True)
+        page = [box.message(msg_id) for msg_id, box in islice(hits, limit + 1)]
+    if len(page) > limit:
+        return page[:limit], page[limit - 1].id
+    return page, None
+
+@state_operation
+def acknowledge(username, last_id):
+    """Record that username holds every message up to last_id."""
+    with membership_lock:
+        if username in connected_users and last_id > acked.get(username, 0):
+            acked[username] = last_id
+
+@state_operation
+def open_room(admin, participants):
+    """Create a room of admin and participants and return its room_id."""
+    global room_id_counter
+    with membership_lock:
+        if admin not in connected_users:
+            raise StateError('Admin is not registered.')
+        for user in participants:
+            if user not in connected_users:
+                raise StateError(f'User {user} is not online.')
+        delay = create_room_limiter.delay(admin, 1, time.monotonic())
+        if delay:
+            raise RateLimited('You are creating rooms too fast.', delay)
+        create_room_limiter.spend(admin, 1)
+
+        # Include admin in the participants to ensure they're part of the room
+        full_participants = frozenset(participants) | {admin}
+
+        room_id = f'room_{room_id_counter}'
+        room_id_counter += 1
+        rooms[room_id] = full_participants
+        mailboxes[room_id] = Mailbox(room_id)
+        log_record({'op': 'create_room', 'room_id': room_id, 'participants': sorted(full_participants)})
+        for user in full_participants:
+            user_rooms.setdefault(user, set()).add(room_id)
+
+        # Announced once in the room's log, which every participant now reads
+        post_message('server', room_id, f'Room {room_id.split("_")[1]} has been created and you have been added as a participant.')
+    sync_log()
+    return room_id
+
+@state_operation
+def leave(username, room_id):
+    with membership_lock:
+        if room_id not in rooms:
+            raise StateError('Room does not exist.')
+        if username not in rooms[room_id]:
+            raise StateError('You are not a participant of this room.')
+
+        log_record({'op': 'leave_room', 'username': username, 'room_id': room_id})
+        remove_from_room(username, room_id)
+    sync_log()
+
+@state_operation
+def online_users_since(version):
+    """Return (current presence version, online users), with None for users if version is current."""
+    with membership_lock:
+        if version == presence_version:
+            return version, None
+        return presence_version, list(connected_users)
+
+@state_operation
+def presence_changes(since):
+    """The /presence answer: net changes after since, or the full list."""
+    with membership_lock:
+        version = presence_version
+        changes = presence_since(since) if since is not None else None
+        if changes is None:
+            # First call, or too far behind: start over from the full list
+            return {'version': version, 'full': True, 'online_users': list(connected_users)}
+    joined, left = changes
+    return {'version': version, 'full': False, 'joined': joined, 'left': left}
+
+@state_operation
+def state_stats(top=0):
+    """Counts for /stats and /metrics, with the top largest mailboxes as [(count, key)]."""
+    with membership_lock:
+        boxes = list(mailboxes.values())
+        users = len(connected_users)
+        room_count = len(rooms)
+    sizes = []
+    stored_bytes = 0
+    for box in boxes:
+        with box.lock:
+            sizes.append((len(box.ids), box.key))
+            stored_bytes += box.nbytes
+    with id_lock:
+        sent = message_id - 1
+    return {
+        'users': users,
+        'rooms': room_count,
+        'mailboxes': len(boxes),
+        'messages_stored': sum(count for count, _ in sizes),
+        'message_bytes': stored_bytes,
+        'messages_compacted': compacted_total,
+        'sessions_reaped': reaped_total,
+        'messages_sent': sent,
+        'largest_mailboxes': nlargest(top, sizes),
+    }
+
+def observe_request(method, route, seconds):
+    if chatmetrics.enabled:
+        request_latency.labels(method, route).observe(seconds)
 
 # --------------------------
 # Routes
 # --------------------------
 
+@app.before_request
+def start_request_timer():
+    request.environ['chat.started'] = time.perf_counter()
+
+@app.before_request
+def check_session():
+    """Refuse requests acting for a user without that user's session token."""
+    # Sessions start at /register; every other route naming a user needs their token
+    if request.endpoint == 'register':
+        return None
+    data = request.get_json(silent=True) if request.is_json else None
+    fields = data if isinstance(data, dict) else {}
+    # Every field naming a user counts, in the query and the body alike: routes
+    # read different ones, and none may name someone else
+    claimed = [value for field in IDENTITY_FIELDS
+               for value in (*request.args.getlist(field), fields.get(field)) if value not in (None, '')]
+    token = session_token(request.headers.get('Authorization'), request.args.get('token'))
+    # Any request with a valid token is a heartbeat, whether or not it names a user
+    username = resolve_session(token) if token else None
+    if not claimed:
+        return None
+    if username is None:
+        response = jsonify({'status': 'fail', 'message': 'A valid session token is required.'})
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    for value in claimed:
+        if value != username:
+            return jsonify({'status': 'fail', 'message': f'This session is not for {value}.'}), 403
+    return None
+
+@app.after_request
+def record_request_latency(response):
+    # The asyncio engine times its requests itself, across both reads of a long poll
+    if 'chat.engine_timed' not in request.environ:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_request(request.method, route, time.perf_counter() - request.environ['chat.started'])
+    return response
+
+@app.after_request
+def compress_response(response):
+    # Streams are left alone; /stream pushes each event as it comes
+    if (response.status_code != 200 or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype != 'application/json'):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < RESPONSE_COMPRESS_MIN:
+        return response
+    for encoding, wbits in (('gzip', 31), ('deflate', 15)):
+        if request.accept_encodings[encoding]:
+            compressor = zlib.compressobj(RESPONSE_COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            response.set_data(compressor.compress(body) + compressor.flush())
+            response.headers['Content-Encoding'] = encoding
+            break
+    return response
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'status': 'fail', 'message': f'Requests are limited to {MAX_REQUEST_BYTES} bytes.'}), 413
+
+@app.errorhandler(RateLimited)
+def too_many_requests(e):
+    response = jsonify({'status': 'fail', 'message': str(e)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
 @app.route('/register', methods=['POST'])
 def register():
-    global connected_users
     data = request.get_json()
     username = data.get('username')
 
     if not username:
         return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
+    if not is_text(username):
+        return jsonify({'status': 'fail', 'message': 'Username must be a valid Unicode string.'}), 400
 
-    with data_lock:
-        if username in connected_users:
-            return jsonify({'status': 'fail', 'message': 'Username already taken.'}), 400
-        connected_users.add(username)
-    
-    return jsonify({'status': 'success', 'message': f'User {username} registered successfully.'}), 200
+    try:
+        token = add_user(username)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    return jsonify({'status': 'success', 'message': f'User {username} registered successfully.', 'token': token}), 200
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    data = request.get_json()
+    username = data.get('username')
+
+    if not username:
+        return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
+
+    # check_session() has already marked the session active
+    return jsonify({'status': 'success', 'message': 'Session kept alive.'}), 200
 
 @app.route('/send', methods=['POST'])
 def send():
-    global messages, message_id
     data = request.get_json()
     sender = data.get('sender')
     recipient = data.get('recipient')  # Can be a username or room_id (as string)
@@ -56,92 +1344,216 @@ def send():
 
     if not sender or not recipient or not message:
         return jsonify({'status': 'fail', 'message': 'Sender, recipient, and message are required.'}), 400
+    if not is_text(sender) or not is_text(recipient) or not is_text(message):
+        return jsonify({'status': 'fail', 'message': 'Sender, recipient and message must be valid Unicode strings.'}), 400
+    if too_large(message):
+        return jsonify({'status': 'fail', 'message': f'Messages are limited to {MAX_MESSAGE_BYTES} bytes.'}), 413
 
-    with data_lock:
-        if sender not in connected_users:
-            return jsonify({'status': 'fail', 'message': 'Sender not registered.'}), 400
-
-        # If recipient is a room
-        if recipient.startswith('room_'):
-            if recipient not in rooms:
-                return jsonify({'status': 'fail', 'message': 'Room does not exist.'}), 400
-            if sender not in rooms[recipient]:
-                return jsonify({'status': 'fail', 'message': 'You are not a participant of this room.'}), 400
-        else:
-            # Direct message: check if recipient is online
-            if recipient not in connected_users:
-                return jsonify({'status': 'fail', 'message': 'Recipient not online.'}), 400
-
-        # Add message to the list
-        msg = {
-            'id': message_id,
-            'sender': sender,
-            'recipient': recipient,
-            'message': message
-        }
-        messages.append(msg)
-        message_id += 1
+    try:
+        send_message(sender, recipient, message)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
 
     return jsonify({'status': 'success', 'message': 'Message sent successfully.'}), 200
 
+@app.route('/send_batch', methods=['POST'])
+def send_batch():
+    data = request.get_json()
+    sender = data.get('sender')
+    batch = data.get('messages')  # List of {'recipient': str, 'message': str}
+
+    if not sender or not isinstance(batch, list) or not batch:
+        return jsonify({'status': 'fail', 'message': 'Sender and a list of messages are required.'}), 400
+    if not is_text(sender):
+        return jsonify({'status': 'fail', 'message': 'Sender must be a valid Unicode string.'}), 400
+    if len(batch) > MAX_BATCH:
+        return jsonify({'status': 'fail', 'message': f'At most {MAX_BATCH} messages per batch.'}), 400
+    for index, item in enumerate(batch):
+        if not isinstance(item, dict) or not item.get('recipient') or not item.get('message'):
+            return jsonify({'status': 'fail', 'message': f'Message {index}: recipient and message are required.'}), 400
+        if not is_text(item['recipient']) or not is_text(item['message']):
+            return jsonify({'status': 'fail',
+                            'message': f'Message {index}: recipient and message must be valid Unicode strings.'}), 400
+        if too_large(item['message']):
+            return jsonify({'status': 'fail',
+                            'message': f'Message {index}: messages are limited to {MAX_MESSAGE_BYTES} bytes.'}), 413
+
+    try:
+        ids = send_messages(sender, [{'recipient': item['recipient'], 'message': item['message']} for item in batch])
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    return jsonify({'status': 'success', 'message': f'{len(batch)} messages sent successfully.', 'ids': ids}), 200
+
 @app.route('/messages', methods=['GET'])
 def get_messages():
     username = request.args.get('username')
     last_id = request.args.get('last_id', default=0, type=int)
+    wait = min(request.args.get('wait', default=0, type=float), MAX_WAIT)
 
     if not username:
         return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
 
-    with data_lock:
-        if username not in connected_users:
-            return jsonify({'status': 'fail', 'message': 'User not registered.'}), 400
+    # Asking for messages after last_id confirms everything up to it
+    acknowledge(username, last_id)
+    # Registered before the first read so a send in between still wakes us
+    event = add_waiter(username) if wait > 0 else None
+    try:
         new_msgs = get_new_messages(username, last_id)
+        if new_msgs is None:
+            return jsonify({'status': 'fail', 'message': 'User not registered.'}), 400
+        if not new_msgs and event is not None:
+            # Nothing yet: hold the request until a message arrives or wait expires
+            event.wait(wait)
+            new_msgs = get_new_messages(username, last_id) or []
+    finally:
+        if event is not None:
+            remove_waiter(username, event)
+
+    return messages_response(json_array(new_msgs))
+
+@app.route('/fetch_batch', methods=['POST'])
+def fetch_batch():
+    data = request.get_json()
+    username = data.get('username')
+    cursors = data.get('cursors')  # {username or room_id: last_id}
+
+    if not username or not isinstance(cursors, dict):
+        return jsonify({'status': 'fail', 'message': 'Username and cursors are required.'}), 400
+    if not is_text(username):
+        return jsonify({'status': 'fail', 'message': 'Username must be a valid Unicode string.'}), 400
+    if not all(isinstance(last_id, int) for last_id in cursors.values()):
+        return jsonify({'status': 'fail', 'message': 'Cursors must map chats to message ids.'}), 400
+
+    try:
+        chats = get_chats_since(username, cursors)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+    result = b','.join([encode_json(key) + b':' + json_array(new_msgs) for key, new_msgs in chats.items()])
+
+    return messages_response(b'{' + result + b'}')
+
+@app.route('/history', methods=['GET'])
+def history():
+    username = request.args.get('username')
+    chat = request.args.get('chat')  # Room id, or the username itself for DMs; all chats if absent
+    before = request.args.get('before', type=int)
+    limit = min(request.args.get('limit', default=HISTORY_PAGE, type=int), MAX_HISTORY_PAGE)
+
+    if not username:
+        return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
+    if limit < 1:
+        return jsonify({'status': 'fail', 'message': 'Limit must be positive.'}), 400
+
+    try:
+        page, next_before = get_history(username, chat, before, limit)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    return messages_response(json_array(page), next_before=next_before)
+
+@app.route('/search', methods=['GET'])
+def search():
+    username = request.args.get('username')
+    query = request.args.get('q', '')
+    before = request.args.get('before', type=int)
+    limit = min(request.args.get('limit', default=SEARCH_PAGE, type=int), MAX_SEARCH_PAGE)
+
+    if not username or not query.strip():
+        return jsonify({'status': 'fail', 'message': 'Username and q are required.'}), 400
+    if limit < 1:
+        return jsonify({'status': 'fail', 'message': 'Limit must be positive.'}), 400
+
+    try:
+        found, next_before = search_messages(username, query, before, limit)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    return messages_response(json_array(found), next_before=next_before)
+
+@app.route('/stream', methods=['GET'])
+def stream_messages():
+    username = request.args.get('username')
+    # A reconnecting EventSource resends the last id it saw; prefer it
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_id', default=0, type=int)
 
-    return jsonify({'status': 'success', 'messages': new_msgs}), 200
+    if not username:
+        return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
+
+    if not is_online(username):
+        return jsonify({'status': 'fail', 'message': 'User not registered.'}), 400
+    # Events already pushed are only confirmed by a reconnect or /ack
+    acknowledge(username, last_id)
+    event = add_waiter(username)
+
+    def generate(last_id):
+        try:
+            while True:
+                # Clear before reading so a send after the read re-arms the wait
+                event.clear()
+                new_msgs = get_new_messages(username, last_id)
+                if new_msgs is None:
+                    return
+                for msg in new_msgs:
+                    last_id = msg.id
+                    yield b'id: %d\ndata: %s\n\n' % (last_id, inflate(msg.payload))
+                if not new_msgs and not event.wait(STREAM_KEEPALIVE):
+                    # Keeps proxies from timing out and surfaces dead clients
+                    yield b': keep-alive\n\n'
+        finally:
+            remove_waiter(username, event)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(last_id), mimetype='text/event-stream', headers=headers)
+
+@app.route('/ack', methods=['POST'])
+def ack():
+    data = request.get_json()
+    username = data.get('username')
+    last_id = data.get('last_id')
+
+    if not username or not isinstance(last_id, int):
+        return jsonify({'status': 'fail', 'message': 'Username and last_id are required.'}), 400
+    if not is_text(username):
+        return jsonify({'status': 'fail', 'message': 'Username must be a valid Unicode string.'}), 400
+
+    acknowledge(username, last_id)
+    return jsonify({'status': 'success', 'message': 'Acknowledged.'}), 200
 
 @app.route('/create_room', methods=['POST'])
 def create_room():
-    global room_id_counter, message_id
     data = request.get_json()
     admin = data.get('admin')
     participants = data.get('participants')  # List of usernames
 
     if not admin or not participants:
         return jsonify({'status': 'fail', 'message': 'Admin and participants are required.'}), 400
+    if not is_text(admin) or not isinstance(participants, list) or not all(map(is_text, participants)):
+        return jsonify({'status': 'fail', 'message': 'Admin must be a username and participants a list of them.'}), 400
 
-    with data_lock:
-        if admin not in connected_users:
-            return jsonify({'status': 'fail', 'message': 'Admin is not registered.'}), 400
-        for user in participants:
-            if user not in connected_users:
-                return jsonify({'status': 'fail', 'message': f'User {user} is not online.'}), 400
-
-        # Include admin in the participants to ensure they're part of the room
-        full_participants = set(participants)
-        full_participants.add(admin)
-
-        room_id = f'room_{room_id_counter}'
-        room_id_counter += 1
-        rooms[room_id] = full_participants
-
-        # Notify participants about room creation
-        for user in rooms[room_id]:
-            msg = {
-                'id': message_id,
-                'sender': 'server',
-                'recipient': user,
-                'message': f'Room {room_id.split("_")[1]} has been created and you have been added as a participant.'
-            }
-            messages.append(msg)
-            message_id += 1
+    try:
+        room_id = open_room(admin, participants)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
 
     return jsonify({'status': 'success', 'message': f'Room {room_id} created successfully.', 'room_id': room_id}), 200
 
 @app.route('/online', methods=['GET'])
 def online_users_route():
-    with data_lock:
-        users = list(connected_users)
-    return jsonify({'status': 'success', 'online_users': users}), 200
+    global online_cache
+    cached = online_cache
+    # Rebuilt at most once per membership change, not once per poll
+    version, users = online_users_since(cached[0])
+    if users is not None:
+        cached = online_cache = (version, encode_json({'status': 'success', 'online_users': users}))
+    return cached_response(cached[1], f'online-{version}')
+
+@app.route('/presence', methods=['GET'])
+def presence():
+    since = request.args.get('since', type=int)
+    return jsonify({'status': 'success', **presence_changes(since)}), 200
 
 @app.route('/leave_room', methods=['POST'])
 def leave_room():
@@ -151,27 +1563,13 @@ def leave_room():
 
     if not username or not room_id:
         return jsonify({'status': 'fail', 'message': 'Username and room_id are required.'}), 400
+    if not is_text(username) or not is_text(room_id):
+        return jsonify({'status': 'fail', 'message': 'Username and room_id must be valid Unicode strings.'}), 400
 
-    with data_lock:
-        if room_id not in rooms:
-            return jsonify({'status': 'fail', 'message': 'Room does not exist.'}), 400
-        if username not in rooms[room_id]:
-            return jsonify({'status': 'fail', 'message': 'You are not a participant of this room.'}), 400
-
-        rooms[room_id].remove(username)
-        if len(rooms[room_id]) == 0:
-            del rooms[room_id]
-        else:
-            # Notify remaining participants
-            for user in rooms[room_id]:
-                msg = {
-                    'id': message_id,
-                    'sender': 'server',
-                    'recipient': user,
-                    'message': f'{username} has left room {room_id.split("_")[1]}.'
-                }
-                messages.append(msg)
-                message_id += 1
+    try:
+        leave(username, room_id)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
 
     return jsonify({'status': 'success', 'message': f'You have left room {room_id}.'}), 200
 
@@ -181,42 +1579,492 @@ def logout():
     username = data.get('username')
     if not username:
         return jsonify({'status': 'fail', 'message': 'Username is required.'}), 400
-    with data_lock:
-        if username in connected_users:
-            connected_users.remove(username)
-            # Remove user from all rooms
-            for room_id, participants in list(rooms.items()):
-                if username in participants:
-                    participants.remove(username)
-                    if len(participants) == 0:
-                        del rooms[room_id]
-                    else:
-                        # Notify remaining participants
-                        msg = {
-                            'id': message_id,
-                            'sender': 'server',
-                            'recipient': user,
-                            'message': f'{username} has left room {room_id.split("_")[1]}.'
-                        }
-                        for user in participants:
-                            messages.append(msg.copy())  # Create a separate message for each user
-                            message_id += 1
-            return jsonify({'status': 'success', 'message': f'User {username} logged out successfully.'}), 200
+    if not is_text(username):
+        return jsonify({'status': 'fail', 'message': 'Username must be a valid Unicode string.'}), 400
+    try:
+        log_out(username)
+    except StateError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+    return jsonify({'status': 'success', 'message': f'User {username} logged out successfully.'}), 200
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    counts = state_stats()
+    del counts['messages_sent'], counts['largest_mailboxes']
+    return jsonify({
+        'status': 'success',
+        **counts,
+        'rss_bytes': process_rss(),
+        'cpu_seconds': time.process_time(),
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of the server's counters, gauges and histograms."""
+    counts = state_stats(METRICS_TOP_MAILBOXES)
+    with waiters_lock:
+        pollers = sum(len(events) for events in waiters.values())
+    lines = []
+    lines += metric('chat_users_online', 'gauge', 'Registered users.', [({}, counts['users'])])
+    lines += metric('chat_rooms', 'gauge', 'Rooms with at least one member.', [({}, counts['rooms'])])
+    lines += metric('chat_mailboxes', 'gauge', 'User and room mailboxes.', [({}, counts['mailboxes'])])
+    lines += metric('chat_messages_stored', 'gauge', 'Messages held in all mailboxes.',
+                    [({}, counts['messages_stored'])])
+    lines += metric('chat_mailbox_messages', 'gauge',
+                    f'Messages stored in each of the {METRICS_TOP_MAILBOXES} fullest mailboxes.',
+                    [({'mailbox': key}, count) for count, key in counts['largest_mailboxes']])
+    lines += metric('chat_active_pollers', 'gauge', 'Long polls and streams waiting for messages.',
+                    [({}, pollers)])
+    lines += metric('chat_messages_total', 'counter', 'Message ids allocated.', [({}, counts['messages_sent'])])
+    lines += metric('chat_messages_compacted_total', 'counter', 'Messages dropped by compaction.',
+                    [({}, counts['messages_compacted'])])
+    lines += metric('chat_sessions_reaped_total', 'counter', 'Idle sessions logged out by the reaper.',
+                    [({}, counts['sessions_reaped'])])
+    if wal is not None:
+        lines += metric('chat_wal_pending_records', 'gauge', 'Log records waiting for the group commit.',
+                        [({}, len(wal.pending))])
+    if not inline_sync:
+        lines += metric('chat_open_connections', 'gauge', 'Client connections held by the asyncio engine.',
+                        [({}, open_connections)])
+    lines += metric('chat_profiler_samples_total', 'counter', 'Stack samples taken by the profiler.',
+                    [({}, profiler.samples)])
+    lines += metric('process_cpu_seconds_total', 'counter', 'CPU time used by the server process.',
+                    [({}, time.process_time())])
+    rss = process_rss()
+    if rss is not None:
+        lines += metric('process_resident_memory_bytes', 'gauge', 'Resident set size.', [({}, rss)])
+    lines += request_latency.render()
+    lines += chatmetrics.lock_wait.render()
+    lines += chatmetrics.lock_hold.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=['GET', 'POST'])
+def profile():
+    """GET: collapsed stacks sampled so far. POST: start, stop or reset the profiler."""
+    if not profile_enabled:
+        return jsonify({'status': 'fail', 'message': 'The profiler is off; start the server with --profile.'}), 403
+    if request.method == 'GET':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    data = request.get_json(silent=True) or {}
+    if data.get('reset'):
+        profiler.reset()
+    if 'enabled' in data:
+        if data['enabled']:
+            try:
+                interval = float(data.get('interval', chatmetrics.PROFILE_INTERVAL))
+            except (TypeError, ValueError):
+                return jsonify({'status': 'fail', 'message': 'Interval must be a number.'}), 400
+            if not interval >= MIN_PROFILE_INTERVAL:
+                return jsonify({'status': 'fail',
+                                'message': f'Interval must be at least {MIN_PROFILE_INTERVAL} seconds.'}), 400
+            profiler.start(interval)
         else:
-            return jsonify({'status': 'fail', 'message': 'Username not found.'}), 400
+            profiler.stop()
+    return jsonify({'status': 'success', 'running': profiler.running, 'samples': profiler.samples}), 200
 
 @app.route('/announcement', methods=['GET'])
 def get_announcement():
-    try:
-        with open('announcement.txt', 'r') as f:
-            announcement = f.read().strip()
-        return jsonify({'status': 'success', 'announcement': announcement}), 200
-    except Exception as e:
+    if not announcement_watched:
+        refresh_announcement()
+    cached = announcement_cache
+    if cached is None:
         return jsonify({'status': 'fail', 'message': 'Failed to read announcement.'}), 500
+    (mtime_ns, size), body = cached
+    return cached_response(body, f'announcement-{mtime_ns}-{size}')
+
+# --------------------------
+# Asyncio Engine
+# --------------------------
+#
+# An alternative to Flask's threaded development server for large numbers of
+# idle connections. One event loop thread owns every socket and runs the
+# Flask routes in-line through WSGI, so the route contract is identical and
+# the shared state is only ever touched from that thread (its locks are
+# never contended). The two blocking routes, /messages with wait and /stream, are
+# served natively with asyncio.Event waiters instead of parking a thread.
+
+ASYNC_BACKLOG = 1024  # Pending connection queue for the asyncio listener
+known_routes = {rule.rule for rule in app.url_map.iter_rules()}  # Route label for request metrics
+
+def call_app(method, path, query, headers, body):
+    """Run one request through the Flask app and return (status, headers, body)."""
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '0',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': headers.get('content-length', str(len(body))),  # Declared, so oversized bodies get a 413
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'chat.engine_timed': True,
+    }
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started[:] = [status, response_headers]
+
+    result = app(environ, start_response)
+    try:
+        payload = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started[0], started[1], payload
+
+async def read_request(reader):
+    """Parse one HTTP/1.x request, or return None when the client hung up."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_REQUEST_BYTES:
+        return method, target, version, headers, None  # Left unread; the app answers 413 from the header
+    body = await reader.readexactly(length) if length else b''
+    return method, target, version, headers, body
+
+def write_response(writer, status, headers, body, keep_alive):
+    lines = [f'HTTP/1.1 {status}']
+    lines += [f'{name}: {value}' for name, value in headers if name.lower() not in ('content-length', 'connection')]
+    lines.append(f'Content-Length: {len(body)}')
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+def write_chunk(writer, data):
+    writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+async def long_poll(path, params, headers, body):
+    """Serve /messages?wait=N without blocking the loop."""
+    username = params.get('username', [None])[0]
+    try:
+        wait = min(float(params.pop('wait')[0]), MAX_WAIT)
+    except ValueError:
+        wait = 0
+    query = urlencode(params, doseq=True)
+    event = asyncio.Event()
+    # Register before the first read so a send in between still wakes us
+    add_waiter(username, event)
+    try:
+        status, response_headers, payload = call_app('GET', path, query, headers, body)
+        if status.startswith('200') and wait > 0 and payload == EMPTY_MESSAGES:
+            try:
+                await asyncio.wait_for(event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            status, response_headers, payload = call_app('GET', path, query, headers, body)
+    finally:
+        remove_waiter(username, event)
+    return status, response_headers, payload
+
+async def stream(writer, params, headers):
+    """Serve /stream natively; returns False if the request was rejected."""
+    username = params.get('username', [None])[0]
+    try:
+        last_id = int(headers.get('last-event-id') or params.get('last_id', ['0'])[0])
+    except ValueError:
+        last_id = 0
+    event = asyncio.Event()
+    # Flask's check_session() is bypassed here; a refusal goes through the app for its 401 or 403
+    token = session_token(headers.get('authorization'), params.get('token', [None])[0])
+    if token is None or resolve_session(token) != username or not is_online(username):
+        return False
+    # As in the Flask route: a reconnect confirms the events it already got
+    acknowledge(username, last_id)
+    add_waiter(username, event)
+    try:
+        # Chunked so clients can hand over each event as soon as it arrives
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream; charset=utf-8\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'X-Accel-Buffering: no\r\n'
+                     b'Transfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n')
+        while True:
+            event.clear()
+            new_msgs = get_new_messages(username, last_id)
+            if new_msgs is None:
+                writer.write(b'0\r\n\r\n')
+                return True
+            for msg in new_msgs:
+                last_id = msg.id
+                write_chunk(writer, b'id: %d\ndata: %s\n\n' % (last_id, inflate(msg.payload)))
+            if not new_msgs:
+                try:
+                    await asyncio.wait_for(event.wait(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    write_chunk(writer, b': keep-alive\n\n')
+            await writer.drain()
+    finally:
+        remove_waiter(username, event)
+
+async def handle_connection(reader, writer):
+    global open_connections
+    open_connections += 1
+    try:
+        while True:
+            parsed = await read_request(reader)
+            if parsed is None:
+                break
+            started = time.perf_counter()
+            method, target, version, headers, body = parsed
+            path, _, query = target.partition('?')
+            params = parse_qs(query)
+            keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+            if body is None:
+                # The unread body is still on the connection, so it cannot be kept
+                response = call_app(method, path, query, headers, b'')
+                keep_alive = False
+            elif method == 'GET' and path == '/stream':
+                if await stream(writer, params, headers):
+                    break
+                response = call_app(method, path, query, headers, body)
+            elif method == 'GET' and path == '/messages' and 'wait' in params:
+                response = await long_poll(path, params, headers, body)
+            else:
+                response = call_app(method, path, query, headers, body)
+                if wal is not None and method == 'POST':
+                    # Group commit: wait for the log off the loop, so other
+                    # requests keep running and share the same fsync
+                    await asyncio.get_running_loop().run_in_executor(None, wal.sync)
+            observe_request(method, path if path in known_routes else 'unmatched', time.perf_counter() - started)
+            write_response(writer, *response, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        open_connections -= 1
+        writer.close()
+
+async def compact_periodically():
+    # Compaction runs on the loop too, keeping the state single-threaded
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        compact_mailboxes()
+
+async def reap_periodically():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        reap_sessions()
+
+async def watch_announcement():
+    global announcement_watched
+    announcement_watched = True
+    while True:
+        refresh_announcement()
+        await asyncio.sleep(ANNOUNCEMENT_CHECK_INTERVAL)
+
+async def snapshot_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        segment, state = capture_state()
+        await loop.run_in_executor(None, wal.write_snapshot, segment, state)
+
+async def serve_asyncio(host, port):
+    global inline_sync
+    inline_sync = False
+    loop = asyncio.get_running_loop()
+    shared = isinstance(backend, BrokerBackend)
+    if shared:
+        # Wakeups arrive on the backend's thread; asyncio.Event is set on the loop
+        backend.wake = lambda username: loop.call_soon_threadsafe(notify, username)
+    # Workers of one --workers group all listen on the same port
+    server = await asyncio.start_server(handle_connection, host, port, backlog=ASYNC_BACKLOG, reuse_port=shared)
+    tasks = [asyncio.create_task(watch_announcement())]
+    if not shared:
+        # The broker compacts and reaps the shared state itself
+        tasks.append(asyncio.create_task(compact_periodically()))
+        tasks.append(asyncio.create_task(reap_periodically()))
+    if wal is not None:
+        tasks.append(asyncio.create_task(snapshot_periodically()))
+    print(f' * Asyncio engine serving on http://{host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+# --------------------------
+# Scale-out
+# --------------------------
+#
+# --workers N runs one broker process holding the state (and the log) and N
+# asyncio servers sharing one port through SO_REUSEPORT, each calling the
+# broker for every state operation. The kernel spreads connections over the
+# servers; a wakeup for a user reaches whichever servers hold their polls.
+
+BROKER_START_TIMEOUT = 10  # Seconds to wait for the broker's socket to appear
+
+def run_broker(address):
+    Thread(target=run_compactor, daemon=True).start()
+    Thread(target=run_reaper, daemon=True).start()
+    if wal is not None:
+        Thread(target=run_snapshotter, daemon=True).start()
+    broker = Broker(address, operations, add_waiter, remove_waiter)
+    print(f' * Broker serving state on {address}')
+    broker.serve_forever()
+
+def run_workers(args, state_args, server_args):
+    """Start a broker and args.workers servers, and stop them all when one exits or on a signal."""
+    script = os.path.abspath(__file__)
+    address = args.broker_socket or os.path.join(tempfile.gettempdir(), f'chatserve-{args.port}.sock')
+    if os.path.exists(address):
+        os.remove(address)
+    children = [subprocess.Popen([sys.executable, script, '--broker-listen', address, *state_args])]
+    deadline = time.monotonic() + BROKER_START_TIMEOUT
+    while not os.path.exists(address):
+        if children[0].poll() is not None or time.monotonic() > deadline:
+            children[0].terminate()
+            sys.exit('The broker did not start.')
+        time.sleep(0.05)
+    for _ in range(args.workers):
+        children.append(subprocess.Popen([sys.executable, script, '--engine', 'asyncio', '--broker', address,
+                                          *server_args]))
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        os.wait()  # Until the first child exits or a signal arrives
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
+        if os.path.exists(address):
+            os.remove(address)
 
 # --------------------------
 # Run Server
 # --------------------------
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5003, debug=True)
+    parser = argparse.ArgumentParser(description='Run the chat server.')
+    parser.add_argument('--engine', choices=('flask', 'asyncio'), default='flask',
+                        help='flask: threaded development server (default); '
+                             'asyncio: single-threaded event loop for many idle connections')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5003)
+    parser.add_argument('--max-mailbox-messages', type=int, default=MAX_MAILBOX_MESSAGES,
+                        help='messages kept per user or room mailbox (0 = unlimited)')
+    parser.add_argument('--max-message-age', type=float, default=MAX_MESSAGE_AGE,
+                        help='seconds a message is kept (0 = unlimited)')
+    parser.add_argument('--max-mailbox-bytes', type=int, default=MAX_MAILBOX_BYTES,
+                        help='message bytes kept per mailbox (0 = unlimited)')
+    parser.add_argument('--compact-interval', type=float, default=COMPACT_INTERVAL,
+                        help='seconds between compaction passes')
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='messages per second each user may send (0 = unlimited)')
+    parser.add_argument('--room-send-rate', type=float, default=ROOM_SEND_RATE,
+                        help='messages per second one room may receive (0 = unlimited)')
+    parser.add_argument('--create-room-rate', type=float, default=CREATE_ROOM_RATE,
+                        help='rooms per second each user may create (0 = unlimited)')
+    parser.add_argument('--max-message-bytes', type=int, default=MAX_MESSAGE_BYTES,
+                        help='largest message body accepted, in UTF-8 bytes')
+    parser.add_argument('--max-mailbox-backlog', type=int, default=MAX_MAILBOX_BACKLOG,
+                        help='messages a mailbox may hold before sends to it are refused (0 = unlimited)')
+    parser.add_argument('--session-timeout', type=float, default=SESSION_TIMEOUT,
+                        help='seconds without a request before a session expires (0 = never)')
+    parser.add_argument('--reap-interval', type=float, default=REAP_INTERVAL,
+                        help='seconds between passes of the idle-session reaper')
+    parser.add_argument('--data-dir',
+                        help='keep a write-ahead log and snapshots here and recover from them at startup')
+    parser.add_argument('--no-group-commit', action='store_true',
+                        help='fsync each log record on its own instead of batching concurrent writes')
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help='seconds between snapshots of the logged state')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='stop timing requests and locks (/metrics still reports counts and gauges)')
+    parser.add_argument('--profile', action='store_true',
+                        help='start the sampling profiler at startup and allow /profile (off otherwise)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run this many asyncio servers on one port, sharing state through a broker process')
+    parser.add_argument('--broker-socket',
+                        help='Unix socket path of the --workers broker (default: chatserve-PORT.sock in the temp dir)')
+    parser.add_argument('--broker-listen', metavar='PATH',
+                        help='only hold the state, serving it to --broker servers on this Unix socket')
+    parser.add_argument('--broker', metavar='PATH',
+                        help='serve HTTP from the state held by the broker on this Unix socket')
+    args = parser.parse_args()
+    if args.workers and args.engine != 'asyncio':
+        parser.error('--workers requires --engine asyncio')
+    if args.broker and args.data_dir:
+        parser.error('--data-dir belongs to the broker, not to a --broker server')
+    MAX_MAILBOX_MESSAGES = args.max_mailbox_messages
+    MAX_MESSAGE_AGE = args.max_message_age
+    MAX_MAILBOX_BYTES = args.max_mailbox_bytes
+    COMPACT_INTERVAL = args.compact_interval
+    send_limiter = RateLimiter(args.send_rate, SEND_BURST)
+    room_send_limiter = RateLimiter(args.room_send_rate, ROOM_SEND_BURST)
+    create_room_limiter = RateLimiter(args.create_room_rate, CREATE_ROOM_BURST)
+    MAX_MAILBOX_BACKLOG = args.max_mailbox_backlog
+    MAX_MESSAGE_BYTES = args.max_message_bytes
+    SESSION_TIMEOUT = args.session_timeout
+    REAP_INTERVAL = args.reap_interval
+    SNAPSHOT_INTERVAL = args.snapshot_interval
+    chatmetrics.enabled = not args.no_metrics
+    if args.profile:
+        profile_enabled = True
+        profiler.start()
+
+    if args.workers:
+        # Options for the state go to the broker, the rest to every server
+        state_args = ['--max-mailbox-messages', str(MAX_MAILBOX_MESSAGES), '--max-message-age', str(MAX_MESSAGE_AGE),
+                      '--max-mailbox-bytes', str(MAX_MAILBOX_BYTES), '--compact-interval', str(COMPACT_INTERVAL),
+                      '--send-rate', str(args.send_rate), '--room-send-rate', str(args.room_send_rate),
+                      '--create-room-rate', str(args.create_room_rate),
+                      '--max-mailbox-backlog', str(MAX_MAILBOX_BACKLOG),
+                      '--session-timeout', str(SESSION_TIMEOUT), '--reap-interval', str(REAP_INTERVAL),
+                      '--snapshot-interval', str(SNAPSHOT_INTERVAL)]
+        if args.data_dir:
+            state_args += ['--data-dir', args.data_dir]
+        if args.no_group_commit:
+            state_args.append('--no-group-commit')
+        server_args = ['--host', args.host, '--port', str(args.port), '--max-message-bytes', str(MAX_MESSAGE_BYTES)]
+        if args.no_metrics:
+            server_args.append('--no-metrics')
+        if args.profile:
+            server_args.append('--profile')
+        run_workers(args, state_args, server_args)
+        sys.exit()
+    if args.broker:
+        backend = BrokerBackend(args.broker, wake=notify)
+
+    if args.data_dir:
+        started = time.monotonic()
+        open_log(args.data_dir, group_commit=not args.no_group_commit)
+        print(f' * Recovered state from {args.data_dir} in {time.monotonic() - started:.2f}s')
+
+    if args.broker_listen:
+        run_broker(args.broker_listen)
+    elif args.engine == 'asyncio':
+        asyncio.run(serve_asyncio(args.host, args.port))
+    else:
+        if not args.broker:
+            Thread(target=run_compactor, daemon=True).start()
+            Thread(target=run_reaper, daemon=True).start()
+        Thread(target=run_announcement_watcher, daemon=True).start()
+        if wal is not None:
+            Thread(target=run_snapshotter, daemon=True).start()
+        # The reloader would run a second process against the same log or broker
+        app.run(host=args.host, port=args.port, debug=True, use_reloader=wal is None and not args.broker)
@@ -2,15 +2,36 @@
 
 import tkinter as tk
 from tkinter import simpledialog, messagebox, scrolledtext, ttk
-import requests
 import threading
 import time
+import os
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from chatcache import MessageCache, cache_path
+from chatclient import AdaptiveInterval, ChatClient, ChatError, PollScheduler
 
 # --------------------------
 # Configuration
 # --------------------------
 
 SERVER_URL = "http://localhost:5003"  # Replace with your server's IP and port
+PRESENCE_POLL = (2, 30)  # Seconds between /presence polls: right after activity, and at most once idle
+ANNOUNCEMENT_POLL = (30, 120)  # Seconds between /announcement polls, likewise
+MESSAGE_RETRY = (1, 30)  # Seconds before reconnecting a dropped /stream, or polling a server without long polls
+LONG_POLL_WAIT = 25  # Seconds the server may hold a /messages request open
+STREAM_READ_TIMEOUT = 60  # Seconds of /stream silence (keep-alives included) before reconnecting
+ACK_INTERVAL = 10  # Minimum seconds between /ack calls while streaming
+IO_WORKERS = 4  # Threads for one-off requests other than sends
+POOL_SIZE = IO_WORKERS + 5  # Kept-alive connections: workers, sender, stream, ack, status and logout
+UI_DRAIN_INTERVAL = 15  # Milliseconds between runs of queued UI updates
+UI_DRAIN_BUDGET = 0.008  # Seconds of queued UI updates run per drain, so redraws keep up
+UI_STALL_THRESHOLD = 0.016  # Tk loop stalls longer than one 60 Hz frame are reported
+TRANSCRIPT_LINES = 2000  # Most lines kept in the chat display; older ones are dropped
+TRANSCRIPT_PAGE = 500  # Messages rendered on switching chats or scrolling to either end
+SEND_RETRIES = 3  # Resends of a message the server refused for now (429), each after its Retry-After
+MAX_RETRY_AFTER = 60  # Longest Retry-After, in seconds, waited out before reporting the send as failed
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".chatroom")  # Local message cache, one file per server and user
 
 # --------------------------
 # Global Variables
@@ -19,154 +40,388 @@ SERVER_URL = "http://localhost:5003"  # Replace with your server's IP and port
 username = None
 current_chat = None  # Can be a username or room_id
 chats = set()
-messages = {}  # {chat_id: [{'sender': sender, 'message': message}, ...]}
-last_message_id = 0
+resumed = False  # True when continuing a session still open on the server
+session_lost = False  # True once the server ended our session (401) and signing in again failed
+cache = None  # MessageCache of every message received this session
+history_cursors = {}  # {server chat: id to page /history back from, None once nothing is older}
+backfilling = False  # True while a /history page is being fetched for the transcript
 app_window = None
 chat_display = None
 online_users_tree = None
 chats_tree = None
 announcement_var = None
+presence_version = None  # Version of the last /presence answer shown in online_users_tree
+online_user_items = {}  # {username: online_users_tree item id}
+transcript_oldest = None  # Id of the oldest message displayed, or None if none is
+transcript_newest = None  # Id of the newest message displayed once paging up dropped newer ones, else None
+transcript_header = None  # Notice heading the transcript, shown again when it jumps to the latest page
+transcript_rows = deque()  # Per chat_display line: the id of a stored message, or None for a notice
+
+# Tkinter may only be touched from the thread running mainloop. Network code
+# runs on other threads and hands its results over through ui_queue.
+ui_queue = queue.Queue()  # (callable, args) to run on the Tk thread
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='chat-io')
+# Sends have a thread of their own, so they reach the server in the order they were typed
+send_queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-send')
+ui_stalls = {'count': 0, 'worst': 0.0}  # Tk loop stalls over UI_STALL_THRESHOLD
+status_scheduler = PollScheduler()  # Polls presence and the announcement, each at its own pace
+session_lock = threading.Lock()  # Held while a session the server ended is renewed
+
+# --------------------------
+# Threading
+# --------------------------
+
+def run_on_ui(func, *args):
+    """Queue func(*args) to run on the Tk thread; safe to call from any thread."""
+    ui_queue.put((func, args))
+
+def run_in_background(func, *args):
+    """Run blocking network I/O on the worker pool instead of the Tk thread."""
+    io_pool.submit(func, *args)
+
+def run_in_order(func, *args):
+    """Like run_in_background, but one at a time in the order queued."""
+    send_queue.submit(func, *args)
+
+def drain_ui_queue(due):
+    # Running late means the Tk loop was blocked by something else meanwhile
+    started = time.perf_counter()
+    record_ui_stall(started - due)
+    while time.perf_counter() - started < UI_DRAIN_BUDGET:
+        try:
+            func, args = ui_queue.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Error updating UI: {e}")
+    finished = time.perf_counter()
+    record_ui_stall(finished - started)
+    app_window.after(UI_DRAIN_INTERVAL, drain_ui_queue, finished + UI_DRAIN_INTERVAL / 1000)
+
+def record_ui_stall(seconds):
+    if seconds > UI_STALL_THRESHOLD:
+        ui_stalls['count'] += 1
+        ui_stalls['worst'] = max(ui_stalls['worst'], seconds)
+        print(f"[UI] Tk loop stalled for {seconds * 1000:.1f} ms")
+
+# --------------------------
+# Transport
+# --------------------------
+
+# One keep-alive connection pool shared by every thread of the client
+client = ChatClient(SERVER_URL, pool_size=POOL_SIZE)
+
+def call_api(action, func, *args, report=print):
+    """Return func(*args), or None after passing report a line saying it failed to do action.
+
+    A call the server refuses for want of a session (401) is made again
+    once the session is renewed; after renewing fails, none is made.
+    """
+    for attempt in range(2):
+        if session_lost:
+            return None
+        token = client.token
+        try:
+            return func(*args)
+        except ChatError as e:
+            if e.status == 401 and attempt == 0 and renew_session(token):
+                continue
+            report(f"Failed to {action}: {e}")
+            return None
+
+def renew_session(failed_token):
+    """Sign in again after the server refused failed_token (401); returns whether requests may go on.
+
+    The server logs out sessions that stay quiet too long, taking their
+    mailbox and rooms, so there is nothing to resume: this registers
+    username afresh. If that fails the user is told once, and the pollers
+    stop calling the server.
+    """
+    global session_lost
+    with session_lock:
+        if session_lost:
+            return False
+        if client.token != failed_token:
+            # Another thread already renewed it
+            return True
+        try:
+            client.register(username)
+        except ChatError as e:
+            session_lost = True
+            show_error(f"The server ended this session, and signing in again failed: {e}")
+            return False
+        # A new session has a new mailbox; start the cache and cursors over
+        cache.clear()
+        cache.set_session_token(client.token)
+        client.last_id = 0
+        history_cursors.clear()
+        run_on_ui(append_chat, "--- The server ended this session; signed in again. Group chats were left. ---", True)
+        return True
+
+def show_error(text):
+    run_on_ui(messagebox.showerror, "Error", text)
 
 # --------------------------
 # Helper Functions
 # --------------------------
 
 def register_user(root):
-    global username
+    global username, resumed
     while True:
         username = simpledialog.askstring("Username", "Please enter your username:", parent=root)
         if not username:
             messagebox.showerror("Error", "Username cannot be empty.")
             continue
         try:
-            response = requests.post(f"{SERVER_URL}/register", json={'username': username})
-            if response.status_code == 200:
-                messagebox.showinfo("Success", response.json().get('message'))
-                break
-            else:
-                messagebox.showerror("Error", response.json().get('message'))
-        except Exception as e:
+            messagebox.showinfo("Success", client.register(username))
+            break
+        except ChatError as e:
+            if e.status is not None:
+                # Still signed in from an earlier run that did not log out
+                if str(e) == 'Username already taken.' and messagebox.askyesno(
+                        "Resume", f"{username} is already signed in. Resume that session here?"):
+                    if resume_session(username):
+                        resumed = True
+                        break
+                    messagebox.showerror("Error", "That session cannot be resumed from here.")
+                    continue
+                messagebox.showerror("Error", str(e))
+                continue
             messagebox.showerror("Error", f"Failed to connect to server: {e}")
             root.destroy()
             exit()
 
-def send_message_api(recipient, message):
-    payload = {
-        'sender': username,
-        'recipient': recipient,
-        'message': message
-    }
+def resume_session(name):
+    """Take over name's session with the token its cache kept; False if there is none or it expired."""
     try:
-        response = requests.post(f"{SERVER_URL}/send", json=payload)
-        if response.status_code != 200:
-            messagebox.showerror("Error", response.json().get('message'))
-    except Exception as e:
-        messagebox.showerror("Error", f"Failed to send message: {e}")
+        client.resume(name, saved_session_token(name))
+        return True
+    except ChatError:
+        return False
+
+def send_message_api(recipient, message):
+    """Send one message, waiting out a 429 and resending. Runs on the send_queue thread only.
+
+    Waiting there holds back the sends queued behind this one, which keeps
+    them in order, and never ties up io_pool's workers.
+    """
+    for attempt in range(SEND_RETRIES + 1):
+        token = client.token
+        try:
+            client.send(recipient, message)
+            return
+        except ChatError as e:
+            if e.status == 401 and not session_lost and renew_session(token):
+                continue
+            if e.retry_after is None or e.retry_after > MAX_RETRY_AFTER or attempt == SEND_RETRIES:
+                show_error(f"Failed to send message: {e}")
+                return
+            print(f"[Send] {e} Retrying in {e.retry_after:g}s")
+            time.sleep(e.retry_after)
 
 def create_room_api(participants):
-    payload = {
-        'admin': username,
-        'participants': participants
-    }
-    try:
-        response = requests.post(f"{SERVER_URL}/create_room", json=payload)
-        if response.status_code == 200:
-            data = response.json()
-            room_id = data.get('room_id')
-            if room_id:
-                chats.add(room_id)
-                update_chats_tree()
-                append_chat(f"--- Group Chat {room_id.split('_')[1]} created with: {', '.join(participants)} ---")
-                # Set as current chat
-                global current_chat
-                current_chat = room_id
-                append_chat(f"--- Switched to Group Chat {room_id.split('_')[1]} ---")
-        else:
-            messagebox.showerror("Error", response.json().get('message'))
-    except Exception as e:
-        messagebox.showerror("Error", f"Failed to create room: {e}")
-
-def fetch_messages():
-    global last_message_id
-    params = {
-        'username': username,
-        'last_id': last_message_id
-    }
+    room_id = call_api("create room", client.create_room, participants, report=show_error)
+    if room_id:
+        run_on_ui(show_room_created, room_id, participants)
+
+def show_room_created(room_id, participants):
+    global current_chat
+    add_chat(room_id)
+    append_chat(f"--- Group Chat {room_id.split('_')[1]} created with: {', '.join(participants)} ---", follow=True)
+    # Set as current chat
+    current_chat = room_id
+    show_chat(room_id, f"--- Switched to Group Chat {room_id.split('_')[1]} ---")
+
+def receive_messages(new_msgs):
+    # The client has already advanced its cursor; store up to it here and
+    # leave only the display work to Tk
+    if new_msgs:
+        store_messages(new_msgs, client.last_id)
+        run_on_ui(show_messages, new_msgs)
+        # A lively chat is when the online list is worth refreshing quickly
+        status_scheduler.poke()
+
+def store_messages(new_msgs, cursor=None):
+    rows = [(chat_of(msg), msg['id'], msg['recipient'], msg['sender'], msg['message'])
+            for msg in new_msgs if not is_room_notice(msg)]
+    cache.add(rows, cursor)
+
+def chat_of(msg):
+    """The chat msg is shown in: its room, or the other user of a DM."""
+    recipient = msg['recipient']
+    if recipient.startswith('room_') or recipient != username:
+        return recipient
+    return msg['sender']
+
+def mailbox_of(chat_id):
+    """The server chat holding chat_id's messages: the room, or our own mailbox for DMs."""
+    return chat_id if chat_id.startswith('room_') else username
+
+def is_room_notice(msg):
+    return msg['sender'] == 'server' and msg['message'].startswith('Room ')
+
+def add_chat(chat_id):
+    chats.add(chat_id)
+    cache.add_chat(chat_id)
+    update_chats_tree()
+
+def show_messages(new_msgs):
+    # Render the whole batch with a single widget update
+    rows = []
+    for msg in new_msgs:
+        handle_message(msg, rows)
+    append_rows(rows)
+
+def handle_message(msg, rows):
+    """Handle msg and add the transcript lines it produces to rows as (line, message id or None)."""
+    global current_chat
+    sender = msg['sender']
+    chat_id = chat_of(msg)
+    message_content = msg['message']
+    if is_room_notice(msg):
+        # Parse room creation; the notice is posted in the new room itself
+        try:
+            room_number = message_content.split('Room ')[1].split(' ')[0]
+            room_id = f'room_{room_number}'
+            if room_id not in chats:
+                add_chat(room_id)
+                rows.append((f"--- Group Chat {room_number} has been created ---", None))
+            # Set as current_chat, flushing what belongs to the previous one
+            append_rows(rows)
+            rows.clear()
+            current_chat = room_id
+            show_chat(room_id, f"--- Switched to Group Chat {room_number} ---")
+        except IndexError:
+            print("[Error] Failed to parse room creation message.")
+    else:
+        if chat_id not in chats:
+            add_chat(chat_id)
+            rows.append((f"--- New chat initiated with {chat_id_display(chat_id)} ---", None))
+        if current_chat == chat_id:
+            # Already stored in the cache by receive_messages
+            rows.append((format_message(sender, message_content), msg['id']))
+
+def fetch_messages(wait=0):
+    """Fetch new messages, letting the server hold the request up to wait seconds.
+
+    Returns the number of messages received.
+    """
+    new_msgs = call_api("fetch messages", client.fetch, wait) or []
+    receive_messages(new_msgs)
+    return len(new_msgs)
+
+def stream_messages():
+    """Receive messages from the /stream push channel until it closes.
+
+    The stream resumes from the client's cursor, so a reconnect picks up
+    anything sent in between. Returns the number of messages received, or
+    None if the server has no /stream.
+    """
+    received = 0
+    token = client.token
     try:
-        response = requests.get(f"{SERVER_URL}/messages", params=params)
-        if response.status_code == 200:
-            data = response.json()
-            new_msgs = data.get('messages', [])
-            for msg in new_msgs:
-                last_message_id = max(last_message_id, msg['id'])
-                recipient = msg['recipient']
-                sender = msg['sender']
-                if recipient.startswith('room_'):
-                    chat_id = recipient
-                else:
-                    # Direct message
-                    if recipient == username:
-                        chat_id = sender
-                    else:
-                        chat_id = recipient
-                if chat_id not in chats:
-                    chats.add(chat_id)
-                    update_chats_tree()
-                    append_chat(f"--- New chat initiated with {chat_id_display(chat_id)} ---")
-                if chat_id not in messages:
-                    messages[chat_id] = []
-                message_content = msg['message']
-                if sender == 'server' and message_content.startswith('Room '):
-                    # Parse room creation
-                    try:
-                        room_number = message_content.split('Room ')[1].split(' ')[0]
-                        room_id = f'room_{room_number}'
-                        if room_id not in chats:
-                            chats.add(room_id)
-                            update_chats_tree()
-                            append_chat(f"--- Group Chat {room_number} has been created ---")
-                        # Set as current_chat
-                        global current_chat
-                        current_chat = room_id
-                        append_chat(f"--- Switched to Group Chat {room_number} ---")
-                    except IndexError:
-                        print("[Error] Failed to parse room creation message.")
-                else:
-                    # Store the message with sender info
-                    messages[chat_id].append({'sender': sender, 'message': message_content})
-                    if current_chat == chat_id:
-                        if sender == username:
-                            display_name = "You"
-                        else:
-                            display_name = sender
-                        append_chat(f"{display_name}: {message_content}")
-        else:
-            print(f"Failed to fetch messages: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error fetching messages: {e}")
+        acked_at = time.monotonic()
+        for msg in client.stream(STREAM_READ_TIMEOUT):
+            receive_messages([msg])
+            received += 1
+            # Pushed events are not confirmed by a cursor, so let the
+            # server compact what we have every now and then
+            if time.monotonic() - acked_at >= ACK_INTERVAL:
+                acknowledge_messages()
+                acked_at = time.monotonic()
+    except ChatError as e:
+        if e.status == 404:
+            return None
+        if e.status == 401 and renew_session(token):
+            return received
+        print(f"Failed to stream messages: {e}")
+    return received
+
+def acknowledge_messages():
+    call_api("acknowledge messages", client.ack)
 
 def fetch_announcement():
+    """Show the announcement if it changed; returns whether it did."""
+    announcement = call_api("fetch announcement", client.announcement)
+    if announcement is None:
+        return False
+    run_on_ui(announcement_var.set, f"Announcement: {announcement}")
+    return True
+
+def saved_session_token(name):
+    """The session token the cache of name kept from an earlier run, or None."""
+    saved = MessageCache(cache_path(CACHE_DIR, SERVER_URL, name))
     try:
-        response = requests.get(f"{SERVER_URL}/announcement")
-        if response.status_code == 200:
-            data = response.json()
-            announcement = data.get('announcement', '')
-            announcement_var.set(f"Announcement: {announcement}")
-        else:
-            print(f"Failed to fetch announcement: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error fetching announcement: {e}")
+        return saved.session_token()
+    finally:
+        saved.close()
+
+def open_cache():
+    global cache
+    cache = MessageCache(cache_path(CACHE_DIR, SERVER_URL, username))
+    if not resumed:
+        # A new registration has a new server mailbox; ids and rooms may repeat
+        cache.clear()
+        cache.set_session_token(client.token)
+
+def restore_session():
+    """Pick up where the cache left off, or fetch only the latest page.
+
+    Either way the backlog is not refetched in full: older messages are
+    paged in from /history when the transcript is scrolled to the top.
+    """
+    client.last_id = cache.cursor()
+    if client.last_id:
+        run_on_ui(show_cached_chats, cache.chats())
+        return
+    page = call_api("fetch history", client.history, None, None, TRANSCRIPT_PAGE)
+    if page:
+        new_msgs, _ = page
+        if new_msgs:
+            client.last_id = new_msgs[-1]['id']
+        receive_messages(new_msgs)
+
+def show_cached_chats(cached):
+    chats.update(cached)
+    update_chats_tree()
 
 def poll_messages():
-    while True:
-        fetch_messages()
-        update_online_users_tree()  # Periodically update online users
-        fetch_announcement()
-        time.sleep(2)  # Poll every 2 seconds
+    """Receive messages over /stream, or long-polled /messages where the server has no stream.
+
+    Messages are pushed as they arrive either way. Only when a channel
+    comes back early and empty (a dropped stream, a server that does not
+    hold long polls, or one that is failing) does the client wait before
+    trying again, backing off while that keeps happening.
+    """
+    restore_session()
+    use_stream = True
+    retry = AdaptiveInterval(*MESSAGE_RETRY)
+    while not session_lost:
+        started = time.monotonic()
+        if use_stream:
+            received = stream_messages()
+            if received is None:
+                use_stream, received = False, 0
+        else:
+            received = fetch_messages(wait=LONG_POLL_WAIT)
+            if received:
+                retry.reset()
+                continue
+        elapsed = time.monotonic() - started
+        # A channel that stayed open its full time was healthy, even if quiet
+        wait = retry.update(received or elapsed >= LONG_POLL_WAIT)
+        if elapsed < wait:
+            time.sleep(wait - elapsed)
 
 def start_polling():
     polling_thread = threading.Thread(target=poll_messages, daemon=True)
     polling_thread.start()
+    status_scheduler.add(update_online_users_tree, AdaptiveInterval(*PRESENCE_POLL))
+    status_scheduler.add(fetch_announcement, AdaptiveInterval(*ANNOUNCEMENT_POLL))
+    status_thread = threading.Thread(target=status_scheduler.run_forever, daemon=True)
+    status_thread.start()
 
 # --------------------------
 # GUI Functions
@@ -222,6 +477,7 @@ def start_gui(root):
     # Chat display
     chat_display = scrolledtext.ScrolledText(right_frame, state='disabled', width=60, height=25)
     chat_display.pack(pady=5, fill=tk.BOTH, expand=True)
+    chat_display.config(yscrollcommand=on_transcript_scroll)
 
     # Message entry
     entry_frame = tk.Frame(right_frame)
@@ -238,19 +494,181 @@ def start_gui(root):
     switch_chat_button = tk.Button(left_frame, text="Switch Chat", command=lambda: switch_chat_gui())
     switch_chat_button.pack(pady=5, fill=tk.X)
 
+    # Search button
+    search_button = tk.Button(left_frame, text="Search Messages", command=lambda: search_gui())
+    search_button.pack(pady=5, fill=tk.X)
+
     # Assign to global variables for access
     globals()['chat_display'] = chat_display
     globals()['online_users_tree'] = online_users_tree
     globals()['chats_tree'] = chats_tree
 
-    # Populate online users
-    update_online_users_tree()
+    # Start running queued UI updates, then populate online users and the
+    # announcement; polls of both start at a random point of their interval
+    app_window.after(UI_DRAIN_INTERVAL, drain_ui_queue, time.perf_counter() + UI_DRAIN_INTERVAL / 1000)
+    run_in_background(update_online_users_tree)
+    run_in_background(fetch_announcement)
+
+def format_message(sender, message_content):
+    if sender == username:
+        display_name = "You"
+    else:
+        display_name = sender
+    return f"{display_name}: {message_content}"
+
+def append_chat(message, follow=False):
+    append_rows([(message, None)], follow)
+
+def append_rows(rows, follow=False):
+    """Add (line, message id or None) rows to the bottom of the transcript in one insert.
+
+    The view follows them only if it was already at the bottom, or with
+    follow, for what the user just did themselves.
+    """
+    global transcript_oldest, transcript_newest
+    if not rows:
+        return
+    if transcript_newest is not None:
+        if not follow:
+            # Paged up past what the transcript holds: live messages wait in
+            # the cache until scrolling down reaches them
+            return
+        show_chat(current_chat, transcript_header)
+    at_end = chat_display.yview()[1] >= 1.0
+    if not (follow or at_end) and len(transcript_rows) + len(rows) > TRANSCRIPT_LINES:
+        # Trimming the top would pull away the lines being read; leave the
+        # new messages in the cache for scrolling down instead
+        first = next((msg_id for _, msg_id in rows if msg_id), None)
+        if first is not None:
+            transcript_newest = next((msg_id for msg_id in reversed(transcript_rows) if msg_id), first - 1)
+        return
+    if transcript_oldest is None:
+        # A chat opened with nothing cached pages back from its first live message
+        transcript_oldest = next((msg_id for _, msg_id in rows if msg_id), None)
+    chat_display.config(state=tk.NORMAL)
+    insert_rows(rows)
+    chat_display.config(state=tk.DISABLED)
+    if follow or at_end:
+        chat_display.see(tk.END)
+
+def insert_rows(rows):
+    """Insert rows at the bottom of the editable transcript; returns how many lines were trimmed from the top."""
+    chat_display.insert(tk.END, ''.join(line + "\n" for line, _ in rows))
+    transcript_rows.extend(msg_id for _, msg_id in rows)
+    return trim_transcript()
+
+def trim_transcript():
+    # Drop lines from the top until at most TRANSCRIPT_LINES remain
+    global transcript_oldest
+    excess = len(transcript_rows) - TRANSCRIPT_LINES
+    if excess <= 0:
+        return 0
+    chat_display.delete("1.0", f"{excess + 1}.0")
+    dropped = [transcript_rows.popleft() for _ in range(excess)]
+    last = next((msg_id for msg_id in reversed(dropped) if msg_id), None)
+    if last is not None:
+        # Scrolling back up reloads the dropped messages from the cache
+        transcript_oldest = next((msg_id for msg_id in transcript_rows if msg_id), last + 1)
+    return excess
+
+def trim_transcript_bottom():
+    # Drop lines from the bottom until at most TRANSCRIPT_LINES remain
+    global transcript_newest
+    excess = len(transcript_rows) - TRANSCRIPT_LINES
+    if excess <= 0:
+        return
+    chat_display.delete(f"{len(transcript_rows) - excess + 1}.0", tk.END)
+    dropped = [transcript_rows.pop() for _ in range(excess)]
+    first = next((msg_id for msg_id in reversed(dropped) if msg_id), None)
+    if first is not None:
+        # Scrolling back down reloads the dropped messages, and any newer, from the cache
+        transcript_newest = next((msg_id for msg_id in reversed(transcript_rows) if msg_id), first - 1)
+
+def show_chat(chat_id, header):
+    """Replace the transcript with header and the latest page of chat_id."""
+    global transcript_oldest, transcript_newest, transcript_header
+    page = cache.page(chat_id, None, TRANSCRIPT_PAGE)
+    transcript_oldest = page[0][0] if page else None
+    transcript_newest = None
+    transcript_header = header
+    chat_display.config(state=tk.NORMAL)
+    chat_display.delete("1.0", tk.END)
+    transcript_rows.clear()
+    chat_display.config(state=tk.DISABLED)
+    rows = [(header, None)]
+    rows.extend((format_message(sender, message_content), msg_id) for msg_id, sender, message_content in page)
+    append_rows(rows, follow=True)
+
+def load_older_page():
+    """Insert the page of messages before the oldest one displayed, keeping the view in place."""
+    global transcript_oldest, backfilling
+    if current_chat is None or backfilling or chat_display.yview()[0] > 0.0:
+        return
+    page = cache.page(current_chat, transcript_oldest, TRANSCRIPT_PAGE)
+    if not page:
+        # Nothing older in the cache: fetch the page before it from the server
+        mailbox = mailbox_of(current_chat)
+        if history_cursors.get(mailbox, 0) is not None:
+            backfilling = True
+            run_in_background(fetch_older_page, mailbox)
+        return
+    # Older messages go below the notices heading the transcript
+    notices = 0
+    for msg_id in transcript_rows:
+        if msg_id:
+            break
+        notices += 1
+    chat_display.config(state=tk.NORMAL)
+    chat_display.insert(f"{notices + 1}.0", ''.join(format_message(sender, message_content) + "\n"
+                                                for _, sender, message_content in page))
+    transcript_rows.rotate(-notices)
+    transcript_rows.extendleft(msg_id for msg_id, _, _ in reversed(page))
+    transcript_rows.rotate(notices)
+    # Trimmed from the far end, so the page just loaded stays
+    trim_transcript_bottom()
+    chat_display.config(state=tk.DISABLED)
+    transcript_oldest = page[0][0]
+    chat_display.yview(f"{notices + len(page) + 1}.0")
 
-def append_chat(message):
+def load_newer_page():
+    """Append the page of cached messages after the newest one displayed, keeping the view in place."""
+    global transcript_newest
+    if current_chat is None or transcript_newest is None or chat_display.yview()[1] < 1.0:
+        return
+    page = cache.page_after(current_chat, transcript_newest, TRANSCRIPT_PAGE)
+    # A short page reaches the latest message, and live ones are shown again
+    transcript_newest = page[-1][0] if len(page) == TRANSCRIPT_PAGE else None
+    if not page:
+        return
+    top = chat_display.index("@0,0")
     chat_display.config(state=tk.NORMAL)
-    chat_display.insert(tk.END, message + "\n")
+    excess = insert_rows([(format_message(sender, message_content), msg_id)
+                          for msg_id, sender, message_content in page])
     chat_display.config(state=tk.DISABLED)
-    chat_display.see(tk.END)
+    chat_display.yview(f"{max(int(top.split('.')[0]) - excess, 1)}.0")
+
+def fetch_older_page(mailbox):
+    # The first page goes back from the oldest message already cached
+    before = history_cursors[mailbox] if mailbox in history_cursors else cache.oldest(mailbox)
+    page = call_api("fetch history", client.history, mailbox, before, TRANSCRIPT_PAGE)
+    if page is not None:
+        new_msgs, history_cursors[mailbox] = page
+        store_messages(new_msgs)
+    run_on_ui(finish_older_page, page is not None)
+
+def finish_older_page(fetched):
+    global backfilling
+    backfilling = False
+    if fetched:
+        # A DM page may hold nothing for this chat; loading again fetches further back
+        load_older_page()
+
+def on_transcript_scroll(first, last):
+    chat_display.vbar.set(first, last)
+    if float(first) == 0.0 and current_chat is not None:
+        app_window.after_idle(load_older_page)
+    if float(last) == 1.0 and transcript_newest is not None:
+        app_window.after_idle(load_newer_page)
 
 def send_chat(message_entry, chat_display):
     global current_chat
@@ -259,8 +677,9 @@ def send_chat(message_entry, chat_display):
         return
     message_entry.delete(0, tk.END)
     if current_chat:
-        send_message_api(current_chat, message)
-        append_chat(f"You: {message}")
+        run_in_order(send_message_api, current_chat, message)
+        append_chat(f"You: {message}", follow=True)
+        status_scheduler.poke()
     else:
         messagebox.showwarning("No Chat Selected", "Please select a chat to send messages.")
 
@@ -273,9 +692,8 @@ def send_dm(online_users_tree):
     global current_chat
     current_chat = recipient
     if recipient not in chats:
-        chats.add(recipient)
-        update_chats_tree()
-    append_chat(f"--- Direct Message with {recipient} ---")
+        add_chat(recipient)
+    show_chat(recipient, f"--- Direct Message with {recipient} ---")
 
 def create_group_chat_gui(online_users_tree):
     selected = online_users_tree.selection()
@@ -286,7 +704,7 @@ def create_group_chat_gui(online_users_tree):
     if username in participants:
         messagebox.showwarning("Invalid Selection", "You cannot add yourself to the group chat.")
         return
-    create_room_api(participants)
+    run_in_background(create_room_api, participants)
 
 def switch_chat_gui():
     selected = chats_tree.selection()
@@ -302,14 +720,29 @@ def switch_chat_gui():
         chat_id = chat_id_display
     global current_chat
     current_chat = chat_id
-    append_chat(f"--- Chat with {chat_id_display} ---")
-    if chat_id in messages:
-        for msg in messages[chat_id]:
-            if msg['sender'] == username:
-                display_name = "You"
-            else:
-                display_name = msg['sender']
-            append_chat(f"{display_name}: {msg['message']}")
+    show_chat(chat_id, f"--- Chat with {chat_id_display} ---")
+
+def search_gui():
+    query = simpledialog.askstring("Search", "Search your chats (end a word with * to match its prefix):",
+                                   parent=app_window)
+    if query and query.strip():
+        run_in_background(search_api, query.strip())
+
+def search_api(query):
+    result = call_api("search messages", client.search, query, report=show_error)
+    if result is not None:
+        run_on_ui(show_search_results, query, *result)
+
+def show_search_results(query, found, next_before):
+    # Shown below the current chat as notices; switching chats clears them
+    rows = [(f"--- Search results for '{query}' ---", None)]
+    for msg in found:
+        rows.append((f"[{chat_id_display(chat_of(msg))}] {format_message(msg['sender'], msg['message'])}", None))
+    if not found:
+        rows.append(("No messages found.", None))
+    elif next_before is not None:
+        rows.append((f"Showing the newest {len(found)} matches; refine the search to see older ones.", None))
+    append_rows(rows, follow=True)
 
 def chat_id_display(chat_id):
     if chat_id.startswith('room_'):
@@ -326,140 +759,41 @@ def update_chats_tree():
     except Exception as e:
         print(f"Error updating chats tree: {e}")
 
-def get_announcement():
-    try:
-        response = requests.get(f"{SERVER_URL}/announcement")
-        if response.status_code == 200:
-            data = response.json()
-            announcement = data.get('announcement', '')
-            return announcement
-        else:
-            print(f"Failed to fetch announcement: {response.json().get('message')}")
-            return ""
-    except Exception as e:
-        print(f"Error fetching announcement: {e}")
-        return ""
-
-def fetch_messages():
-    global last_message_id
-    params = {
-        'username': username,
-        'last_id': last_message_id
-    }
-    try:
-        response = requests.get(f"{SERVER_URL}/messages", params=params)
-        if response.status_code == 200:
-            data = response.json()
-            new_msgs = data.get('messages', [])
-            for msg in new_msgs:
-                last_message_id = max(last_message_id, msg['id'])
-                recipient = msg['recipient']
-                sender = msg['sender']
-                if recipient.startswith('room_'):
-                    chat_id = recipient
-                else:
-                    # Direct message
-                    if recipient == username:
-                        chat_id = sender
-                    else:
-                        chat_id = recipient
-                if chat_id not in chats:
-                    chats.add(chat_id)
-                    update_chats_tree()
-                    append_chat(f"--- New chat initiated with {chat_id_display(chat_id)} ---")
-                if chat_id not in messages:
-                    messages[chat_id] = []
-                message_content = msg['message']
-                if sender == 'server' and message_content.startswith('Room '):
-                    # Parse room creation
-                    try:
-                        room_number = message_content.split('Room ')[1].split(' ')[0]
-                        room_id = f'room_{room_number}'
-                        if room_id not in chats:
-                            chats.add(room_id)
-                            update_chats_tree()
-                            append_chat(f"--- Group Chat {room_number} has been created ---")
-                        # Set as current_chat
-                        global current_chat
-                        current_chat = room_id
-                        append_chat(f"--- Switched to Group Chat {room_number} ---")
-                    except IndexError:
-                        print("[Error] Failed to parse room creation message.")
-                else:
-                    # Store the message with sender info
-                    messages[chat_id].append({'sender': sender, 'message': message_content})
-                    if current_chat == chat_id:
-                        if sender == username:
-                            display_name = "You"
-                        else:
-                            display_name = sender
-                        append_chat(f"{display_name}: {message_content}")
-        else:
-            print(f"Failed to fetch messages: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error fetching messages: {e}")
-
-def fetch_announcement():
-    try:
-        response = requests.get(f"{SERVER_URL}/announcement")
-        if response.status_code == 200:
-            data = response.json()
-            announcement = data.get('announcement', '')
-            announcement_var.set(f"Announcement: {announcement}")
-        else:
-            print(f"Failed to fetch announcement: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error fetching announcement: {e}")
-
-def poll_messages():
-    while True:
-        fetch_messages()
-        update_online_users_tree()  # Periodically update online users
-        fetch_announcement()
-        time.sleep(2)  # Poll every 2 seconds
-
-def start_polling():
-    polling_thread = threading.Thread(target=poll_messages, daemon=True)
-    polling_thread.start()
-
 # --------------------------
 # Online Users Handling
 # --------------------------
 
 def update_online_users_tree():
-    try:
-        # Step 1: Get the currently selected users
-        selected_items = online_users_tree.selection()
-        selected_users = [online_users_tree.item(item)['values'][0] for item in selected_items]
-
-        # Step 2: Fetch the latest online users from the server
-        response = requests.get(f"{SERVER_URL}/online")
-        if response.status_code == 200:
-            data = response.json()
-            users = data.get('online_users', [])
-
-            # Step 3: Repopulate the Treeview with the latest users
-            populate_online_users(users)
-
-            # Step 4: Re-select the previously selected users if they are still online
-            for user in selected_users:
-                if user in users:
-                    # Find the Treeview item corresponding to the user
-                    for item in online_users_tree.get_children():
-                        if online_users_tree.item(item)['values'][0] == user:
-                            online_users_tree.selection_add(item)
-                            break
-        else:
-            print(f"Failed to fetch online users: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error fetching online users: {e}")
-
-def populate_online_users(users):
-    # Clear existing entries
-    online_users_tree.delete(*online_users_tree.get_children())
-    for user in users:
-        if user != username:  # Exclude self
-            online_users_tree.insert("", tk.END, values=(user,))
+    """Apply presence changes to the online list; returns whether there were any."""
+    global presence_version
+    # Ask only for what changed since the version we already show
+    data = call_api("fetch online users", client.presence, presence_version)
+    if not data:
+        return False
+    run_on_ui(show_presence, data)
+    presence_version = data.get('version')
+    return bool(data.get('full') or data.get('joined') or data.get('left'))
+
+def show_presence(data):
+    if data.get('full'):
+        # Resync: diff against the rows we have rather than rebuilding the tree
+        users = set(data.get('online_users', []))
+        joined = users.difference(online_user_items)
+        left = set(online_user_items).difference(users)
+    else:
+        joined = data.get('joined', [])
+        left = data.get('left', [])
+    apply_presence(joined, left)
+
+def apply_presence(joined, left):
+    # Rows of users who stay online are never recreated, so their selection survives
+    for user in left:
+        item = online_user_items.pop(user, None)
+        if item is not None:
+            online_users_tree.delete(item)
+    for user in joined:
+        if user != username and user not in online_user_items:  # Exclude self
+            online_user_items[user] = online_users_tree.insert("", tk.END, values=(user,))
 
 # --------------------------
 # Main Function
@@ -472,8 +806,9 @@ def main():
     root = tk.Tk()
     root.withdraw()  # Hide the root window during registration
 
-    # Register user
+    # Register user, then open their message cache
     register_user(root)
+    open_cache()
 
     # Start the main GUI
     start_gui(root)
@@ -486,15 +821,13 @@ def main():
     app_window.mainloop()
 
 def on_closing(window):
-    try:
-        # Call the /logout endpoint to remove the user from online users
-        response = requests.post(f"{SERVER_URL}/logout", json={'username': username})
-        if response.status_code == 200:
-            print(response.json().get('message'))
-        else:
-            print(f"Logout failed: {response.json().get('message')}")
-    except Exception as e:
-        print(f"Error during logout: {e}")
+    # Call the /logout endpoint to remove the user from online users
+    message = call_api("log out", client.logout)
+    if message:
+        print(message)
+    if ui_stalls['count']:
+        print(f"[UI] {ui_stalls['count']} Tk loop stalls over {UI_STALL_THRESHOLD * 1000:.0f} ms, "
+              f"worst {ui_stalls['worst'] * 1000:.1f} ms")
     window.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,497 @@
+# loadgen.py
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+from chatclient import ChatClient, ChatError
+
+# --------------------------
+# Scenarios
+# --------------------------
+#
+# A scenario sets any of the options below; command-line flags override it.
+# Pass one of these names or the path of a JSON file holding such a dict.
+
+SCENARIOS = {
+    'smoke': {'users': 10, 'rooms': 2, 'rate': 1.0, 'duration': 10},
+    'rooms': {'users': 100, 'rooms': 10, 'rate': 0.5, 'duration': 30},
+    'fanout': {'users': 200, 'rooms': 1, 'rate': 0.05, 'duration': 30},
+    'direct': {'users': 100, 'rooms': 0, 'rate': 1.0, 'duration': 30},
+    # 1,000 connected clients streaming; fails unless delivery p99 stays under 50 ms
+    'delivery': {'users': 1000, 'rooms': 100, 'rate': 0.1, 'duration': 30, 'delivery_p99_ms': 50},
+    # Run with --compare: a few active users among 100 to 10k connected clients, on each engine
+    'engines': {'users': 50, 'rooms': 5, 'rate': 1.0, 'duration': 20},
+}
+DEFAULTS = {
+    'users': 10,  # Simulated users, each with its own connections
+    'rooms': 2,  # Rooms the users are spread over; 0 sends direct messages instead
+    'rate': 1.0,  # Messages per second sent by each user
+    'duration': 10,  # Seconds of sending
+    'message_size': 64,  # Bytes per message body
+    'receive': 'stream',  # How users receive: 'stream' or 'poll'
+    'drain': 2.0,  # Seconds to wait for deliveries after the last send
+    'idle': 0,  # Further clients that only hold a /stream open, on one socket each
+    'delivery_p99_ms': None,  # Fail the run if delivery p99 exceeds this, or a message is not delivered
+}
+LONG_POLL_WAIT = 25  # Seconds the server may hold a /messages request open
+STATS_INTERVAL = 1  # Seconds between samples of the server's /stats
+IDLE_CONNECT_TIMEOUT = 10  # Seconds an idle client waits for the server to accept its connection
+COMPARE_CLIENTS = '100,1000,10000'  # Connected clients per run of --compare
+
+# --------------------------
+# Server
+# --------------------------
+
+def start_server(engine, port, workers=0, options=()):
+    """Start chatserve.py on localhost and wait until it answers; options are extra command-line flags."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatserve.py')
+    command = [sys.executable, script, '--engine', engine, '--host', '127.0.0.1', '--port', str(port),
+               # Simulated users may send faster than people do; measure the server, not its limits
+               '--send-rate', '0', '--room-send-rate', '0', '--create-room-rate', '0']
+    if workers:
+        command += ['--workers', str(workers)]
+    command += options
+    # A session of its own, so the Flask reloader's child (or the broker and workers) is stopped with it
+    process = subprocess.Popen(command,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    probe = ChatClient(f"http://127.0.0.1:{port}")
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            probe.call('GET', "/stats")
+            return process
+        except ChatError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                stop_server(process)
+                raise SystemExit(f"chatserve.py did not start on port {port}")
+            time.sleep(0.1)
+        finally:
+            probe.close()
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+def source_version():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+class StatsSampler:
+    """Samples /stats in the background for server CPU time and memory."""
+
+    def __init__(self, url):
+        self.client = ChatClient(url)
+        self.samples = []  # (monotonic time, /stats answer)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        self.client.close()
+
+    def sample(self):
+        try:
+            self.samples.append((time.monotonic(), self.client.call('GET', "/stats")))
+        except ChatError as e:
+            print(f"Failed to sample server stats: {e}", file=sys.stderr)
+
+    def _run(self):
+        while not self.stopped.wait(STATS_INTERVAL):
+            self.sample()
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return {}
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        rss = [stats['rss_bytes'] for _, stats in self.samples if stats.get('rss_bytes') is not None]
+        result = {
+            'rss_bytes_start': rss[0] if rss else None,
+            'rss_bytes_peak': max(rss) if rss else None,
+            'rss_bytes_end': rss[-1] if rss else None,
+            'messages_stored': last.get('messages_stored'),
+        }
+        if 'cpu_seconds' in first and 'cpu_seconds' in last:
+            cpu = last['cpu_seconds'] - first['cpu_seconds']
+            result['cpu_seconds'] = round(cpu, 3)
+            result['cpu_percent'] = round(100 * cpu / (end - start), 1)
+        return result
+
+# --------------------------
+# Simulated users
+# --------------------------
+
+class SimulatedUser:
+    def __init__(self, url, name):
+        self.client = ChatClient(url, name)
+        self.name = name
+        self.target = None  # Room id or username this user sends to
+        self.fanout = 0  # Receivers of each message sent
+        self.sent = 0
+        self.send_errors = 0
+        self.send_latencies = []  # Seconds per /send request
+        self.delivery_latencies = []  # Seconds from send to receipt, for messages from others
+        self.receive_errors = 0
+        self.last_received = 0  # Highest message id received
+        self.last_seq = {}  # {sender: sequence number of their last message received}
+        self.out_of_order = 0  # Messages whose id or sender sequence went backwards
+        self.duplicates = 0  # Messages received twice
+
+    def receive(self, mode, stopped):
+        while not stopped.is_set():
+            try:
+                if mode == 'stream':
+                    for msg in self.client.stream():
+                        self.record(msg)
+                        if stopped.is_set():
+                            return
+                else:
+                    for msg in self.client.fetch(wait=LONG_POLL_WAIT):
+                        self.record(msg)
+            except ChatError:
+                if not stopped.is_set():
+                    self.receive_errors += 1
+                    time.sleep(0.1)
+
+    def record(self, msg):
+        received = time.time()
+        # Every receiver must see ids rising, whichever server answers it
+        if msg['id'] == self.last_received:
+            self.duplicates += 1
+            return
+        if msg['id'] < self.last_received:
+            self.out_of_order += 1
+            return
+        self.last_received = msg['id']
+        if msg['sender'] in (self.name, 'server'):
+            return
+        # Bodies start with the wall-clock time they were sent and the sender's
+        # sequence number; all users share this host's clock
+        sent_at, seq, _ = msg['message'].split(' ', 2)
+        self.delivery_latencies.append(received - float(sent_at))
+        if int(seq) <= self.last_seq.get(msg['sender'], -1):
+            self.out_of_order += 1
+        self.last_seq[msg['sender']] = int(seq)
+
+    def send_loop(self, interval, padding, started, stop_at):
+        next_at = started + random.uniform(0, interval)  # Spread users over the interval
+        # Stop on time even when behind schedule: the run measures a fixed window
+        while next_at < stop_at and time.time() < stop_at:
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            begun = time.perf_counter()
+            try:
+                self.client.send(self.target, f"{time.time():.6f} {self.sent + self.send_errors} {padding}")
+                self.sent += 1
+                self.send_latencies.append(time.perf_counter() - begun)
+            except ChatError:
+                self.send_errors += 1
+            # Keep the schedule even when a send was slow, like independent users would
+            next_at += interval
+
+def setup_users(url, count, rooms):
+    """Register the users, then put them in rooms (or pair them up for DMs)."""
+    prefix = f"lg{os.getpid()}_{int(time.time()) % 100000}_"
+    users = [SimulatedUser(url, f"{prefix}{i}") for i in range(count)]
+    for user in users:
+        user.client.register()
+    if rooms:
+        for r in range(rooms):
+            members = users[r::rooms]
+            room_id = members[0].client.create_room([member.name for member in members[1:]])
+            for member in members:
+                member.target = room_id
+                member.fanout = len(members) - 1
+    else:
+        for i, user in enumerate(users):
+            user.target = users[(i + 1) % count].name
+            user.fanout = 1
+    return users
+
+def open_idle_streams(url, count):
+    """Register count users who each open a /stream and never read or send.
+
+    Each holds one socket and no thread, so a run can keep thousands
+    connected. Returns ([(name, token)], [socket], connections refused).
+    """
+    prefix = f"idle{os.getpid()}_{int(time.time()) % 100000}_"
+    parts = urlsplit(url)
+    registrar = ChatClient(url)
+    sessions = []
+    for i in range(count):
+        registrar.register(f"{prefix}{i}")
+        sessions.append((registrar.username, registrar.token))
+    registrar.close()
+    streams = []
+    refused = 0
+    for name, token in sessions:
+        try:
+            stream = socket.create_connection((parts.hostname, parts.port), timeout=IDLE_CONNECT_TIMEOUT)
+        except OSError:
+            refused += 1
+            continue
+        stream.sendall(f"GET /stream?{urlencode({'username': name, 'last_id': 0})} HTTP/1.1\r\n"
+                       f"Host: {parts.netloc}\r\nAuthorization: Bearer {token}\r\n\r\n".encode())
+        streams.append(stream)
+    return sessions, streams, refused
+
+def close_idle_streams(url, sessions, streams):
+    for stream in streams:
+        stream.close()
+    client = ChatClient(url)
+    for name, token in sessions:
+        client.username = name
+        client.set_token(token)
+        try:
+            client.logout()
+        except ChatError:
+            pass
+    client.close()
+
+def active_pollers(url):
+    """Long polls and streams the server is holding, from /metrics; None if it did not say."""
+    client = ChatClient(url)
+    try:
+        for line in client.request('GET', "/metrics").text.splitlines():
+            if line.startswith('chat_active_pollers '):
+                return int(float(line.split()[1]))
+    except ChatError:
+        pass
+    finally:
+        client.close()
+    return None
+
+def percentiles(values):
+    """p50/p95/p99/max of values, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {
+        'p50': round(rank(0.50) * 1000, 3),
+        'p95': round(rank(0.95) * 1000, 3),
+        'p99': round(rank(0.99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+def run(url, config):
+    if config['rooms'] and config['users'] < 2 * config['rooms']:
+        raise SystemExit("Every room needs at least two users.")
+    if not config['rooms'] and config['users'] < 2:
+        raise SystemExit("Direct messages need at least two users.")
+    idle_sessions, idle_streams, refused = open_idle_streams(url, config['idle'])
+    if idle_streams:
+        time.sleep(1)  # Let the server take up every idle stream before counting them
+    idle_held = active_pollers(url) if config['idle'] else 0
+    users = setup_users(url, config['users'], config['rooms'])
+    sampler = StatsSampler(url)
+    stopped = threading.Event()
+    receivers = [threading.Thread(target=user.receive, args=(config['receive'], stopped), daemon=True)
+                 for user in users]
+    for thread in receivers:
+        thread.start()
+    time.sleep(1)  # Let every receiver connect before the clock starts
+
+    sampler.start()
+    padding = 'x' * max(0, config['message_size'] - 24)  # 24 = len of the timestamp and sequence prefix, roughly
+    started = time.time()
+    stop_at = started + config['duration']
+    senders = []
+    if config['rate'] > 0:
+        senders = [threading.Thread(target=user.send_loop, args=(1 / config['rate'], padding, started, stop_at),
+                                    daemon=True) for user in users]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    sending = time.time() - started
+    time.sleep(config['drain'])
+    stopped.set()
+    sampler.stop()
+
+    for user in users:
+        try:
+            user.client.logout()
+        except ChatError:
+            pass
+        user.client.close()
+    close_idle_streams(url, idle_sessions, idle_streams)
+
+    sent = sum(user.sent for user in users)
+    expected = sum(user.sent * user.fanout for user in users)
+    delivery = [latency for user in users for latency in user.delivery_latencies]
+    return {
+        'sent': sent,
+        'send_errors': sum(user.send_errors for user in users),
+        'receive_errors': sum(user.receive_errors for user in users),
+        'expected_deliveries': expected,
+        'delivered': len(delivery),
+        'out_of_order': sum(user.out_of_order for user in users),
+        'duplicates': sum(user.duplicates for user in users),
+        'seconds': round(sending, 3),
+        'sends_per_second': round(sent / sending, 1),
+        'deliveries_per_second': round(len(delivery) / sending, 1),
+        'delivery_latency_ms': percentiles(delivery),
+        'send_latency_ms': percentiles([latency for user in users for latency in user.send_latencies]),
+        'idle': {'clients': config['idle'], 'refused': refused, 'streams_held': idle_held},
+        'server': sampler.summary(),
+    }
+
+def compare(config, counts, port):
+    """Run config on each engine with each count of connected clients; a server is started per run.
+
+    Of each count, config['users'] clients send and receive; the others
+    only hold a /stream open.
+    """
+    runs = []
+    for engine in ('flask', 'asyncio'):
+        for clients in counts:
+            run_config = dict(config, idle=max(0, clients - config['users']))
+            process = start_server(engine, port)
+            try:
+                results = run(f"http://127.0.0.1:{port}", run_config)
+            except ChatError as e:
+                # An engine that cannot take this many clients fails the run, not the comparison
+                results = {'error': str(e)}
+            finally:
+                stop_server(process)
+            runs.append({'engine': engine, 'clients': clients, 'config': run_config, 'results': results})
+            print_comparison(runs[-1])
+    return runs
+
+def print_comparison(entry):
+    r = entry['results']
+    head = f"{entry['engine']:>7} {entry['clients']:>6} clients:"
+    if 'error' in r:
+        print(f"{head} failed: {r['error']}")
+        return
+    lat, send, server = r['delivery_latency_ms'] or {}, r['send_latency_ms'] or {}, r['server']
+    rss = server.get('rss_bytes_peak')
+    print(f"{head} {r['idle']['streams_held']}/{r['idle']['clients']} idle streams held, "
+          f"{r['delivered']}/{r['expected_deliveries']} delivered, delivery p50 {lat.get('p50')} "
+          f"p99 {lat.get('p99')} ms, send p99 {send.get('p99')} ms, "
+          f"{r['send_errors'] + r['receive_errors']} errors, cpu {server.get('cpu_percent')}%, "
+          f"rss peak {rss / 1e6 if rss else 0:.0f} MB")
+
+def check_delivery(config, r):
+    """Whether r meets config's delivery target; None if it sets none."""
+    target = config['delivery_p99_ms']
+    if target is None:
+        return None
+    lat = r['delivery_latency_ms'] or {}
+    ok = lat.get('p99') is not None and lat['p99'] <= target and r['delivered'] == r['expected_deliveries']
+    print(f"delivery target: p99 {lat.get('p99')} ms (limit {target} ms), "
+          f"{r['delivered']}/{r['expected_deliveries']} delivered: {'ok' if ok else 'FAIL'}")
+    return ok
+
+def load_scenario(name):
+    if name in SCENARIOS:
+        return dict(SCENARIOS[name])
+    with open(name) as f:
+        return json.load(f)
+
+def print_summary(results):
+    r = results['results']
+    lat = r['delivery_latency_ms'] or {}
+    server = r['server']
+    print(f"{r['sent']} sent ({r['sends_per_second']}/s), {r['delivered']}/{r['expected_deliveries']} delivered "
+          f"({r['deliveries_per_second']}/s), {r['send_errors']} send errors")
+    print(f"ordering: {r['out_of_order']} out of order, {r['duplicates']} duplicates")
+    print(f"delivery latency ms: p50 {lat.get('p50')}  p95 {lat.get('p95')}  p99 {lat.get('p99')}  max {lat.get('max')}")
+    print(f"server: cpu {server.get('cpu_percent')}%  rss {server.get('rss_bytes_start')} -> "
+          f"{server.get('rss_bytes_peak')} peak")
+    if r['idle']['clients']:
+        print(f"idle clients: {r['idle']['streams_held']}/{r['idle']['clients']} streams held, "
+              f"{r['idle']['refused']} connections refused")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate chat users against chatserve.py on localhost.')
+    parser.add_argument('--scenario', default='smoke',
+                        help=f'one of {", ".join(SCENARIOS)}, or a JSON file of options (default: smoke)')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--rooms', type=int)
+    parser.add_argument('--rate', type=float, help='messages per second per user')
+    parser.add_argument('--duration', type=float, help='seconds of sending')
+    parser.add_argument('--message-size', type=int, help='bytes per message body')
+    parser.add_argument('--receive', choices=('stream', 'poll'))
+    parser.add_argument('--drain', type=float, help='seconds to wait for deliveries after the last send')
+    parser.add_argument('--idle', type=int, help='further clients that only hold a /stream open')
+    parser.add_argument('--delivery-p99-ms', type=float,
+                        help='exit with status 1 if delivery p99 exceeds this or a message is lost')
+    parser.add_argument('--compare', action='store_true',
+                        help='run the scenario on both engines, once per --clients count')
+    parser.add_argument('--clients', default=COMPARE_CLIENTS,
+                        help=f'comma-separated connected clients per run of --compare (default: {COMPARE_CLIENTS})')
+    parser.add_argument('--url', help='use this running server instead of starting one')
+    parser.add_argument('--engine', choices=('flask', 'asyncio'), default='asyncio',
+                        help='engine of the server started for the run (default: asyncio)')
+    parser.add_argument('--port', type=int, default=5099, help='port of the server started for the run')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='start the server with this many asyncio workers sharing a broker (default: one process)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    config = dict(DEFAULTS)
+    config.update(load_scenario(args.scenario))
+    for key in DEFAULTS:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    if args.compare:
+        runs = compare(config, [int(n) for n in args.clients.split(',')], args.port)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'scenario': args.scenario, 'version': source_version(), 'python': sys.version.split()[0],
+                           'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'runs': runs}, f, indent=2)
+        sys.exit()
+
+    process = None
+    url = args.url
+    if url is None:
+        process = start_server(args.engine, args.port, args.workers)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        started_at = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        results = {
+            'scenario': args.scenario,
+            'config': config,
+            'engine': args.engine if process else None,
+            'workers': args.workers if process else None,
+            'version': source_version(),
+            'python': sys.version.split()[0],
+            'started_at': started_at,
+            'results': run(url, config),
+        }
+    finally:
+        if process:
+            stop_server(process)
+
+    print_summary(results)
+    results['delivery_target_met'] = check_delivery(config, results['results'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if results['delivery_target_met'] is False:
+        sys.exit(1)